@@ -0,0 +1,6 @@
+"""
+Ad-hoc benchmarks for ttapiutils. Run them from the root of the repository
+with python -m, e.g:
+
+    $ python -m benchmarks.deletegen_index
+"""
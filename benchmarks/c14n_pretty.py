@@ -0,0 +1,37 @@
+"""
+Compare write_c14n_pretty() with pretty printing, re-parsing and writing
+C14N.
+"""
+from __future__ import print_function, unicode_literals
+
+from io import BytesIO
+
+from lxml import etree
+
+from benchmarks.data import generate_module_list, time_call
+from ttapiutils.utils import write_c14n_pretty
+
+
+def reparse_c14n_pretty(xml):
+    out = BytesIO()
+    pretty_xml = etree.fromstring(
+        etree.tostring(xml, pretty_print=True, encoding="utf-8"))
+    pretty_xml.getroottree().write_c14n(out)
+    return out.getvalue()
+
+
+def main():
+    api_xml = generate_module_list(modules=200, series=10, events=30)
+    event_count = int(api_xml.xpath("count(//event)"))
+
+    assert reparse_c14n_pretty(api_xml) == write_c14n_pretty(api_xml)
+
+    print("Writing a document of {:d} events".format(event_count))
+    print("re-parse:          {:.3f}s".format(
+        time_call(lambda: reparse_c14n_pretty(api_xml))))
+    print("write_c14n_pretty: {:.3f}s".format(
+        time_call(lambda: write_c14n_pretty(api_xml))))
+
+
+if __name__ == "__main__":
+    main()
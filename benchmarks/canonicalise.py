@@ -0,0 +1,27 @@
+"""
+Compare the native and XSLT canonicalise engines, checking that they
+produce identical output.
+"""
+from __future__ import print_function, unicode_literals
+
+from lxml import etree
+
+from benchmarks.data import generate_module_list, time_call
+from ttapiutils.canonicalise import canonicalise
+
+
+def main():
+    api_xml = generate_module_list(modules=100, series=10, events=30)
+    event_count = int(api_xml.xpath("count(//event)"))
+
+    assert (etree.tostring(canonicalise(api_xml, engine="xslt")) ==
+            etree.tostring(canonicalise(api_xml, engine="native")))
+
+    print("Canonicalising a document of {:d} events".format(event_count))
+    for engine in ["xslt", "native"]:
+        print("{:8s} {:.3f}s".format(engine, time_call(
+            lambda: canonicalise(api_xml, engine=engine))))
+
+
+if __name__ == "__main__":
+    main()
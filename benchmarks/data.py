@@ -0,0 +1,81 @@
+"""
+Generation of large, valid, Timetable API XML documents for benchmarking.
+"""
+from __future__ import unicode_literals
+
+import datetime
+import random
+import timeit
+
+from lxml import etree
+
+
+EVENT_TYPES = ["lecture", "class", "seminar", "practical"]
+
+
+def _add_text_element(parent, name, text):
+    element = etree.SubElement(parent, name)
+    element.text = text
+    return element
+
+
+def generate_event(series, event_id, rand):
+    event = etree.SubElement(series, "event")
+    _add_text_element(event, "uniqueid", "import-{:d}".format(event_id))
+    _add_text_element(event, "name", "Event {:d}".format(event_id))
+    _add_text_element(event, "location",
+                      "Room {:d}".format(rand.randint(1, 20)))
+    _add_text_element(event, "lecturer",
+                      "Dr Lecturer {:d}".format(rand.randint(1, 50)))
+    date = datetime.date(2014, 10, 1) + datetime.timedelta(
+        days=rand.randint(0, 240))
+    _add_text_element(event, "date", date.isoformat())
+    hour = rand.randint(9, 17)
+    _add_text_element(event, "start", "{:02d}:00:00".format(hour))
+    _add_text_element(event, "end", "{:02d}:00:00".format(hour + 1))
+    _add_text_element(event, "type", rand.choice(EVENT_TYPES))
+    return event
+
+
+def generate_module_list(modules=50, series=10, events=20, seed=0):
+    """
+    Generate a moduleList with the specified number of modules, series per
+    module and events per series. Elements are in an arbitrary order.
+    """
+    rand = random.Random(seed)
+    module_list = etree.Element("moduleList")
+    event_id = 0
+
+    for m in range(modules):
+        module = etree.SubElement(module_list, "module")
+        path = etree.SubElement(module, "path")
+        _add_text_element(path, "tripos", "tripos{:d}".format(m % 7))
+        _add_text_element(path, "part", "part{:d}".format(m % 3))
+        _add_text_element(module, "name", "Module {:d}".format(m))
+
+        for s in range(series):
+            series_elem = etree.SubElement(module, "series")
+            _add_text_element(series_elem, "uniqueid", "{:d}-{:d}".format(m, s))
+            _add_text_element(series_elem, "name", "Series {:d}".format(s))
+
+            for _ in range(events):
+                generate_event(series_elem, event_id, rand)
+                event_id += 1
+
+        series_elems = list(module.iterchildren("series"))
+        rand.shuffle(series_elems)
+        for series_elem in series_elems:
+            module.append(series_elem)
+
+    module_elems = list(module_list)
+    rand.shuffle(module_elems)
+    module_list[:] = module_elems
+
+    return module_list.getroottree()
+
+
+def time_call(func, repeat=3):
+    """
+    Get the best wall clock time in seconds out of repeat calls to func.
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
@@ -0,0 +1,75 @@
+"""
+Compare deletegen's single-pass KeyedIndex with the previous approach of
+computing every key with XPath expressions as merging descends the tree.
+"""
+from __future__ import print_function, unicode_literals
+
+from copy import deepcopy
+
+from lxml import etree
+
+from benchmarks.data import generate_module_list, time_call
+from ttapiutils.deletegen import dictzip_longest, merge_module_lists
+
+
+def xpath_module_key(module):
+    return (module.xpath("string(path/tripos)"),
+            module.xpath("string(path/part)"),
+            module.xpath("string(path/subject)"),
+            module.xpath("string(name)"))
+
+
+def xpath_series_key(series):
+    module = series.xpath("..")[0]
+    return xpath_module_key(module) + (series.xpath("string(uniqueid)"),)
+
+
+def xpath_event_key(event):
+    series = event.xpath("..")[0]
+    return xpath_series_key(series) + (event.xpath("string(uniqueid)"),)
+
+
+def xpath_index(items, key):
+    return dict((key(i), i) for i in items)
+
+
+def xpath_merge_module_lists(current, future):
+    root = etree.Element("moduleList")
+    for (_, a, b) in dictzip_longest(
+            xpath_index(current.xpath("module"), xpath_module_key),
+            xpath_index(future.xpath("module"), xpath_module_key)):
+        root.append(xpath_merge_modules(a, b))
+    return root
+
+
+def xpath_merge_modules(current, future):
+    module = etree.Element("module")
+    module.append(deepcopy(future.xpath("path")[0]))
+    module.append(deepcopy(future.xpath("name")[0]))
+    for (_, a, b) in dictzip_longest(
+            xpath_index(current.xpath("series"), xpath_series_key),
+            xpath_index(future.xpath("series"), xpath_series_key)):
+        series = etree.SubElement(module, "series")
+        series.append(deepcopy(b.xpath("uniqueid")[0]))
+        series.append(deepcopy(b.xpath("name")[0]))
+        series.extend(
+            deepcopy(event_b) for (_, _, event_b) in dictzip_longest(
+                xpath_index(a.xpath("event"), xpath_event_key),
+                xpath_index(b.xpath("event"), xpath_event_key)))
+    return module
+
+
+def main():
+    current = generate_module_list(modules=100, series=10, events=30)
+    future = deepcopy(current)
+    event_count = int(current.xpath("count(//event)"))
+
+    print("Merging 2 documents of {:d} events each".format(event_count))
+    print("xpath keys:   {:.3f}s".format(
+        time_call(lambda: xpath_merge_module_lists(current, future))))
+    print("keyed index:  {:.3f}s".format(
+        time_call(lambda: merge_module_lists(current, future))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""
+Compare checking two documents for equality with fingerprints against
+comparing their canonical serialisations.
+"""
+from __future__ import print_function, unicode_literals
+
+from copy import deepcopy
+
+from benchmarks.data import generate_module_list, time_call
+from ttapiutils.canonicalise import canonicalise
+from ttapiutils.fingerprint import fingerprint
+from ttapiutils.utils import write_c14n_pretty
+
+
+def main():
+    a = generate_module_list(modules=100, series=10, events=30)
+    b = deepcopy(a)
+    event_count = int(a.xpath("count(//event)"))
+
+    print("Comparing 2 documents of {:d} events each".format(event_count))
+    print("canonical serialisation: {:.3f}s".format(time_call(
+        lambda: write_c14n_pretty(canonicalise(a)) ==
+        write_c14n_pretty(canonicalise(b)))))
+    print("fingerprint:             {:.3f}s".format(time_call(
+        lambda: fingerprint(a) == fingerprint(b))))
+
+
+if __name__ == "__main__":
+    main()
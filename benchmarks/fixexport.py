@@ -0,0 +1,30 @@
+"""
+Compare the native and XSLT fix_export_ids engines, checking that they
+produce identical output.
+"""
+from __future__ import print_function, unicode_literals
+
+from lxml import etree
+
+from benchmarks.data import generate_module_list, time_call
+from ttapiutils.fixexport import fix_export_ids
+
+
+def main():
+    api_xml = generate_module_list(modules=100, series=10, events=30)
+    event_count = int(api_xml.xpath("count(//event)"))
+
+    assert (etree.tostring(fix_export_ids(api_xml, engine="xslt")) ==
+            etree.tostring(fix_export_ids(api_xml, engine="native")))
+
+    print("Fixing the IDs of a document of {:d} events".format(event_count))
+    for engine in ["xslt", "native"]:
+        print("{:16s} {:.3f}s".format(engine, time_call(
+            lambda: fix_export_ids(api_xml, engine=engine))))
+    # Each call modifies api_xml, but only the first actually changes IDs
+    print("{:16s} {:.3f}s".format("native in place", time_call(
+        lambda: fix_export_ids(api_xml, in_place=True))))
+
+
+if __name__ == "__main__":
+    main()
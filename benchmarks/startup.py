@@ -0,0 +1,31 @@
+"""
+Measure the time taken by python -m ttapiutils <cmd> --help for each
+subcommand, to catch regressions in startup time.
+"""
+from __future__ import print_function, unicode_literals
+
+import os
+import subprocess
+import sys
+import timeit
+
+from ttapiutils import get_subcommand_entrypoints
+
+
+def time_help(args, repeat=5):
+    with open(os.devnull, "w") as devnull:
+        def run():
+            subprocess.check_call(
+                [sys.executable, "-m", "ttapiutils"] + args + ["--help"],
+                stdout=devnull)
+        return min(timeit.repeat(run, number=1, repeat=repeat))
+
+
+def main():
+    print("{:14s} {:.3f}s".format("(none)", time_help([])))
+    for name in sorted(get_subcommand_entrypoints()):
+        print("{:14s} {:.3f}s".format(name, time_help([name])))
+
+
+if __name__ == "__main__":
+    main()
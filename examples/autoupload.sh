@@ -21,7 +21,11 @@ autoimport_status=$?
 
 echo "autoimport: pid: $autoimport_pid, status: $autoimport_status"
 
-if [ $autoimport_status -ne 0 ] ; then
+# autoimport exits with status 3 when nothing has changed, so nothing was imported
+if [ $autoimport_status -eq 3 ] ; then
+	logger -t autoimport-engineering -p user.info -s "Timetable Engineering autoimport (pid:$autoimport_pid) skipped, nothing changed."
+	autoimport_status=0
+elif [ $autoimport_status -ne 0 ] ; then
 	logger -t autoimport-engineering -p user.error -s  "Timetable Engineering autoimport (pid:$autoimport_pid) failed, status:$autoimport_status" "$(cat $autoimport_outfile)"
 else
 	logger -t autoimport-engineering -p user.info -s "Timetable Engineering autoimport (pid:$autoimport_pid) succeeded."
@@ -40,8 +40,10 @@ setup(
             "fixexport = ttapiutils.fixexport",
             "xmlexport = ttapiutils.xmlexport",
             "deletegen = ttapiutils.deletegen",
+            "fingerprint = ttapiutils.fingerprint",
             "xmlimport = ttapiutils.xmlimport",
-            "autoimport = ttapiutils.autoimport"
+            "autoimport = ttapiutils.autoimport",
+            "serve = ttapiutils.serve"
         ]
     },
     packages=['ttapiutils'],
@@ -1,6 +1,6 @@
 """
 usage: ttapiutils autoimport [-X=<name>=<value>...] [options] <data-source> <domain> <path>...
-       ttapiutils autoimport --complete-dry-run=<audit-dir>
+       ttapiutils autoimport [options] --complete-dry-run=<audit-dir>
 
 In the first form, <data-source> provides new timetable XML data
 to be imported into <path>s on <domain>, replacing existing data.
@@ -13,6 +13,13 @@ the new state are taken care of automatically.
 In the second form, the yet-unimported data from a dir created
 by --audit-trail with --dry-run can be imported. This is useful
 for completing an import after manually verifying behaviour.
+The import is only made if the current state of the dry run's
+<path>s is still the state the dry run was based on, unless
+--skip-verify is used. The import's HTTP request and response are
+recorded in the dir.
+
+If the data produced by <data-source> is equivalent to the current
+state of <path>s, nothing is imported and the exit status is 3.
 
 options:
     <data-source>
@@ -32,7 +39,8 @@ options:
     --audit-trail=<base-dir>
         Create a timestamped subdirectory of <dir> containing a record
         of the data received, generated and sent by an invocation of
-        this program.
+        this program, and the measurements of each stage as with
+        --timings.
 
     --user=<user>
         The username to authenticate with.
@@ -50,15 +58,53 @@ options:
         Generate all data, but don't actually perform the final
         xmlimport on the timetable site.
 
+    --concurrency=<n>
+        The maximum number of <path>s to export at once [default: 4].
+
+    --cache-dir=<dir>
+    --cache-max-age=<seconds>
+        Cache exports of the current state of <path>s, as with ttapiutils
+        xmlexport.
+
+    --state-dir=<dir>
+        Store the state of <path>s in <dir> after each import, and use it
+        as the current state of <path>s in the next import instead of
+        exporting them.
+
+    --full-export-every=<n>
+        With --state-dir, export <path>s rather than using their stored
+        state once it's been used for <n> runs [default: 24].
+
+    --force-import
+        Import the data even if it's equivalent to the current state of
+        <path>s.
+
+    --timings
+        Print the time, memory use, data size and module, series and
+        event counts of each stage of the import to stderr.
+
+    --skip-verify
+        With --complete-dry-run, import without checking that the current
+        state of <path>s hasn't changed since the dry run.
+
+    --strict-validation
+        Validate every XML document at every stage, even those already
+        known to be valid. Also enabled by the
+        TTAPIUTILS_STRICT_VALIDATION envar.
+
     -X=<name>=<value>
         Extension parameters to send to the data source.
 """
 
+from __future__ import print_function
+
 # Data source: - for stdin, or name of generator, e.g. engineering
 #    - ttapiutils.autoimport.generators: engineering
 # domain to upload to
 # list of of paths to be affected
-from collections import defaultdict
+from collections import Counter, defaultdict
+import contextlib
+from copy import deepcopy
 import functools
 import json
 import os
@@ -66,26 +112,46 @@ import os.path
 import re
 import sys
 
+from lxml import etree
 import docopt
 import pkg_resources
 
-from ttapiutils.canonicalise import canonicalise
+from ttapiutils.canonicalise import (
+    canonicalise, canonicalise_module, module_sort_key)
 from ttapiutils.deletegen import generate_deletes
+from ttapiutils.fingerprint import fingerprint, hex_fingerprint
 from ttapiutils.fixexport import fix_export_ids
+from ttapiutils.index import module_key, report_duplicates
+from ttapiutils.instrument import print_stats_table, StageInstrumentation
 from ttapiutils.merge import merge
+from ttapiutils.stages import StageGraph
+from ttapiutils.statestore import StateStore
 from ttapiutils.utils import (
+    assert_valid,
+    create_session,
     DirectoryAuditLogger,
     get_credentials,
     get_proto,
+    get_validation_counts,
+    is_marked_valid,
+    iter_modules,
+    mark_valid,
     parse_xml,
     read_password,
+    recording_validation_counts,
+    scoped_validity_marks,
     serialise_http_request,
     serialise_http_response,
+    set_strict_validation,
     TimetableApiUtilsException,
     write_c14n_pretty
 )
-from ttapiutils.xmlexport import xmlexport
-from ttapiutils.xmlimport import xmlimport
+from ttapiutils.xmlexport import get_export_cache, xmlexport, xmlexport_paths
+from ttapiutils.xmlimport import get_timetable_path, ImportClient
+
+
+# The exit status when nothing is imported as nothing has changed
+EXIT_STATUS_UNCHANGED = 3
 
 
 class NoSuchDataSourceException(TimetableApiUtilsException):
@@ -94,6 +160,9 @@ class NoSuchDataSourceException(TimetableApiUtilsException):
 class DataSourceParamsException(TimetableApiUtilsException):
     pass
 
+class DryRunCompletionException(TimetableApiUtilsException):
+    pass
+
 
 def get_defined_data_source_entrypoints():
     return dict((ep.name, ep)
@@ -123,6 +192,10 @@ class StreamDataSource(object):
     def get_xml(self):
         return parse_xml(self.file)
 
+    def iter_modules(self):
+        # AutoImporter validates modules from iter_modules() as they arrive
+        return iter_modules(self.file, validate=False)
+
 
 def get_data_source_factory(data_source_name, data_source_entrypoints=None):
     if data_source_name == "-":
@@ -150,15 +223,120 @@ def parse_data_source_args(x_params):
     return dict(params.items())
 
 
+def get_data_source_modules(data_source):
+    """
+    Get an iterator over the modules produced by data_source, and whether
+    they're already known to be valid.
+
+    Data sources can provide iter_modules() to yield modules as they're
+    generated. Data sources which only provide get_xml() have the modules
+    of its result iterated over, which are known to be valid if the result
+    is marked valid.
+    """
+    if hasattr(data_source, "iter_modules"):
+        return data_source.iter_modules(), False
+
+    api_xml = data_source.get_xml()
+    if isinstance(api_xml, etree._ElementTree):
+        api_xml = api_xml.getroot()
+    # Checked before modules are detached from api_xml
+    is_valid = is_marked_valid(api_xml)
+    return iter(list(api_xml.iterchildren("module"))), is_valid
+
+
+class NewStateBuilder(object):
+    """
+    Builds the raw and canonical new state from modules as they're
+    produced by a data source, so that each module is validated and
+    canonicalised while the data source generates the next.
+    """
+    def __init__(self):
+        self._raw = etree.Element("moduleList")
+        self._canonical_modules = []
+        self._keys = set()
+
+    def _assert_module_valid(self, module):
+        wrapper = etree.Element("moduleList")
+        wrapper.append(module)
+        assert_valid(wrapper, stage="autoimport.new_module", remember=False)
+
+    def add_module(self, module, validate=True):
+        """
+        Add module to the new state, validating it unless validate is False.
+        """
+        if validate:
+            self._assert_module_valid(module)
+
+        key = module_key(module)
+        if key in self._keys:
+            raise report_duplicates(Counter({key: 1}))
+        self._keys.add(key)
+
+        canonical_module = deepcopy(module)
+        canonical_module.tail = None
+        canonicalise_module(canonical_module)
+        self._canonical_modules.append(canonical_module)
+        self._raw.append(module)
+
+    def _create_state(self, module_list):
+        state = etree.ElementTree(module_list)
+        if len(module_list) == 0:
+            # An empty moduleList is invalid
+            assert_valid(state, stage="autoimport.new_state")
+        # The schema has no constraints between modules, so a moduleList of
+        # valid modules is valid
+        mark_valid(state)
+        return state
+
+    def get_raw_state(self):
+        return self._create_state(self._raw)
+
+    def get_canonical_state(self):
+        """
+        Get the new state as canonicalise() would canonicalise the raw
+        state.
+        """
+        module_list = etree.Element("moduleList")
+        module_list.extend(
+            sorted(self._canonical_modules, key=module_sort_key))
+        return self._create_state(module_list)
+
+
 class AutoImporter(object):
     def __init__(self, data_source, domain, is_dry_run=False, permitted_paths=None,
-                 http_protocol="https", auth=None):
+                 http_protocol="https", auth=None, concurrency=1,
+                 export_cache=None, force_import=False, state_store=None,
+                 instrument=False, session=None):
         self.data_source = data_source
         self._is_dry_run = bool(is_dry_run)
         self._permitted_paths = permitted_paths
         self._http_protocol = http_protocol
         self._domain = domain
         self._auth = auth
+        self._concurrency = concurrency
+        self._session = session
+        self._export_cache = export_cache
+        # Caches can be shared between runs, so their stats at the start of
+        # this one are subtracted from their stats at the end.
+        self._export_cache_initial_stats = (
+            None if export_cache is None else export_cache.get_stats())
+        self._validation_counts = defaultdict(Counter)
+        # Trees marked valid by this run's stages, which are released with
+        # the importer rather than kept alive by the process-wide LRU
+        self._validity_marks = {}
+        self._import_client = None
+        self._stages = None
+        self._force_import = bool(force_import)
+        self._state_store = state_store
+        # The source ("store" or "export") of each path's old state, and
+        # the paths whose exported state differed from their stored state
+        self._old_state_sources = {}
+        self._drifted_paths = set()
+        self._runs_since_export = {}
+        # instrument is True or a StageInstrumentation to measure stages
+        if instrument is True:
+            instrument = StageInstrumentation()
+        self._instrumentation = instrument or None
 
     def get_paths(self):
         return self._permitted_paths
@@ -175,42 +353,256 @@ class AutoImporter(object):
     def is_dry_run(self):
         return self._is_dry_run
 
+    def get_concurrency(self):
+        return self._concurrency
+
+    def is_forced_import(self):
+        return self._force_import
+
+    def get_export_cache(self):
+        return self._export_cache
+
+    def get_state_store(self):
+        return self._state_store
+
+    def get_session(self):
+        if self._session is None:
+            self._session = create_session(
+                pool_size=max(self.get_concurrency(), 1))
+        return self._session
+
+    def get_import_client(self):
+        if self._import_client is None:
+            self._import_client = ImportClient(
+                self.get_domain(), proto=self.get_proto(),
+                auth=self.get_auth(), session=self.get_session())
+        return self._import_client
+
+    def get_stages(self):
+        """
+        Get the StageGraph of this import, creating it on first use.
+        """
+        if self._stages is None:
+            self._stages = self.create_stages()
+        return self._stages
+
+    @contextlib.contextmanager
+    def _stage_context(self):
+        with recording_validation_counts(self._validation_counts):
+            with scoped_validity_marks(self._validity_marks):
+                yield
+
+    def create_stages(self):
+        """
+        Create the StageGraph of the import pipeline. The new and old state
+        branches are independent, so they (and the old state of each path)
+        are computed concurrently.
+        """
+        stages = StageGraph(
+            concurrency=self.get_concurrency(),
+            instrument=self._instrumentation,
+            context=self._stage_context)
+        stages.add_stage("new_state", self.build_new_state)
+        stages.add_stage("raw_new_state", NewStateBuilder.get_raw_state,
+                         ["new_state"])
+        # The raw new state is a dependency so that it's always available
+        # to hooks, even though the canonical state is built separately.
+        stages.add_stage("canonical_new_state",
+                         lambda builder, raw: builder.get_canonical_state(),
+                         ["new_state", "raw_new_state"])
+
+        old_states = []
+        for path in self.get_paths():
+            raw_name = get_path_stage_name("raw_old_state", path)
+            fixed_name = get_path_stage_name("fixed_old_state", path)
+            stages.add_stage(raw_name,
+                             functools.partial(self.export_old_state, path))
+            stages.add_stage(fixed_name, fix_export_ids, [raw_name])
+
+            if self.get_state_store() is None:
+                old_states.append(fixed_name)
+            else:
+                # The fixed state is only computed if the stored state can't
+                # be used.
+                old_name = get_path_stage_name("old_state", path)
+                stages.add_stage(old_name, functools.partial(
+                    self.get_stored_or_exported_old_state, path))
+                old_states.append(old_name)
+
+        stages.add_stage("merged_old_state",
+                         lambda *states: merge(states, copy=True),
+                         old_states)
+        stages.add_stage("canonical_merged_old_state", canonicalise,
+                         ["merged_old_state"])
+        stages.add_stage("state_with_deletes", generate_deletes,
+                         ["canonical_merged_old_state",
+                          "canonical_new_state"])
+        stages.add_stage("is_unchanged", is_unchanged,
+                         ["canonical_merged_old_state",
+                          "canonical_new_state"])
+        stages.add_stage("import", self.import_to_timetable,
+                         ["state_with_deletes"])
+        return stages
+
+    def build_new_state(self):
+        """
+        Get a NewStateBuilder containing the modules of the data source.
+        """
+        builder = NewStateBuilder()
+        modules, is_valid = get_data_source_modules(self.data_source)
+        for module in modules:
+            builder.add_module(module, validate=not is_valid)
+        return builder
+
+    def export_old_state(self, path):
+        return xmlexport(self.get_domain(), path, auth=self.get_auth(),
+                         proto=self.get_proto(), fix_ids=False,
+                         session=self.get_session(),
+                         cache=self.get_export_cache())
+
+    def get_stored_or_exported_old_state(self, path):
+        """
+        Get the stored state of path, or its exported state if it's not
+        stored or is due to be exported.
+        """
+        store = self.get_state_store()
+        stored = store.load(self.get_domain(), path)
+        if not store.needs_export(stored):
+            self._old_state_sources[path] = "store"
+            self._runs_since_export[path] = stored.runs_since_export + 1
+            return stored.api_xml
+
+        exported = self.get_fixed_old_state(path)
+        self._old_state_sources[path] = "export"
+        self._runs_since_export[path] = 0
+        if stored is not None and (hex_fingerprint(fingerprint(exported)) !=
+                                   stored.fingerprint):
+            self._drifted_paths.add(path)
+        return exported
+
+    def save_state(self):
+        """
+        Store the new state of each path as its current state.
+        """
+        store = self.get_state_store()
+        new_state = self.get_canonical_new_state()
+        for path in self.get_paths():
+            path_state = etree.Element("moduleList")
+            path_state.extend(
+                deepcopy(module)
+                for module in new_state.xpath("/moduleList/module")
+                if get_timetable_path(module.find("path")) == path)
+
+            # An empty moduleList isn't valid, so empty paths are exported
+            if len(path_state) == 0:
+                store.forget(self.get_domain(), path)
+            else:
+                store.save(self.get_domain(), path, path_state,
+                           runs_since_export=self._runs_since_export.get(
+                               path, 0))
+
+    def get_validation_counts(self):
+        """
+        Get the validation counts (as with utils.get_validation_counts()) of
+        this import alone.
+        """
+        return get_validation_counts(self._validation_counts)
+
+    def get_export_cache_stats(self):
+        """
+        Get the hits and misses of the export cache made since this
+        importer was created.
+        """
+        stats = self.get_export_cache().get_stats()
+        return dict((key, value - self._export_cache_initial_stats[key])
+                    for (key, value) in stats.items())
+
+    def forget_state(self):
+        """
+        Remove the stored state of each path, so that they're exported by
+        the next import.
+        """
+        for path in self.get_paths():
+            self.get_state_store().forget(self.get_domain(), path)
+
+    def get_stage_stats(self):
+        """
+        Get the measurements of each stage which has been run (see
+        StageInstrumentation), or None if stages aren't instrumented.
+        """
+        if self._instrumentation is None:
+            return None
+        return self._instrumentation.get_stats()
+
+    def get_state_store_stats(self):
+        return {
+            "old_state_sources": self._old_state_sources,
+            "drifted_paths": sorted(self._drifted_paths)
+        }
+
     def get_raw_new_state(self):
-        return self.data_source.get_xml()
+        return self.get_stages().get("raw_new_state")
 
     def get_canonical_new_state(self):
-        return canonicalise(self.get_raw_new_state())
+        return self.get_stages().get("canonical_new_state")
 
     def get_raw_old_state(self, path):
-        return xmlexport(self.get_domain(), path, auth=self.get_auth(),
-                         proto=self.get_proto(), fix_ids=False)
+        return self.get_stages().get(
+            get_path_stage_name("raw_old_state", path))
 
     def get_fixed_old_state(self, path):
         """
         As get_raw_old_state() but with event IDs fixed.
         """
-        return fix_export_ids(self.get_raw_old_state(path))
+        return self.get_stages().get(
+            get_path_stage_name("fixed_old_state", path))
 
     def get_merged_old_state(self):
-        return merge(
-            self.get_fixed_old_state(path) for path in self.get_paths())
+        return self.get_stages().get("merged_old_state")
 
     def get_canonical_merged_old_state(self):
-        return canonicalise(self.get_merged_old_state())
+        return self.get_stages().get("canonical_merged_old_state")
 
     def get_state_with_deletes(self):
-        old_state = self.get_canonical_merged_old_state()
-        new_state = self.get_canonical_new_state()
-        return generate_deletes(old_state, new_state)
+        return self.get_stages().get("state_with_deletes")
+
+    def is_unchanged(self):
+        """
+        Check if the new state is equivalent to the old state, in which
+        case there's nothing to import.
+        """
+        return self.get_stages().get("is_unchanged")
+
+    def is_import_skipped(self):
+        return not self.is_forced_import() and self.is_unchanged()
 
     def import_to_timetable(self, api_xml):
-        return xmlimport(api_xml, self.get_domain(), paths=self.get_paths(),
-                  proto=self.get_proto(), auth=self.get_auth(),
-                  dry_run=self.is_dry_run())
+        return self.get_import_client().import_xml(
+            api_xml, paths=self.get_paths(), dry_run=self.is_dry_run())
 
     def auto_import(self):
-        api_xml = self.get_state_with_deletes()
-        self.import_to_timetable(api_xml)
+        """
+        Import the new state, unless it's unchanged (and the import isn't
+        forced). Returns the import's (request, response), or None if it
+        was skipped.
+        """
+        stores_state = (self.get_state_store() is not None and
+                        not self.is_dry_run())
+        if self.is_import_skipped():
+            result = None
+        else:
+            try:
+                result = self.get_stages().get("import")
+            except Exception:
+                # The import may have been partially applied, so the stored
+                # state can't be trusted.
+                if stores_state:
+                    self.forget_state()
+                raise
+
+        if stores_state:
+            self.save_state()
+        return result
 
 
 def path_filename_representation(path):
@@ -222,8 +614,21 @@ def path_filename_representation(path):
     return re.sub(r"^/(.*)$", r"\1", path).replace("/", ".")
 
 
+def is_unchanged(old_state, new_state):
+    return fingerprint(old_state) == fingerprint(new_state)
+
+
+def get_path_stage_name(name, path):
+    return "{}_{}".format(name, path_filename_representation(path))
+
+
 class AuditTrailAutoImporter(AutoImporter):
     def __init__(self, audit_log, *args, **kwargs):
+        # Stage measurements are always recorded in the manifest. Sizes are
+        # those of the logged results, as the audit log already serialises
+        # every stage's result.
+        if not isinstance(kwargs.get("instrument"), StageInstrumentation):
+            kwargs["instrument"] = StageInstrumentation(measure_size=False)
         super(AuditTrailAutoImporter, self).__init__(*args, **kwargs)
         self._audit_log = audit_log
         self.log_manifest()
@@ -242,45 +647,33 @@ class AuditTrailAutoImporter(AutoImporter):
             "permitted_paths": self.get_paths(),
             "http_proto": self.get_proto(),
             "domain": self.get_domain(),
-            "is_dry_run": self.is_dry_run()
+            "is_dry_run": self.is_dry_run(),
+            "concurrency": self.get_concurrency(),
+            "export_cache_dir": (None if self.get_export_cache() is None
+                                 else self.get_export_cache().directory),
+            "force_import": self.is_forced_import(),
+            "state_dir": (None if self.get_state_store() is None
+                          else self.get_state_store().directory)
         }
 
-    # Override XML producing methods to log output to audit dir
-    def get_raw_new_state(self):
-        return self.log_xml("raw_new_state",
-            super(AuditTrailAutoImporter, self).get_raw_new_state())
-
-    def get_canonical_new_state(self):
-        return self.log_xml("canonical_new_state",
-            super(AuditTrailAutoImporter, self).get_canonical_new_state())
-
-    def get_raw_old_state(self, path):
-        return self.log_xml(
-            "raw_old_state_{}".format(path_filename_representation(path)),
-            super(AuditTrailAutoImporter, self).get_raw_old_state(path))
-
-    def get_fixed_old_state(self, path):
-        return self.log_xml(
-            "fixed_old_state_{}".format(path_filename_representation(path)),
-            super(AuditTrailAutoImporter, self).get_fixed_old_state(path))
-
-    def get_merged_old_state(self):
-        return self.log_xml("merged_old_state",
-            super(AuditTrailAutoImporter, self).get_merged_old_state())
-
-    def get_canonical_merged_old_state(self):
-        return self.log_xml("canonical_merged_old_state",
-            super(AuditTrailAutoImporter, self)
-            .get_canonical_merged_old_state())
-
-    def get_state_with_deletes(self):
-        return self.log_xml("state_with_deletes",
-            super(AuditTrailAutoImporter, self).get_state_with_deletes())
-
-    def import_to_timetable(self, api_xml):
-        request, response = (super(AuditTrailAutoImporter, self)
-            .import_to_timetable(api_xml))
+    def create_stages(self):
+        stages = super(AuditTrailAutoImporter, self).create_stages()
+        stages.add_hook(self.log_stage)
+        return stages
 
+    def log_stage(self, name, result):
+        """
+        Log the result of a stage to the audit dir.
+        """
+        if name == "import":
+            self.log_import(*result)
+        elif isinstance(result, (etree._Element, etree._ElementTree)):
+            self.log_xml(name, result)
+            self._instrumentation.record_size(
+                name, self._audit_log.get_audit_file_size(
+                    "{}.xml".format(name)))
+
+    def log_import(self, request, response):
         with self._audit_log.open_audit_file("http_request.txt") as f:
             serialise_http_request(request, f)
 
@@ -290,10 +683,127 @@ class AuditTrailAutoImporter(AutoImporter):
             with self._audit_log.open_audit_file("http_response.txt") as f:
                 serialise_http_response(response, f)
 
+    def auto_import(self):
+        manifest = self.get_manifest_json()
+        try:
+            result = super(AuditTrailAutoImporter, self).auto_import()
+            if result is None:
+                manifest["skipped"] = "unchanged"
+            return result
+        finally:
+            manifest["stages"] = self.get_stage_stats()
+            self._audit_log.log_json("manifest", manifest)
+            self._audit_log.log_json("validation_counts",
+                                     self.get_validation_counts())
+            if self.get_export_cache() is not None:
+                self._audit_log.log_json("export_cache",
+                                         self.get_export_cache_stats())
+            if self.get_state_store() is not None:
+                self._audit_log.log_json("state_store",
+                                         self.get_state_store_stats())
+
+
+def create_auto_importer(data_source_factory, data_source_params, domain,
+                         audit_trail_base_dir=None, **kwargs):
+    """
+    Create an AutoImporter for domain with a data source created from
+    data_source_params. If audit_trail_base_dir is provided an
+    AuditTrailAutoImporter is created, logging to a new dir in it.
+    kwargs are passed to the AutoImporter.
+    """
+    if audit_trail_base_dir is None:
+        data_source = data_source_factory(data_source_params)
+        return AutoImporter(data_source, domain, **kwargs)
+
+    audit_log = DirectoryAuditLogger(audit_trail_base_dir)
+    data_source_params["audit_log"] = audit_log
+    data_source = data_source_factory(data_source_params)
+    return AuditTrailAutoImporter(audit_log, data_source, domain, **kwargs)
+
+
+def complete_dry_run(audit_dir, auth=None, verify=True, concurrency=1,
+                     session=None):
+    """
+    Make the import recorded by an AuditTrailAutoImporter dry run in
+    audit_dir, without recomputing it.
+
+    If verify is True the current state of the dry run's paths is exported
+    and compared with the old state the dry run was based on, and
+    DryRunCompletionException is raised if it's changed. If the dry run
+    used a state dir, the stored state of its paths is forgotten. Returns
+    the import's (request, response), or None if the dry run found nothing
+    to import.
+    """
+    def audit_file(name):
+        return os.path.join(audit_dir, name)
+
+    with open(audit_file("manifest.json")) as f:
+        manifest = json.load(f)
+    if not manifest.get("is_dry_run"):
+        raise DryRunCompletionException(
+            "Not a dry run: {}".format(audit_dir))
+    if os.path.exists(audit_file("complete_http_request.txt")):
+        raise DryRunCompletionException(
+            "Dry run already completed: {}".format(audit_dir))
+    if manifest.get("skipped") == "unchanged":
+        return None
+
+    domain = manifest["domain"]
+    paths = manifest["permitted_paths"]
+    proto = manifest["http_proto"]
+    if session is None:
+        session = create_session(pool_size=max(concurrency, 1))
+
+    if verify:
+        dry_run_old_state = parse_xml(
+            audit_file("canonical_merged_old_state.xml"))
+        current_state = merge(xmlexport_paths(
+            domain, paths, auth=auth, proto=proto, session=session,
+            concurrency=concurrency))
+        if fingerprint(current_state) != fingerprint(dry_run_old_state):
+            raise DryRunCompletionException(
+                "The current state of {} has changed since the dry run: {}"
+                .format(", ".join(paths), audit_dir))
+
+    # The dry run didn't store its state, so the stored state of its paths
+    # would be out of date after the import. They're exported next time.
+    if manifest.get("state_dir") is not None:
+        state_store = StateStore(manifest["state_dir"])
+        for path in paths:
+            state_store.forget(domain, path)
+
+    # The payload is uploaded directly from the audit file
+    state_with_deletes_file = audit_file("state_with_deletes.xml")
+    client = ImportClient(domain, proto=proto, auth=auth, session=session)
+    request, response = client.import_xml(
+        parse_xml(state_with_deletes_file), paths=paths,
+        api_xml_file=state_with_deletes_file)
+
+    with open(audit_file("complete_http_request.txt"), "w") as f:
+        serialise_http_request(request, f)
+    with open(audit_file("complete_http_response.txt"), "w") as f:
+        serialise_http_response(response, f)
+    return (request, response)
+
+
+def complete_dry_run_main(args):
+    result = complete_dry_run(
+        args["--complete-dry-run"], auth=get_credentials(args),
+        verify=not args["--skip-verify"],
+        concurrency=int(args["--concurrency"]))
+    if result is None:
+        print("Nothing imported as the dry run found no changes",
+              file=sys.stderr)
+        sys.exit(EXIT_STATUS_UNCHANGED)
+
 
 def main(argv):
     args = docopt.docopt(__doc__, argv=argv)
 
+    if args["--complete-dry-run"]:
+        complete_dry_run_main(args)
+        return
+
     # TODO: log cmd line args in manifest.json
     credentials = get_credentials(args)
     proto = get_proto(args)
@@ -301,27 +811,38 @@ def main(argv):
     paths = args["<path>"]
     audit_trail_base_dir = args["--audit-trail"]
     dry_run = args["--dry-run"]
+    concurrency = int(args["--concurrency"])
+    export_cache = get_export_cache(args)
+    force_import = args["--force-import"]
+    timings = args["--timings"]
+    state_store = None
+    if args["--state-dir"]:
+        state_store = StateStore(
+            args["--state-dir"],
+            full_export_interval=int(args["--full-export-every"]))
+
+    if args["--strict-validation"]:
+        set_strict_validation(True)
 
     data_source_factory = get_data_source_factory(args["<data-source>"])
     data_source_params = parse_data_source_args(args["-X"])
 
-    # Construct an auto importer from our params
-    args = [domain]
-    kwargs = dict(
+    auto_importer = create_auto_importer(
+        data_source_factory, data_source_params, domain,
+        audit_trail_base_dir=audit_trail_base_dir,
         is_dry_run=dry_run, permitted_paths=paths, http_protocol=proto,
-        auth=credentials)
-    if audit_trail_base_dir is None:
-        importer_class = AutoImporter
-        data_source = data_source_factory(data_source_params)
-        args = [data_source] + args
-    else:
-        audit_log = DirectoryAuditLogger(audit_trail_base_dir)
-        data_source_params["audit_log"] = audit_log
-        data_source = data_source_factory(data_source_params)
-        importer_class = AuditTrailAutoImporter
-        args = [audit_log, data_source] + args
-
-    auto_importer = importer_class(*args, **kwargs)
+        auth=credentials, concurrency=concurrency,
+        export_cache=export_cache, force_import=force_import,
+        state_store=state_store, instrument=timings)
 
     # Perform the import
-    auto_importer.auto_import()
+    try:
+        result = auto_importer.auto_import()
+    finally:
+        if timings:
+            print_stats_table(auto_importer.get_stage_stats(), sys.stderr)
+
+    if result is None:
+        print("Nothing imported as the current state is unchanged",
+              file=sys.stderr)
+        sys.exit(EXIT_STATUS_UNCHANGED)
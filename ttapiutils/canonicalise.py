@@ -2,38 +2,287 @@
 Canonicalise a Timetable API v0 XML document.
 stdin/stdout are used for input/output.
 
-usage: ttapiutils canonicalise [--help]
+usage: ttapiutils canonicalise [options]
+       ttapiutils canonicalise --stream [--buffer-size=<bytes>]
 
 The output will be semantically equivalent to the input, but the
 XML representation will be canonical, allowing two canonicalised
 Timetable API XML documents to be compared byte-for-byte for
 equivalence.
+
+options:
+    --engine=<engine>
+        The implementation to canonicalise with, either native or xslt.
+        Both produce identical output [default: native].
+
+    --stream
+        Read and canonicalise one module at a time, using temporary files
+        to sort modules if they don't fit in --buffer-size. The output is
+        identical to the default in-memory mode, but documents larger
+        than the available memory can be canonicalised. The native
+        engine is always used.
+
+    --buffer-size=<bytes>
+        The amount of serialised module data to hold in memory in --stream
+        mode before sorting it and writing it to a temporary file
+        [default: 67108864].
+
+    -h, --help
+        Show this help message
 """
+from copy import deepcopy
+import heapq
+import pickle
 import sys
+import tempfile
 
 import docopt
 import pkg_resources
 from lxml import etree
 
-from ttapiutils.utils import parse_xml, assert_valid, write_c14n_pretty
+from ttapiutils.utils import (
+	assert_valid, iter_modules, mark_valid, memoize, parse_xml,
+	write_c14n_pretty)
 
+@memoize
 def get_canonicalise_transform():
 	canonicalise_xsl = pkg_resources.resource_stream(
 		"ttapiutils.canonicalise", "data/canonicalise.xsl")
 	return etree.XSLT(etree.parse(canonicalise_xsl))
 
 
-CANONICALISE_TRANSFORM = get_canonicalise_transform()
+def _string_value(element):
+	"""
+	Get the XPath string-value of element, or "" if element is None.
+	"""
+	if element is None:
+		return ""
+	if len(element) == 0:
+		return element.text or ""
+	return "".join(element.itertext())
+
+
+def _first_child_values(element, tags):
+	"""
+	Get a dict of tag to the string-value of the first child element of
+	element with each of tags.
+	"""
+	values = {}
+	for child in element.iterchildren(*tags):
+		if child.tag not in values:
+			values[child.tag] = _string_value(child)
+	return values
+
+
+def event_sort_key(event):
+	values = {}
+	for child in event:
+		tag = child.tag
+		# (end|duration)[1] is whichever of end or duration comes first in
+		# document order.
+		if tag == "end" or tag == "duration":
+			tag = "end|duration"
+		if tag not in values:
+			values[tag] = _string_value(child)
+
+	return (values.get("date", ""),
+	        values.get("start", ""),
+	        values.get("end|duration", ""),
+	        values.get("name", ""),
+	        values.get("type", ""),
+	        values.get("location", ""),
+	        values.get("lecturer", ""),
+	        values.get("uniqueid", ""))
+
+
+def series_sort_key(series):
+	values = _first_child_values(series, ("name", "uniqueid"))
+	return (values.get("name", ""), values.get("uniqueid", ""))
+
+
+def module_sort_key(module):
+	path = module.find("path")
+	values = {} if path is None else _first_child_values(
+		path, ("tripos", "part", "subject"))
+	return (values.get("tripos", ""),
+	        values.get("part", ""),
+	        values.get("subject", ""),
+	        _string_value(module.find("name")))
+
+
+def _reset(element):
+	"""
+	Remove the attributes and text of element, as xsl:copy does.
+	"""
+	element.attrib.clear()
+	element.text = None
+
+
+def _sort_children(element, sorted_tag, key):
+	"""
+	Reorder the children of element to be its non-sorted_tag child
+	elements in document order, followed by its sorted_tag children
+	ordered by key. Non-element children and tails are removed.
+	"""
+	others = []
+	sortable = []
+	for child in element.iterchildren(tag=etree.Element):
+		child.tail = None
+		(sortable if child.tag == sorted_tag else others).append(child)
+
+	# sorted() is stable, so equal keys retain document order like xsl:sort
+	element[:] = others + sorted(sortable, key=key)
+
+
+def canonicalise_series(series):
+	"""
+	Canonicalise a series element in place.
+	"""
+	_reset(series)
+	_sort_children(series, "event", event_sort_key)
+
+
+def canonicalise_module(module):
+	"""
+	Canonicalise a module element (and its series) in place.
+	"""
+	_reset(module)
+	_sort_children(module, "series", series_sort_key)
+	for series in module.iterchildren("series"):
+		canonicalise_series(series)
+
+
+def canonicalise_native(api_xml, in_place=False):
+	"""
+	Canonicalise api_xml with the same result as canonicalise.xsl, by
+	sorting elements with precomputed keys.
+
+	api_xml is modified if in_place is True, otherwise it's copied first.
+	"""
+	tree = api_xml if isinstance(api_xml, etree._ElementTree) else (
+		api_xml.getroottree())
+	if not in_place:
+		tree = deepcopy(tree)
 
+	module_list = tree.getroot()
+	if module_list.tag != "moduleList":
+		return tree
 
-def canonicalise(api_xml):
-	assert_valid(api_xml)
-	return CANONICALISE_TRANSFORM(api_xml)
+	_reset(module_list)
+	modules = list(module_list.iterchildren("module"))
+	for module in modules:
+		module.tail = None
+		canonicalise_module(module)
+	module_list[:] = sorted(modules, key=module_sort_key)
+	return tree
+
+
+def canonicalise_xslt(api_xml):
+	return get_canonicalise_transform()(api_xml)
+
+
+ENGINES = {
+	"native": canonicalise_native,
+	"xslt": canonicalise_xslt
+}
+
+
+def canonicalise(api_xml, engine="native"):
+	if engine not in ENGINES:
+		raise ValueError("Unknown canonicalise engine: {!r}".format(engine))
+
+	assert_valid(api_xml, stage="canonicalise")
+	canonical_xml = ENGINES[engine](api_xml)
+	# Canonicalising doesn't affect validity
+	mark_valid(canonical_xml)
+	return canonical_xml
+
+
+DEFAULT_BUFFER_SIZE = 64 * 1024 * 1024
+
+_MODULE_LIST_START = b"<moduleList>"
+_MODULE_LIST_END = b"\n</moduleList>"
+
+
+def _serialise_module(module):
+	"""
+	Serialise module as write_c14n_pretty() would serialise it as a child
+	of a moduleList, including the preceding indentation.
+	"""
+	wrapper = etree.Element("moduleList")
+	wrapper.append(module)
+	serialised = write_c14n_pretty(wrapper)
+	assert serialised.startswith(_MODULE_LIST_START)
+	assert serialised.endswith(_MODULE_LIST_END)
+	return serialised[len(_MODULE_LIST_START):-len(_MODULE_LIST_END)]
+
+
+def _write_run(records):
+	"""
+	Sort records and write them to a temporary file, returning the file.
+	"""
+	run = tempfile.TemporaryFile()
+	for record in sorted(records):
+		pickle.dump(record, run, pickle.HIGHEST_PROTOCOL)
+	run.seek(0)
+	return run
+
+
+def _read_run(run):
+	while True:
+		try:
+			yield pickle.load(run)
+		except EOFError:
+			return
+
+
+def canonicalise_streaming(file, out, buffer_size=DEFAULT_BUFFER_SIZE):
+	"""
+	Canonicalise the API XML in file, writing the result to out in the
+	same format as write_c14n_pretty().
+
+	Modules are read and canonicalised one at a time. Serialised modules
+	are held in memory until buffer_size bytes of them have accumulated,
+	at which point they're sorted and written to a temporary file. The
+	sorted runs are merged to produce the output.
+	"""
+	runs = []
+	records = []
+	buffered_size = 0
+
+	try:
+		for (sequence, module) in enumerate(iter_modules(file)):
+			canonicalise_module(module)
+			serialised = _serialise_module(module)
+			# The sequence number keeps the sort stable, as the XSLT's is
+			records.append((module_sort_key(module), sequence, serialised))
+			buffered_size += len(serialised)
+
+			if buffered_size >= buffer_size:
+				runs.append(_write_run(records))
+				records = []
+				buffered_size = 0
+
+		sorted_records = heapq.merge(
+			sorted(records), *[_read_run(run) for run in runs])
+
+		out.write(_MODULE_LIST_START)
+		for (_, _, serialised) in sorted_records:
+			out.write(serialised)
+		out.write(_MODULE_LIST_END)
+	finally:
+		for run in runs:
+			run.close()
 
 
 def main(args):
-	docopt.docopt(__doc__, argv=args)
+	args = docopt.docopt(__doc__, argv=args)
+
+	if args["--stream"]:
+		canonicalise_streaming(sys.stdin, sys.stdout,
+		                       buffer_size=int(args["--buffer-size"]))
+		return
 
 	api_xml = parse_xml(sys.stdin)
-	canonic_xml = canonicalise(api_xml)
+	canonic_xml = canonicalise(api_xml, engine=args["--engine"])
 	write_c14n_pretty(canonic_xml, sys.stdout)
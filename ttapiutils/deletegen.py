@@ -23,6 +23,21 @@ It pains me that this program needs to exist. The need for it should be
 removed at the earliest opportunity.
 
 options:
+    --elide-unchanged
+        Leave out events and series which are identical in both states,
+        so that the output only contains additions, modifications and
+        deletions. If nothing has changed the output is an empty
+        <moduleList>, which is not valid to import.
+
+    --jobs=<n>
+        The number of processes to merge modules with [default: 1].
+        Not used with --stream.
+
+    --stream
+        Read the states and write the output incrementally, holding only
+        one module from each state in memory at a time. Both states must
+        have been canonicalised with ttapiutils canonicalise.
+
     -h --help
         Show this help text
 """
@@ -31,20 +46,32 @@ from __future__ import unicode_literals
 from collections import Counter
 from copy import deepcopy
 from os import path
-import itertools
+import multiprocessing
 import sys
 
 import docopt
 from lxml import etree
 
+from ttapiutils.fingerprint import indexed_fingerprint
+from ttapiutils.index import (
+    DuplicateKeyException,
+    event_key,
+    index_module,
+    index_module_list,
+    module_key,
+    report_duplicates,
+    series_key
+)
 from ttapiutils.utils import (
     assert_valid,
+    forget_validation,
+    iter_modules,
     parse_xml,
     TimetableApiUtilsException
 )
 
 
-class DuplicateKeyException(TimetableApiUtilsException):
+class UnsortedModulesException(TimetableApiUtilsException):
     pass
 
 
@@ -54,129 +81,200 @@ def wrap(name, elements):
     return parent
 
 
-def module_key(module):
-    return (module.xpath("string(path/tripos)"),
-            module.xpath("string(path/part)"),
-            module.xpath("string(path/subject)"),
-            module.xpath("string(name)"))
-
-
-def series_key(series):
-    module = series.xpath("..")[0]
-    return module_key(module) + (series.xpath("string(uniqueid)"),)
+def _take(element, consume):
+    """
+    Get element for use in a merged tree. If consume is True element
+    itself is returned (and so will be moved out of its tree when added to
+    the merged tree), otherwise a copy is returned.
+    """
+    return element if consume else deepcopy(element)
 
 
-def event_key(event):
-    series = event.xpath("..")[0]
-    return series_key(series) + (event.xpath("string(uniqueid)"),)
+def _serialise_module(indexed_module):
+    if indexed_module is None:
+        return None
+    return etree.tostring(indexed_module.element, encoding="utf-8",
+                          with_tail=False)
 
 
-def index(items, key):
-    indexed = dict((key(i), i) for i in items)
-    if len(indexed) < len(items):
-        raise report_duplicates(items, key)
-    return indexed
+def _parse_module(serialised_module):
+    if serialised_module is None:
+        return None
+    return index_module(etree.fromstring(serialised_module))
 
 
-def report_duplicates(items, key):
-    key_counts = Counter(key(i) for i in items)
-    duplicates = (
-        (key, count) for (key, count) in
-        itertools.takewhile(lambda (_, n): n > 0, key_counts.most_common())
-    )
-    dupes_description = ", ".join("{!r}: {:d}x".format(key, count)
-                                  for (key, count) in duplicates)
-    return DuplicateKeyException(
-        "Duplicate items encountered: {}".format(dupes_description))
+def _merge_serialised_modules(args):
+    """
+    Merge a pair of serialised modules in a worker process, returning the
+    serialised result.
+    """
+    (current, future, elide_unchanged) = args
+    merged = merge_modules(_parse_module(current), _parse_module(future),
+                           elide_unchanged=elide_unchanged, consume=True)
+    if merged is None:
+        return None
+    return etree.tostring(merged, encoding="utf-8")
 
 
-def merge_module_lists(current, future):
+def _merge_modules_in_pool(merge_pairs, jobs, elide_unchanged):
+    """
+    Merge each pair of modules in a pool of jobs processes, yielding the
+    merged modules in the order of merge_pairs.
+    """
+    work = ((_serialise_module(a), _serialise_module(b), elide_unchanged)
+            for (_, a, b) in merge_pairs)
+    chunksize = max(1, len(merge_pairs) // (jobs * 4))
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for merged in pool.imap(_merge_serialised_modules, work, chunksize):
+            yield None if merged is None else etree.fromstring(merged)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def merge_module_lists(current, future, elide_unchanged=False,
+                       consume=False, jobs=None):
     root = etree.Element("moduleList")
 
     merge_pairs = dictzip_longest(
-        index(current.xpath("module"), module_key),
-        index(future.xpath("module"), module_key))
+        index_module_list(current).children,
+        index_module_list(future).children)
 
-    merged_modules = (merge_modules(a, b) for (_, a, b) in merge_pairs)
+    if jobs is not None and jobs > 1:
+        merged_modules = _merge_modules_in_pool(merge_pairs, jobs,
+                                                elide_unchanged)
+    else:
+        merged_modules = (merge_modules(a, b,
+                                        elide_unchanged=elide_unchanged,
+                                        consume=consume)
+                          for (_, a, b) in merge_pairs)
 
-    root.extend(merged_modules)
+    root.extend(m for m in merged_modules if m is not None)
     return root
 
 
-def merge_modules(current, future):
+def merge_modules(current, future, elide_unchanged=False, consume=False):
+    """
+    Merge two KeyedIndexes of a module, either of which may be None.
+
+    If elide_unchanged is True, None is returned when the module is the
+    same in current and future. If consume is True, elements of future are
+    moved into the result rather than copied.
+    """
     # If the module doesn't exist in future it needs to be
     # marked for deletion
     if future is None:
         assert current is not None
         module = etree.Element("module")
-        module.append(deepcopy(current.xpath("path")[0]))
-        module.append(deepcopy(current.xpath("name")[0]))
+        module.append(deepcopy(current.element.find("path")))
+        module.append(deepcopy(current.element.find("name")))
         etree.SubElement(module, "delete")
         return module
     # If there's no current then just use the future state
     elif current is None:
         assert future is not None
-        return deepcopy(future)
+        return _take(future.element, consume)
 
     # otherwise we need to use the future module with recursively merged series
     else:
-        merge_pairs = dictzip_longest(
-            index(current.xpath("series"), series_key),
-            index(future.xpath("series"), series_key))
+        merge_pairs = dictzip_longest(current.children, future.children)
+
+        merged_series = [
+            s for s in (merge_series(a, b, elide_unchanged=elide_unchanged,
+                                     consume=consume)
+                        for (_, a, b) in merge_pairs)
+            if s is not None]
 
-        merged_series = (merge_series(a, b) for (_, a, b) in merge_pairs)
+        # A module's path and name are part of its key, so if none of its
+        # series differ there's nothing to change.
+        if not merged_series:
+            assert elide_unchanged
+            return None
 
         module = etree.Element("module")
-        module.append(deepcopy(future.xpath("path")[0]))
-        module.append(deepcopy(future.xpath("name")[0]))
+        module.append(_take(future.element.find("path"), consume))
+        module.append(_take(future.element.find("name"), consume))
         module.extend(merged_series)
         return module
 
 
-def merge_series(current, future):
+def merge_series(current, future, elide_unchanged=False, consume=False):
     if future is None:
         assert current is not None
         series = etree.Element("series")
-        series.append(deepcopy(current.xpath("uniqueid")[0]))
-        series.append(deepcopy(current.xpath("name")[0]))
+        series.append(deepcopy(current.element.find("uniqueid")))
+        series.append(deepcopy(current.element.find("name")))
         etree.SubElement(series, "delete")
         return series
     elif current is None:
-        return deepcopy(future)
+        return _take(future.element, consume)
     else:
-        merge_pairs = dictzip_longest(
-            index(current.xpath("event"), event_key),
-            index(future.xpath("event"), event_key))
+        if elide_unchanged and (indexed_fingerprint(current) ==
+                                indexed_fingerprint(future)):
+            return None
 
-        merged_events = (merge_events(a, b) for (_, a, b) in merge_pairs)
+        merge_pairs = dictzip_longest(current.children, future.children)
+
+        merged_events = [
+            e for e in (merge_events(a, b, elide_unchanged=elide_unchanged,
+                                     consume=consume)
+                        for (_, a, b) in merge_pairs)
+            if e is not None]
+
+        # Only the series' own fields changed, but a series must contain
+        # at least one event, so include them all.
+        if not merged_events:
+            assert elide_unchanged
+            return _take(future.element, consume)
 
         series = etree.Element("series")
-        series.append(deepcopy(future.xpath("uniqueid")[0]))
-        series.append(deepcopy(future.xpath("name")[0]))
+        series.append(_take(future.element.find("uniqueid"), consume))
+        series.append(_take(future.element.find("name"), consume))
         series.extend(merged_events)
         return series
 
 
-def merge_events(current, future):
+def merge_events(current, future, elide_unchanged=False, consume=False):
     if future is None:
         event = etree.Element("event")
-        event.append(deepcopy(current.xpath("uniqueid")[0]))
+        event.append(deepcopy(current.element.find("uniqueid")))
         etree.SubElement(event, "delete")
         return event
+    elif (elide_unchanged and current is not None and
+            indexed_fingerprint(current) == indexed_fingerprint(future)):
+        return None
     else:
         # No more merging to be done as events are tree leafs
-        return deepcopy(future)
+        return _take(future.element, consume)
 
 
-def generate_deletes(current, future):
+def generate_deletes(current, future, elide_unchanged=False, consume=False,
+                     jobs=None):
     """
     Given a current representation and future (desired) representation,
     work out which parts of current are not needed in future, and mark
     them for deletion in future.
+
+    If elide_unchanged is True, series and events whose content is the
+    same in current and future are omitted from the result, as are modules
+    containing no changes. The result then only describes what has changed.
+    If nothing has changed the result is an empty (and therefore invalid)
+    moduleList.
+
+    If consume is True, elements of future are moved into the result rather
+    than being copied, which avoids allocating a second copy of the future
+    state. future is left in an undefined (and invalid) state, so this
+    should only be used when future is not needed afterwards.
+
+    If jobs is greater than 1, modules are merged in parallel by a pool of
+    jobs worker processes. The result is the same as merging serially.
     """
 
-    assert_valid(current)
-    assert_valid(future)
+    assert_valid(current, stage="deletegen.current")
+    assert_valid(future, stage="deletegen.future")
 
     # Situation: We have 2 trees, the current state (A) and the target
     # state (B). We want to generate a third state (C) with the necessary
@@ -191,18 +289,105 @@ def generate_deletes(current, future):
     # Merge the deletions from the current state into the future state.
     # This merged result would result in the future state when applied to
     # the current state via the Timetable v0 API...
-    merged = merge_module_lists(current, future)
-    assert_valid(merged)
+    merged = merge_module_lists(current, future,
+                                elide_unchanged=elide_unchanged,
+                                consume=consume, jobs=jobs)
+    if consume:
+        forget_validation(future)
+
+    if not (elide_unchanged and len(merged) == 0):
+        assert_valid(merged, stage="deletegen.result")
     return merged
 
 
+def _index_in_key_order(modules):
+    previous_key = None
+    for module in modules:
+        indexed = index_module(module)
+        if previous_key is not None:
+            if indexed.key == previous_key:
+                raise report_duplicates(Counter({indexed.key: 1}))
+            if indexed.key < previous_key:
+                raise UnsortedModulesException(
+                    "Modules are not in canonical order: {!r} follows {!r}"
+                    .format(indexed.key, previous_key))
+        previous_key = indexed.key
+        yield indexed
+
+
+def merge_join(current_modules, future_modules):
+    """
+    Pair up the modules of two iterables of modules sorted by key (as
+    ttapiutils canonicalise sorts them).
+
+    Yields (key, current, future) tuples of KeyedIndexes in key order,
+    where current or future is None if the module only occurs in one of
+    the iterables.
+    """
+    current_modules = _index_in_key_order(current_modules)
+    future_modules = _index_in_key_order(future_modules)
+
+    current = next(current_modules, None)
+    future = next(future_modules, None)
+    while current is not None or future is not None:
+        if future is None or (current is not None and
+                              current.key < future.key):
+            yield (current.key, current, None)
+            current = next(current_modules, None)
+        elif current is None or future.key < current.key:
+            yield (future.key, None, future)
+            future = next(future_modules, None)
+        else:
+            yield (current.key, current, future)
+            current = next(current_modules, None)
+            future = next(future_modules, None)
+
+
+def generate_deletes_streaming(current_file, future_file, out,
+                               elide_unchanged=False):
+    """
+    As generate_deletes(), but reading the current and future states from
+    files and writing the result to out, one module at a time.
+
+    Peak memory use is bounded by the size of the largest module rather
+    than the whole document. The states must both be canonicalised, as
+    modules are matched up by merging the sorted sequences of modules.
+    """
+    merge_pairs = merge_join(iter_modules(current_file),
+                             iter_modules(future_file))
+
+    with etree.xmlfile(out, encoding="utf-8") as xf:
+        with xf.element("moduleList"):
+            xf.write("\n")
+            for (_, current, future) in merge_pairs:
+                # Each future module is discarded after merging, so it can
+                # be consumed.
+                merged = merge_modules(current, future,
+                                       elide_unchanged=elide_unchanged,
+                                       consume=True)
+                if merged is None:
+                    continue
+                assert_valid(wrap("moduleList", [merged]),
+                             stage="deletegen.result")
+                xf.write(merged, pretty_print=True)
+
+
 def main(argv):
     args = docopt.docopt(__doc__, argv=argv)
 
+    if args["--stream"]:
+        generate_deletes_streaming(
+            args["<current_state>"], args["<future_state>"], sys.stdout,
+            elide_unchanged=args["--elide-unchanged"])
+        return
+
     current_state = parse_xml(args["<current_state>"])
     future_state = parse_xml(args["<future_state>"])
 
-    with_deletes = generate_deletes(current_state, future_state)
+    with_deletes = generate_deletes(
+        current_state, future_state,
+        elide_unchanged=args["--elide-unchanged"], consume=True,
+        jobs=int(args["--jobs"]))
 
     with_deletes.getroottree().write(sys.stdout, pretty_print=True)
 
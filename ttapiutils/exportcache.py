@@ -0,0 +1,176 @@
+"""
+An on-disk cache of Timetable API XML exports.
+
+Export response bodies are stored along with their ETag and Last-Modified
+validators, allowing later exports of the same URL to be made with
+conditional requests. A max_age can be set to use cached exports without
+any request for a period after they were fetched, which is useful if the
+server doesn't send validators.
+"""
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+
+class CacheEntry(object):
+    """
+    A cached export of url, whose body is stored in the file body_path.
+    """
+    def __init__(self, url, body_path, etag=None, last_modified=None,
+                 fetched=None):
+        self.url = url
+        self.body_path = body_path
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+
+    def to_json(self):
+        return {
+            "url": self.url,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "fetched": self.fetched
+        }
+
+    def open_body(self):
+        return open(self.body_path, "rb")
+
+
+class ExportCache(object):
+    def __init__(self, directory, max_age=None):
+        self.directory = directory
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _get_path(self, url, extension):
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, "{}.{}".format(name, extension))
+
+    def lookup(self, url):
+        """
+        Get the CacheEntry of url, or None if it's not cached.
+        """
+        try:
+            with open(self._get_path(url, "json")) as f:
+                metadata = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        body_path = self._get_path(url, "xml")
+        if metadata.get("url") != url or not os.path.exists(body_path):
+            return None
+        return CacheEntry(url, body_path, etag=metadata.get("etag"),
+                          last_modified=metadata.get("last_modified"),
+                          fetched=metadata.get("fetched"))
+
+    def is_fresh(self, entry, now=None):
+        """
+        Check if entry can be used without revalidating it, i.e. it was
+        fetched less than max_age seconds ago.
+        """
+        if self.max_age is None or entry.fetched is None:
+            return False
+        now = time.time() if now is None else now
+        return now - entry.fetched < self.max_age
+
+    def get_conditional_headers(self, entry):
+        """
+        Get the headers of a request which the server can respond to with
+        304 Not Modified if entry is still current.
+        """
+        headers = {}
+        if entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def _write_metadata(self, entry):
+        self._replace(self._get_path(entry.url, "json"),
+                      json.dumps(entry.to_json()).encode("utf-8"))
+
+    def _replace(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def refresh(self, entry, headers=None):
+        """
+        Record that entry has been found to be current, using any updated
+        validators in the 304 response headers.
+        """
+        headers = {} if headers is None else headers
+        entry.etag = headers.get("ETag", entry.etag)
+        entry.last_modified = headers.get("Last-Modified",
+                                          entry.last_modified)
+        entry.fetched = time.time()
+        self._write_metadata(entry)
+
+    def writer(self, url, headers):
+        """
+        Get a context manager which stores the chunks of a response body
+        passed through its tee() method as the body of url. The body is
+        only stored if the with block completes without an exception.
+        """
+        return _CacheWriter(self, url, headers)
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def get_stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class _CacheWriter(object):
+    def __init__(self, cache, url, headers):
+        self.cache = cache
+        self.url = url
+        self.headers = headers
+        self._file = None
+        self._tmp_path = None
+
+    def __enter__(self):
+        fd, self._tmp_path = tempfile.mkstemp(dir=self.cache.directory)
+        self._file = os.fdopen(fd, "wb")
+        return self
+
+    def tee(self, chunks):
+        for chunk in chunks:
+            self._file.write(chunk)
+            yield chunk
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is not None:
+            os.remove(self._tmp_path)
+            return
+
+        entry = CacheEntry(
+            self.url, self.cache._get_path(self.url, "xml"),
+            etag=self.headers.get("ETag"),
+            last_modified=self.headers.get("Last-Modified"),
+            fetched=time.time())
+        # Remove the old metadata first so that the new body is never
+        # paired with the old validators.
+        metadata_path = self.cache._get_path(self.url, "json")
+        if os.path.exists(metadata_path):
+            os.remove(metadata_path)
+        os.rename(self._tmp_path, entry.body_path)
+        self.cache._write_metadata(entry)
@@ -0,0 +1,242 @@
+"""
+Print the fingerprint of a Timetable API XML document, or compare the
+fingerprints of two documents to find the parts which differ.
+
+usage: ttapiutils fingerprint [options] [<xmlfile>]
+       ttapiutils fingerprint --diff <xmlfile-a> <xmlfile-b>
+
+The document is read from stdin if <xmlfile> is not provided.
+
+Two documents have the same fingerprint if they canonicalise to the same
+XML (see ttapiutils canonicalise), so comparing fingerprints is a
+cheaper way to check if documents are equivalent.
+
+options:
+    --level=<level>
+        Print the fingerprint and key of every element at <level>,
+        which is one of moduleList, module, series or event
+        [default: moduleList].
+
+    --diff
+        Print the keys of the modules, series and events which differ
+        between the two documents, each preceded by "added", "removed"
+        or "changed". The exit status is 1 if any differ.
+
+    -h, --help
+        Show this help message
+"""
+from __future__ import print_function, unicode_literals
+
+import binascii
+import hashlib
+import json
+import sys
+
+import docopt
+from lxml import etree
+
+from ttapiutils.index import index_module_list
+from ttapiutils.utils import parse_xml
+
+
+# A fingerprint is a digest of the content of an element which does not
+# depend on insignificant details of its XML representation, such as
+# whitespace between elements or the order of modules, series and events.
+# As with canonicalise, the order of other elements is significant.
+
+def _serialise_children(element, parts, exclude=()):
+    """
+    Append the tag, text and children of each child element of element to
+    parts, in document order.
+    """
+    for child in element.iterchildren(tag=etree.Element):
+        tag = child.tag
+        if tag in exclude:
+            continue
+        parts.append("<" + tag)
+        parts.append(child.text or "")
+        if len(child):
+            _serialise_children(child, parts)
+        parts.append(">")
+
+
+def _fingerprint(tag, element, child_tag=None, child_fingerprints=()):
+    parts = [tag]
+    _serialise_children(element, parts, exclude=(child_tag,))
+    # NUL can't occur in XML text so it makes a safe separator
+    digest = hashlib.sha1("\0".join(parts).encode("utf-8"))
+    # Sorting makes the fingerprint independent of child order
+    for fingerprint in sorted(child_fingerprints):
+        digest.update(fingerprint)
+    return digest.digest()
+
+
+def event_fingerprint(event):
+    """
+    Get the fingerprint of an event element.
+    """
+    return _fingerprint("event", event)
+
+
+def series_fingerprint(series, event_fingerprints=None):
+    """
+    Get the fingerprint of a series element.
+
+    event_fingerprints may be provided if the fingerprints of the series'
+    events have already been calculated.
+    """
+    if event_fingerprints is None:
+        event_fingerprints = [event_fingerprint(e)
+                              for e in series.iterchildren("event")]
+    return _fingerprint("series", series, "event", event_fingerprints)
+
+
+def module_fingerprint(module, series_fingerprints=None):
+    """
+    Get the fingerprint of a module element.
+
+    series_fingerprints may be provided if the fingerprints of the module's
+    series have already been calculated.
+    """
+    if series_fingerprints is None:
+        series_fingerprints = [series_fingerprint(s)
+                               for s in module.iterchildren("series")]
+    return _fingerprint("module", module, "series", series_fingerprints)
+
+
+def module_list_fingerprint(module_list, module_fingerprints=None):
+    """
+    Get the fingerprint of a moduleList element.
+    """
+    if module_fingerprints is None:
+        module_fingerprints = [module_fingerprint(m)
+                               for m in module_list.iterchildren("module")]
+    return _fingerprint("moduleList", module_list, "module",
+                        module_fingerprints)
+
+
+def fingerprint(api_xml):
+    """
+    Get the fingerprint of a Timetable API XML document.
+    """
+    if isinstance(api_xml, etree._ElementTree):
+        api_xml = api_xml.getroot()
+    return module_list_fingerprint(api_xml)
+
+
+# Fingerprint functions of elements with keyed children
+_FINGERPRINT_FUNCTIONS = {
+    "moduleList": module_list_fingerprint,
+    "module": module_fingerprint,
+    "series": series_fingerprint
+}
+
+
+def indexed_fingerprint(indexed):
+    """
+    Get the fingerprint of the element of a KeyedIndex, reusing and
+    caching fingerprints in the index.
+    """
+    if indexed.fingerprint is None:
+        tag = indexed.element.tag
+        if tag == "event":
+            indexed.fingerprint = event_fingerprint(indexed.element)
+        else:
+            fingerprint_func = _FINGERPRINT_FUNCTIONS[tag]
+            indexed.fingerprint = fingerprint_func(
+                indexed.element,
+                [indexed_fingerprint(c) for c in indexed.children.values()])
+    return indexed.fingerprint
+
+
+def _own_fingerprint(indexed):
+    """
+    Get a fingerprint of just the fields of an indexed element, excluding
+    its keyed children.
+    """
+    tag = indexed.element.tag
+    if tag == "event":
+        return indexed_fingerprint(indexed)
+    return _FINGERPRINT_FUNCTIONS[tag](indexed.element, [])
+
+
+def fingerprint_index(api_xml):
+    """
+    Index api_xml (see ttapiutils.index) and calculate the fingerprint of
+    every element in the index.
+    """
+    indexed = index_module_list(api_xml)
+    indexed_fingerprint(indexed)
+    return indexed
+
+
+def diff_indexes(a, b):
+    """
+    Compare two fingerprinted KeyedIndexes (see fingerprint_index()),
+    yielding (change, key) pairs for the most specific keyed elements
+    which differ, where change is "added", "removed" or "changed".
+
+    Only the parts of the indexes with differing fingerprints are visited.
+    """
+    if indexed_fingerprint(a) == indexed_fingerprint(b):
+        return
+    if _own_fingerprint(a) != _own_fingerprint(b):
+        yield ("changed", a.key)
+
+    a_children, b_children = a.children, b.children
+    for key in sorted(set(a_children) | set(b_children)):
+        if key not in b_children:
+            yield ("removed", key)
+        elif key not in a_children:
+            yield ("added", key)
+        else:
+            for change in diff_indexes(a_children[key], b_children[key]):
+                yield change
+
+
+def diff(a, b):
+    """
+    Get a list of (change, key) pairs describing the differences between
+    two Timetable API XML documents. See diff_indexes().
+    """
+    return list(diff_indexes(fingerprint_index(a), fingerprint_index(b)))
+
+
+def hex_fingerprint(fingerprint):
+    return binascii.hexlify(fingerprint).decode("ascii")
+
+
+LEVELS = ("moduleList", "module", "series", "event")
+
+
+def _iter_level(indexed, level):
+    if indexed.element.tag == level:
+        yield indexed
+    elif indexed.element.tag != "event":
+        for key in sorted(indexed.children):
+            for child in _iter_level(indexed.children[key], level):
+                yield child
+
+
+def main(argv):
+    args = docopt.docopt(__doc__, argv=argv)
+
+    if args["--diff"]:
+        changes = diff(parse_xml(args["<xmlfile-a>"]),
+                       parse_xml(args["<xmlfile-b>"]))
+        for (change, key) in changes:
+            print("{} {}".format(change, json.dumps(key)))
+        sys.exit(1 if changes else 0)
+
+    level = args["--level"]
+    if level not in LEVELS:
+        sys.exit("--level must be one of: {}".format(", ".join(LEVELS)))
+
+    api_xml = parse_xml(args["<xmlfile>"] or sys.stdin)
+    if level == "moduleList":
+        print(hex_fingerprint(fingerprint(api_xml)))
+        return
+
+    for indexed in _iter_level(fingerprint_index(api_xml), level):
+        print("{} {}".format(hex_fingerprint(indexed.fingerprint),
+                             json.dumps(indexed.key)))
@@ -2,37 +2,112 @@
 Postprocess the output of /api/v0/xmlexport/<path> to allow it to
 be round-tripped. stdin/stdout are used for input/output.
 
-usage: ttapiutils fixexport [--help]
+usage: ttapiutils fixexport [options]
 
 The API adds the prefix "import-" to the the uniqueid of events, so
 the event IDs imported are not the same as those exported. This fixes
 the event IDs so that the export IDs match the import IDs.
+
+options:
+    --engine=<engine>
+        The implementation to fix IDs with, either native or xslt. Both
+        produce identical output [default: native].
+
+    -h, --help
+        Show this help message
 """
+from copy import deepcopy
 import sys
 
 import docopt
 import pkg_resources
 from lxml import etree
 
-from ttapiutils.utils import parse_xml, assert_valid, write_c14n_pretty
+from ttapiutils.utils import (
+	parse_xml, assert_valid, mark_valid, memoize, write_c14n_pretty)
 
 
+@memoize
 def _get_id_fix_transform():
 	id_fix_xsl = pkg_resources.resource_stream(
 		"ttapiutils.fixexport", "data/fix_export_ids.xsl")
 	return etree.XSLT(etree.parse(id_fix_xsl))
 
-_FIX_IDS_TRANSFORM = _get_id_fix_transform()
 
+IMPORT_ID_PREFIX = "import-"
+
+_EVENT_UNIQUEIDS = etree.XPath("/moduleList/module/series/event/uniqueid")
+
+
+def _strip_import_prefix(uniqueid):
+	text = uniqueid.text
+	if text is not None and text.startswith(IMPORT_ID_PREFIX):
+		uniqueid.text = text[len(IMPORT_ID_PREFIX):]
+
+
+def fix_event_uniqueid(uniqueid):
+	"""
+	Strip the import- prefix from a uniqueid element in place if it's the
+	uniqueid of an event, as fix_export_ids.xsl does.
+	"""
+	event = uniqueid.getparent()
+	if event is None or event.tag != "event":
+		return
+	ancestors = [a.tag for a in event.iterancestors()]
+	if ancestors != ["series", "module", "moduleList"]:
+		return
+	_strip_import_prefix(uniqueid)
+
+
+def fix_export_ids_native(api_xml, in_place=False):
+	"""
+	Fix event IDs with the same result as fix_export_ids.xsl, by modifying
+	only the uniqueid elements of events.
+
+	api_xml is modified if in_place is True, otherwise it's copied first.
+	"""
+	tree = api_xml if isinstance(api_xml, etree._ElementTree) else (
+		api_xml.getroottree())
+	if not in_place:
+		tree = deepcopy(tree)
+
+	for uniqueid in _EVENT_UNIQUEIDS(tree):
+		_strip_import_prefix(uniqueid)
+	return tree
+
+
+def fix_export_ids_xslt(api_xml):
+	return _get_id_fix_transform()(api_xml)
+
+
+ENGINES = {
+	"native": fix_export_ids_native,
+	"xslt": fix_export_ids_xslt
+}
+
+
+def fix_export_ids(api_xml, engine="native", in_place=False):
+	"""
+	Fix the event IDs of api_xml. If in_place is True the native engine
+	modifies api_xml rather than a copy of it.
+	"""
+	if engine not in ENGINES:
+		raise ValueError("Unknown fixexport engine: {!r}".format(engine))
 
-def fix_export_ids(api_xml):
-	assert_valid(api_xml)
-	return _FIX_IDS_TRANSFORM(api_xml)
+	assert_valid(api_xml, stage="fixexport")
+	if engine == "native":
+		fixed_xml = fix_export_ids_native(api_xml, in_place=in_place)
+	else:
+		fixed_xml = fix_export_ids_xslt(api_xml)
+	# Changing uniqueid values doesn't affect validity
+	mark_valid(fixed_xml)
+	return fixed_xml
 
 
 def main(args):
-	docopt.docopt(__doc__, argv=args)
+	args = docopt.docopt(__doc__, argv=args)
 
 	api_xml = parse_xml(sys.stdin)
-	fixed_xml = fix_export_ids(api_xml)
+	fixed_xml = fix_export_ids(api_xml, engine=args["--engine"],
+	                           in_place=True)
 	write_c14n_pretty(fixed_xml, sys.stdout)
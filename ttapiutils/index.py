@@ -0,0 +1,123 @@
+"""
+Keyed indexes of Timetable API XML documents.
+
+Modules, series and events are identified by keys built from their own
+identifying fields prefixed with the key of their parent. i.e. a module is
+identified by its path and name, a series by its module's key and its
+uniqueid, and an event by its series' key and its uniqueid.
+"""
+from __future__ import unicode_literals
+
+from collections import Counter
+
+from lxml import etree
+
+from ttapiutils.utils import TimetableApiUtilsException
+
+
+class DuplicateKeyException(TimetableApiUtilsException):
+    pass
+
+
+def module_key(module):
+    return (module.findtext("path/tripos", ""),
+            module.findtext("path/part", ""),
+            module.findtext("path/subject", ""),
+            module.findtext("name", ""))
+
+
+def series_key(series):
+    return module_key(series.getparent()) + (series.findtext("uniqueid", ""),)
+
+
+def event_key(event):
+    return series_key(event.getparent()) + (event.findtext("uniqueid", ""),)
+
+
+class KeyedIndex(object):
+    """
+    An element of a moduleList, its key and an index of its keyed
+    children.
+
+    Duplicate child keys are recorded rather than raised when the index is
+    built, so that only the parts of a document that are actually used
+    need to be free of duplicates.
+    """
+    __slots__ = ("key", "element", "fingerprint", "_children", "_duplicates")
+
+    def __init__(self, key, element):
+        self.key = key
+        self.element = element
+        # Calculated on demand by users of the index that need it
+        self.fingerprint = None
+        self._children = {}
+        self._duplicates = None
+
+    def add_child(self, child):
+        if child.key in self._children:
+            if self._duplicates is None:
+                self._duplicates = Counter()
+            self._duplicates[child.key] += 1
+        else:
+            self._children[child.key] = child
+
+    @property
+    def children(self):
+        """
+        A dict of child key to child KeyedIndex.
+
+        Raises DuplicateKeyException if more than one child had the same
+        key.
+        """
+        if self._duplicates:
+            raise report_duplicates(self._duplicates)
+        return self._children
+
+
+def report_duplicates(duplicates):
+    # duplicates counts the occurrences after the first
+    dupes_description = ", ".join(
+        "{!r}: {:d}x".format(key, count + 1)
+        for (key, count) in duplicates.most_common())
+    return DuplicateKeyException(
+        "Duplicate items encountered: {}".format(dupes_description))
+
+
+def _get_root(api_xml):
+    if isinstance(api_xml, etree._ElementTree):
+        return api_xml.getroot()
+    return api_xml
+
+
+def index_module(module):
+    """
+    Index a single module element and all of its series and events.
+    """
+    indexed_module = KeyedIndex(module_key(module), module)
+
+    for series in module.iterchildren("series"):
+        indexed_series = KeyedIndex(
+            indexed_module.key + (series.findtext("uniqueid", ""),), series)
+
+        for event in series.iterchildren("event"):
+            indexed_series.add_child(KeyedIndex(
+                indexed_series.key + (event.findtext("uniqueid", ""),),
+                event))
+
+        indexed_module.add_child(indexed_series)
+    return indexed_module
+
+
+def index_module_list(api_xml):
+    """
+    Index the modules, series and events of a moduleList in a single pass
+    over the document.
+
+    Returns a KeyedIndex for the moduleList whose children are the indexed
+    modules.
+    """
+    module_list = _get_root(api_xml)
+    indexed = KeyedIndex((), module_list)
+    for module in module_list.iterchildren("module"):
+        indexed.add_child(index_module(module))
+    return indexed
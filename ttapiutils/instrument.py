@@ -0,0 +1,131 @@
+"""
+Measurement of the resources used by each stage of a StageGraph.
+"""
+from __future__ import print_function, unicode_literals
+
+from collections import OrderedDict
+import resource
+import threading
+import time
+
+from lxml import etree
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _peak_rss():
+    # In kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def describe_result(result, measure_size=True):
+    """
+    Get a dict of the size in bytes and the number of modules, series and
+    events of a stage's result. XML results are measured by serialising
+    them, unless measure_size is False, and import results by the size of
+    the request body.
+    """
+    description = {}
+    if isinstance(result, etree._ElementTree):
+        result = result.getroot()
+    if isinstance(result, etree._Element):
+        if measure_size:
+            description["bytes_out"] = len(
+                etree.tostring(result, encoding="utf-8"))
+        description.update({
+            "modules": int(result.xpath("count(/moduleList/module)")),
+            "series": int(result.xpath("count(/moduleList/module/series)")),
+            "events": int(result.xpath(
+                "count(/moduleList/module/series/event)"))
+        })
+    elif isinstance(result, tuple) and len(result) == 2:
+        request, _ = result
+        description["bytes_out"] = int(
+            request.headers.get("Content-Length", 0))
+    return description
+
+
+class StageInstrumentation(object):
+    """
+    A StageGraph instrument recording the wall time, CPU time, peak RSS
+    increase, bytes in and out and module, series and event counts of each
+    stage.
+
+    CPU time and RSS are measured for the whole process, so they include
+    the use of any stages running concurrently. Measuring bytes requires
+    serialising each result, so it can be disabled with measure_size, and
+    the sizes of results which are serialised anyway recorded with
+    record_size() instead.
+    """
+    def __init__(self, measure_size=True):
+        self.measure_size = measure_size
+        self.stats = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, name, func, dependencies, args):
+        start_wall = time.time()
+        start_cpu = _cpu_time()
+        start_rss = _peak_rss()
+
+        result = func(*args)
+
+        stats = OrderedDict([
+            ("wall_time", time.time() - start_wall),
+            ("cpu_time", _cpu_time() - start_cpu),
+            ("peak_rss_delta_kb", _peak_rss() - start_rss)
+        ])
+        with self._lock:
+            sizes = [self.stats[dependency]["bytes_out"]
+                     for dependency in dependencies
+                     if "bytes_out" in self.stats.get(dependency, {})]
+        if self.measure_size or sizes:
+            stats["bytes_in"] = sum(sizes)
+        stats.update(sorted(
+            describe_result(result, self.measure_size).items()))
+
+        with self._lock:
+            self.stats[name] = stats
+        return result
+
+    def record_size(self, name, size):
+        """
+        Record size as the bytes out of the stage called name, which has
+        been measured. Stages which depend on it count it as bytes in.
+        """
+        with self._lock:
+            self.stats[name]["bytes_out"] = size
+
+    def get_stats(self):
+        """
+        Get a list of the stats of each stage, in the order they completed.
+        """
+        with self._lock:
+            return [OrderedDict([("stage", name)] + list(stats.items()))
+                    for (name, stats) in self.stats.items()]
+
+
+_COLUMNS = [
+    ("stage", "{:<40}", "{:<40}"),
+    ("wall_time", "{:>9}", "{:>9.3f}"),
+    ("cpu_time", "{:>9}", "{:>9.3f}"),
+    ("peak_rss_delta_kb", "{:>18}", "{:>18d}"),
+    ("bytes_in", "{:>10}", "{:>10d}"),
+    ("bytes_out", "{:>10}", "{:>10d}"),
+    ("modules", "{:>8}", "{:>8d}"),
+    ("series", "{:>8}", "{:>8d}"),
+    ("events", "{:>8}", "{:>8d}")
+]
+
+
+def print_stats_table(stats, file):
+    print(" ".join(header_format.format(column)
+                   for (column, header_format, _) in _COLUMNS), file=file)
+    for stage_stats in stats:
+        print(" ".join(
+            value_format.format(stage_stats[column]) if column in stage_stats
+            else header_format.format("-")
+            for (column, header_format, value_format) in _COLUMNS),
+            file=file)
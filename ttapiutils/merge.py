@@ -3,21 +3,35 @@ Merge multiple Timetable API XML files into one.
 
 usage: ttapiutils merge <xmlfile>...
 """
+from copy import deepcopy
 import sys
 
 from lxml import etree
 import docopt
 
-from ttapiutils.utils import assert_valid, parse_xml
+from ttapiutils.utils import (
+	assert_valid, forget_validation, is_marked_valid, mark_valid, parse_xml)
 
 
-def merge(xmlfiles):
+def merge(xmlfiles, copy=False):
+	"""
+	Merge the modules of xmlfiles into a new moduleList. The modules are
+	moved out of xmlfiles unless copy is True.
+	"""
 	root = etree.Element("moduleList")
-	root.extend(
-		module
-		for xml in xmlfiles
-		for module in xml.xpath("/moduleList/module")
-	)
+	all_valid = True
+	for xml in xmlfiles:
+		all_valid = all_valid and is_marked_valid(xml)
+		modules = xml.xpath("/moduleList/module")
+		root.extend(map(deepcopy, modules) if copy else modules)
+		if modules and not copy:
+			# Without its modules xml is no longer valid
+			forget_validation(xml)
+
+	# The modules of valid moduleLists form a valid moduleList, as long as
+	# there's at least one.
+	if all_valid and len(root) > 0:
+		mark_valid(root)
 	return root
 
 
@@ -26,5 +40,6 @@ def main(args):
 	parser = etree.XMLParser(remove_blank_text=True)
 
 	xml_files = [parse_xml(filename) for filename in args["<xmlfile>"]]
-	map(assert_valid, xml_files)
+	for xml in xml_files:
+		assert_valid(xml, stage="merge")
 	merge(xml_files).getroottree().write(sys.stdout, pretty_print=True)
@@ -0,0 +1,386 @@
+"""
+Repeatedly run autoimport jobs from one long-running process.
+
+usage: ttapiutils serve [options] <jobs-file>
+
+Each job in <jobs-file> is an autoimport of the data from a data source
+into paths on a domain, which is run every interval seconds. Running
+jobs from one process keeps compiled schemas and stylesheets, data
+source plugins and HTTP connections to each domain warm between runs.
+
+A job is never started while a previous run of it is still running; if
+a run takes longer than the job's interval, the next run starts as soon
+as it finishes. A failed run is reported on stderr and the job is run
+again at its next interval.
+
+<jobs-file> is a JSON list of jobs such as:
+
+    [{
+        "name": "engineering",
+        "data_source": "engineering",
+        "params": {"part": ["IA", "IB"]},
+        "domain": "2014-15.timetable.cam.ac.uk",
+        "paths": ["/tripos/engineering/IA", "/tripos/engineering/IB"],
+        "interval": 3600,
+        "user": "someuser",
+        "pass_envar": "TIMETABLE_PASSWORD"
+    }]
+
+name, data_source, domain, paths and interval are required. params are
+passed to the data source, as with autoimport's -X. Jobs can also have
+the following, which match the autoimport options of the same name:
+audit_trail, https (default true), dry_run, concurrency (default 4),
+cache_dir, cache_max_age, state_dir, full_export_every (default 24) and
+force_import.
+
+options:
+    <jobs-file>
+        The JSON file defining the jobs to run.
+
+    --max-parallel-jobs=<n>
+        The maximum number of jobs to run at once [default: 2].
+
+    --once
+        Run each job once, then exit. The exit status is 1 if any job
+        failed.
+
+    --strict-validation
+        Validate every XML document at every stage, as with autoimport.
+
+    -h, --help
+        Show this help message
+"""
+from __future__ import print_function
+
+import datetime
+import json
+import sys
+import threading
+import time
+import traceback
+
+import docopt
+
+from ttapiutils.autoimport import (
+    create_auto_importer, get_data_source_factory,
+    get_defined_data_source_entrypoints)
+from ttapiutils.exportcache import ExportCache
+from ttapiutils.statestore import StateStore
+from ttapiutils.utils import (
+    create_session, get_credentials, set_strict_validation,
+    TimetableApiUtilsException)
+
+
+# The longest time the scheduler waits without checking for due jobs, so
+# that it remains responsive to KeyboardInterrupt.
+MAX_WAIT = 1.0
+
+
+class JobsFileException(TimetableApiUtilsException):
+    pass
+
+
+class Job(object):
+    """
+    An autoimport of data_source into paths on domain, run every interval
+    seconds.
+    """
+    REQUIRED_KEYS = ["name", "data_source", "domain", "paths", "interval"]
+    POSITIVE_NUMBER_KEYS = ["interval", "concurrency", "full_export_every"]
+
+    def __init__(self, name, data_source, domain, paths, interval,
+                 params=None, audit_trail=None, user=None, pass_envar=None,
+                 https=True, dry_run=False, concurrency=4, cache_dir=None,
+                 cache_max_age=None, state_dir=None, full_export_every=24,
+                 force_import=False):
+        self.name = name
+        self.data_source = data_source
+        self.domain = domain
+        self.paths = paths
+        self.interval = interval
+        self.params = params or {}
+        self.audit_trail = audit_trail
+        self.user = user
+        self.pass_envar = pass_envar
+        self.proto = "https" if https else "http"
+        self.dry_run = dry_run
+        self.concurrency = concurrency
+        self.force_import = force_import
+
+        # Caches and stores are kept for the life of the job. Each run's
+        # audit trail records only its own share of their stats.
+        self.export_cache = None
+        if cache_dir is not None:
+            self.export_cache = ExportCache(cache_dir, max_age=cache_max_age)
+        self.state_store = None
+        if state_dir is not None:
+            self.state_store = StateStore(
+                state_dir, full_export_interval=full_export_every)
+
+    @classmethod
+    def from_json(cls, obj):
+        if not isinstance(obj, dict):
+            raise JobsFileException("Jobs must be objects: {!r}".format(obj))
+
+        missing = [key for key in cls.REQUIRED_KEYS if key not in obj]
+        if missing:
+            raise JobsFileException("Job {!r} is missing: {}".format(
+                obj.get("name"), ", ".join(missing)))
+        if obj["data_source"] == "-":
+            raise JobsFileException(
+                "Job {!r} can't read its data source from stdin"
+                .format(obj["name"]))
+        if obj.get("user") and not obj.get("pass_envar"):
+            # A daemon can't prompt for passwords
+            raise JobsFileException(
+                "Job {!r} has a user but no pass_envar".format(obj["name"]))
+
+        for key in cls.POSITIVE_NUMBER_KEYS:
+            if key in obj and not is_positive_number(obj[key]):
+                raise JobsFileException(
+                    "Job {!r} has an invalid {}, which must be a positive "
+                    "number: {!r}".format(obj["name"], key, obj[key]))
+
+        kwargs = dict((str(key), value) for (key, value) in obj.items())
+        kwargs["params"] = parse_job_params(kwargs.get("params"))
+        try:
+            return cls(**kwargs)
+        except TypeError as e:
+            raise JobsFileException(
+                "Job {!r} is invalid: {}".format(obj["name"], e))
+
+    def get_credentials(self):
+        return get_credentials({"--user": self.user,
+                                "--pass-envar": self.pass_envar})
+
+    def get_data_source_params(self):
+        # Data sources may modify their params, e.g. by popping audit_log
+        return dict((key, list(values))
+                    for (key, values) in self.params.items())
+
+
+def is_positive_number(value):
+    # bool is a subclass of int, but true isn't a number of seconds
+    return (isinstance(value, (int, long, float)) and
+            not isinstance(value, bool) and value > 0)
+
+
+def parse_job_params(params):
+    """
+    Get the params of a job as parse_data_source_args() would return them
+    from -X options, i.e. a dict of name to list of values.
+    """
+    if params is None:
+        return {}
+    if not isinstance(params, dict):
+        raise JobsFileException("params must be an object: {!r}"
+                                .format(params))
+    return dict((str(key), value if isinstance(value, list) else [value])
+                for (key, value) in params.items())
+
+
+def load_jobs(file):
+    try:
+        jobs_json = json.load(file)
+    except ValueError as e:
+        raise JobsFileException("Unable to parse jobs file: {}".format(e))
+
+    if not isinstance(jobs_json, list):
+        raise JobsFileException("The jobs file must contain a list of jobs")
+
+    jobs = [Job.from_json(obj) for obj in jobs_json]
+    names = [job.name for job in jobs]
+    duplicates = sorted(set(name for name in names if names.count(name) > 1))
+    if duplicates:
+        raise JobsFileException("Duplicate job names: {}".format(
+            ", ".join(duplicates)))
+    return jobs
+
+
+class JobRunner(object):
+    """
+    Runs Jobs, sharing data source plugins and one HTTP session per domain
+    between all runs of all jobs.
+    """
+    def __init__(self, data_source_entrypoints=None, pool_size=10):
+        if data_source_entrypoints is None:
+            data_source_entrypoints = get_defined_data_source_entrypoints()
+        self.data_source_entrypoints = data_source_entrypoints
+        self.pool_size = pool_size
+        self._factories = {}
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get_data_source_factory(self, name):
+        with self._lock:
+            if name not in self._factories:
+                self._factories[name] = get_data_source_factory(
+                    name, self.data_source_entrypoints)
+            return self._factories[name]
+
+    def get_session(self, domain):
+        with self._lock:
+            if domain not in self._sessions:
+                self._sessions[domain] = create_session(
+                    pool_size=self.pool_size)
+            return self._sessions[domain]
+
+    def create_auto_importer(self, job):
+        return create_auto_importer(
+            self.get_data_source_factory(job.data_source),
+            job.get_data_source_params(), job.domain,
+            audit_trail_base_dir=job.audit_trail,
+            is_dry_run=job.dry_run, permitted_paths=job.paths,
+            http_protocol=job.proto, auth=job.get_credentials(),
+            concurrency=job.concurrency, export_cache=job.export_cache,
+            force_import=job.force_import, state_store=job.state_store,
+            session=self.get_session(job.domain))
+
+    def __call__(self, job):
+        """
+        Run job, returning True if anything was imported.
+        """
+        return self.create_auto_importer(job).auto_import() is not None
+
+
+class Scheduler(object):
+    """
+    Runs each of jobs with run_job every job.interval seconds, running at
+    most max_parallel_jobs at once and never running a job while a previous
+    run of it is still running.
+    """
+    def __init__(self, jobs, run_job, max_parallel_jobs=1, clock=time.time,
+                 log=None):
+        self.jobs = jobs
+        self.run_job = run_job
+        self.max_parallel_jobs = max_parallel_jobs
+        self.clock = clock
+        self.log = log_to_stderr if log is None else log
+        self.runs = dict((job.name, 0) for job in jobs)
+        self.failures = dict((job.name, 0) for job in jobs)
+        self._running = set()
+        self._stopped = False
+        self._condition = threading.Condition()
+
+        now = clock()
+        self._next_run = dict((job.name, now) for job in jobs)
+
+    def get_running_jobs(self):
+        with self._condition:
+            return set(self._running)
+
+    def stop(self):
+        """
+        Stop starting jobs. run() returns once the running jobs finish.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+
+    def _get_due_jobs(self, now, max_runs):
+        due = [job for job in self.jobs
+               if job.name not in self._running and
+               self._next_run[job.name] <= now and
+               (max_runs is None or self.runs[job.name] < max_runs)]
+        return sorted(due, key=lambda job: self._next_run[job.name])
+
+    def _get_wait_time(self, now, max_runs):
+        # Due jobs can't start until a running job finishes, which notifies
+        # the condition.
+        if len(self._running) >= self.max_parallel_jobs:
+            return MAX_WAIT
+        waiting = [self._next_run[job.name] for job in self.jobs
+                   if job.name not in self._running and
+                   (max_runs is None or self.runs[job.name] < max_runs)]
+        if not waiting:
+            return MAX_WAIT
+        return max(0, min(MAX_WAIT, min(waiting) - now))
+
+    def _is_finished(self, max_runs):
+        return max_runs is not None and all(
+            self.runs[job.name] >= max_runs for job in self.jobs)
+
+    def _start(self, job):
+        self._running.add(job.name)
+        thread = threading.Thread(target=self._run, args=(job,),
+                                  name="job-{}".format(job.name))
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, job):
+        started = self.clock()
+        failed = False
+        self.log("Starting job {!r}".format(job.name))
+        try:
+            imported = self.run_job(job)
+        except Exception:
+            failed = True
+            self.log("Job {!r} failed:\n{}".format(
+                job.name, traceback.format_exc()))
+        else:
+            self.log("Finished job {!r} in {:.1f}s: {}".format(
+                job.name, self.clock() - started,
+                "imported" if imported else "unchanged"))
+        finally:
+            with self._condition:
+                # Even if scheduling the next run fails, the job must not be
+                # left running, or run() would wait for it forever.
+                try:
+                    self._next_run[job.name] = started + job.interval
+                finally:
+                    self._running.discard(job.name)
+                    self.runs[job.name] += 1
+                    self.failures[job.name] += int(failed)
+                    self._condition.notify_all()
+
+    def run(self, max_runs=None):
+        """
+        Run jobs until stop() is called or, if max_runs is provided, each
+        job has been run max_runs times.
+        """
+        with self._condition:
+            try:
+                while not self._stopped and not self._is_finished(max_runs):
+                    now = self.clock()
+                    for job in self._get_due_jobs(now, max_runs):
+                        if len(self._running) >= self.max_parallel_jobs:
+                            break
+                        self._start(job)
+                    self._condition.wait(self._get_wait_time(now, max_runs))
+            finally:
+                self._stopped = True
+                if self._running:
+                    self.log("Waiting for running jobs to finish: {}".format(
+                        ", ".join(sorted(self._running))))
+                while self._running:
+                    self._condition.wait(MAX_WAIT)
+
+
+def log_to_stderr(message):
+    print("[{}] {}".format(datetime.datetime.now().isoformat(), message),
+          file=sys.stderr)
+
+
+def main(argv):
+    args = docopt.docopt(__doc__, argv=argv)
+
+    with open(args["<jobs-file>"]) as f:
+        jobs = load_jobs(f)
+    max_parallel_jobs = int(args["--max-parallel-jobs"])
+
+    if args["--strict-validation"]:
+        set_strict_validation(True)
+
+    runner = JobRunner()
+    # Fail on unknown data sources before running anything
+    for job in jobs:
+        runner.get_data_source_factory(job.data_source)
+
+    scheduler = Scheduler(jobs, runner, max_parallel_jobs=max_parallel_jobs)
+    try:
+        scheduler.run(max_runs=1 if args["--once"] else None)
+    except KeyboardInterrupt:
+        pass
+
+    if args["--once"] and any(scheduler.failures.values()):
+        sys.exit(1)
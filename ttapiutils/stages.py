@@ -0,0 +1,104 @@
+"""
+Graphs of named, memoised processing stages.
+
+A stage is a function of the results of the stages it depends on. Each
+stage is computed at most once per graph, however many stages depend on
+it, and independent dependencies can be computed concurrently.
+"""
+from __future__ import unicode_literals
+
+import contextlib
+import threading
+
+from ttapiutils.utils import map_concurrently, TimetableApiUtilsException
+
+
+@contextlib.contextmanager
+def _null_context():
+    yield
+
+
+class NoSuchStageException(TimetableApiUtilsException):
+    pass
+
+
+class StageGraph(object):
+    """
+    A set of stages whose results are computed on demand by get().
+
+    Stage results are shared between all the stages which depend on them,
+    so stage functions must not modify their arguments.
+
+    If instrument is provided, each stage is run by calling it with the
+    stage's name, function, dependency names and arguments, allowing it to
+    measure the stage. It must return the function's result.
+
+    If context is provided, it's called to get a context manager which each
+    stage's function is run within, in whichever thread computes it.
+    """
+    def __init__(self, concurrency=1, instrument=None, context=None):
+        self.concurrency = concurrency
+        self.instrument = instrument
+        self.context = context
+        self._stages = {}
+        self._results = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+        self._stage_locks = {}
+
+    def add_stage(self, name, func, dependencies=()):
+        """
+        Add a stage called name whose result is func called with the
+        results of the stages named in dependencies.
+        """
+        self._stages[name] = (func, tuple(dependencies))
+
+    def add_hook(self, hook):
+        """
+        Register hook to be called with the name and result of each stage
+        once it's been computed.
+        """
+        self._hooks.append(hook)
+
+    def get_stage_names(self):
+        return sorted(self._stages)
+
+    def _get_stage_lock(self, name):
+        with self._lock:
+            if name not in self._stage_locks:
+                self._stage_locks[name] = threading.Lock()
+            return self._stage_locks[name]
+
+    def _get_context(self):
+        if self.context is None:
+            return _null_context()
+        return self.context()
+
+    def is_computed(self, name):
+        return name in self._results
+
+    def get(self, name):
+        """
+        Get the result of the stage called name, computing it and its
+        dependencies if they've not been computed yet.
+        """
+        if name not in self._stages:
+            raise NoSuchStageException("No such stage: {!r}".format(name))
+
+        # Only one thread computes each stage; others wait for its result
+        with self._get_stage_lock(name):
+            if name in self._results:
+                return self._results[name]
+
+            func, dependencies = self._stages[name]
+            args = map_concurrently(self.get, dependencies,
+                                    concurrency=self.concurrency)
+            with self._get_context():
+                if self.instrument is None:
+                    result = func(*args)
+                else:
+                    result = self.instrument(name, func, dependencies, args)
+            for hook in self._hooks:
+                hook(name, result)
+            self._results[name] = result
+            return result
@@ -0,0 +1,98 @@
+"""
+A local store of the last imported state of timetable paths.
+
+After an import the new state of each path is stored, so that the next
+import can use it as the current state of the path instead of exporting
+it from the Timetable site. States are stored with their fingerprint, and
+with the number of runs since the path was last exported, so that paths
+can be exported periodically to detect changes made outside of imports.
+"""
+from __future__ import unicode_literals
+
+import json
+import os
+import os.path
+import tempfile
+
+from lxml import etree
+
+from ttapiutils.fingerprint import fingerprint, hex_fingerprint
+from ttapiutils.utils import parse_xml, write_c14n_pretty
+
+
+class StoredState(object):
+    def __init__(self, api_xml, fingerprint, runs_since_export):
+        self.api_xml = api_xml
+        self.fingerprint = fingerprint
+        self.runs_since_export = runs_since_export
+
+
+class StateStore(object):
+    """
+    Stores the state of paths under directory, in a subdirectory for each
+    domain. Stored states are used for at most full_export_interval runs
+    before the path must be exported again.
+    """
+    def __init__(self, directory, full_export_interval=24):
+        self.directory = directory
+        self.full_export_interval = full_export_interval
+
+    def _get_path(self, domain, path, extension):
+        # Strip the leading / and replace / with . as in audit trails
+        name = path.lstrip("/").replace("/", ".")
+        return os.path.join(self.directory, domain,
+                            "{}.{}".format(name, extension))
+
+    def load(self, domain, path):
+        """
+        Get the StoredState of path on domain, or None if it's not stored
+        or doesn't match its recorded fingerprint.
+        """
+        try:
+            with open(self._get_path(domain, path, "json")) as f:
+                metadata = json.load(f)
+            api_xml = parse_xml(self._get_path(domain, path, "xml"))
+        except (IOError, ValueError, etree.LxmlError):
+            return None
+
+        state_fingerprint = hex_fingerprint(fingerprint(api_xml))
+        if state_fingerprint != metadata.get("fingerprint"):
+            return None
+        return StoredState(api_xml, state_fingerprint,
+                           metadata.get("runs_since_export", 0))
+
+    def needs_export(self, stored):
+        """
+        Check if the path of a StoredState (or None) must be exported rather
+        than using the stored state.
+        """
+        return (stored is None or
+                stored.runs_since_export >= self.full_export_interval)
+
+    def _replace(self, path, data):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def save(self, domain, path, api_xml, runs_since_export=0):
+        """
+        Store api_xml as the state of path on domain.
+        """
+        self._replace(self._get_path(domain, path, "xml"),
+                      write_c14n_pretty(api_xml))
+        metadata = {
+            "fingerprint": hex_fingerprint(fingerprint(api_xml)),
+            "runs_since_export": runs_since_export
+        }
+        self._replace(self._get_path(domain, path, "json"),
+                      json.dumps(metadata).encode("utf-8"))
+
+    def forget(self, domain, path):
+        for extension in ["xml", "json"]:
+            filename = self._get_path(domain, path, extension)
+            if os.path.exists(filename):
+                os.remove(filename)
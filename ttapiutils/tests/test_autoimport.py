@@ -0,0 +1,519 @@
+from copy import deepcopy
+from cStringIO import StringIO
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from lxml import etree
+
+from ttapiutils.autoimport import (
+    AuditTrailAutoImporter, AutoImporter, complete_dry_run,
+    DryRunCompletionException, NewStateBuilder, StreamDataSource)
+from ttapiutils.canonicalise import canonicalise
+from ttapiutils.exportcache import ExportCache
+from ttapiutils.index import DuplicateKeyException
+from ttapiutils.instrument import print_stats_table
+from ttapiutils.statestore import StateStore
+from ttapiutils.tests.test_canonicalise import shuffled
+from ttapiutils.tests.test_deletegen import TtapiutilsTestCaseMixin
+from ttapiutils.tests.test_xmlexport import FakeResponse
+from ttapiutils.tests.test_xmlimport import FakeImportSession, read_body
+from ttapiutils.utils import (
+    DirectoryAuditLogger, get_validation_counts, is_marked_valid,
+    reset_validation_counts, scoped_validity_marks, write_c14n_pretty)
+from ttapiutils.xmlexport import build_api_export_url
+from ttapiutils.xmlimport import ImportClient
+
+
+class FakeDataSource(object):
+    def __init__(self, get_xml):
+        self.get_xml = get_xml
+
+
+class FakeStreamingDataSource(object):
+    """
+    A data source which yields the modules of api_xml one at a time.
+    """
+    def __init__(self, api_xml):
+        self.api_xml = api_xml
+
+    def iter_modules(self):
+        for module in self.api_xml.xpath("/moduleList/module"):
+            yield module
+
+    def get_xml(self):
+        raise AssertionError("iter_modules() should be used")
+
+
+class FakeAutoImporterMixin(TtapiutilsTestCaseMixin):
+    """
+    An AutoImporter which exports deleted_module_current.xml, imports
+    deleted_module_future.xml and makes its requests to a FakeImportSession.
+    """
+    def __init__(self, *args, **kwargs):
+        super(FakeAutoImporterMixin, self).__init__(*args, **kwargs)
+        self.exported_paths = []
+        self.import_session = FakeImportSession()
+
+    def export_old_state(self, path):
+        self.exported_paths.append(path)
+        return self.get_xml_data("deleted_module_current.xml")
+
+    def get_import_client(self):
+        return ImportClient(self.get_domain(), session=self.import_session)
+
+
+class FakeAutoImporter(FakeAutoImporterMixin, AutoImporter):
+    pass
+
+
+class FakeAuditTrailAutoImporter(FakeAutoImporterMixin,
+                                 AuditTrailAutoImporter):
+    pass
+
+
+class AutoImporterTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    paths = ["/tripos/foo/I"]
+
+    def get_data_source(self):
+        return FakeDataSource(
+            lambda: self.get_xml_data("deleted_module_future.xml"))
+
+    def test_stages_are_computed_once(self):
+        importer = FakeAutoImporter(
+            self.get_data_source(), "example.com", permitted_paths=self.paths,
+            concurrency=2)
+
+        importer.auto_import()
+        importer.get_merged_old_state()
+        importer.get_raw_old_state(self.paths[0])
+
+        self.assertEqual(self.paths, importer.exported_paths)
+        self.assertEqual(1, len(importer.import_session.imported))
+
+    def test_stage_results_are_not_modified_by_later_stages(self):
+        importer = FakeAutoImporter(
+            self.get_data_source(), "example.com", permitted_paths=self.paths)
+
+        importer.auto_import()
+
+        self.assert_api_xml_equal(
+            self.get_xml_data("deleted_module_current.xml"),
+            importer.get_fixed_old_state(self.paths[0]))
+
+    def get_unchanged_data_source(self):
+        return FakeDataSource(
+            lambda: self.get_xml_data("deleted_module_current.xml"))
+
+    def test_unchanged_state_is_not_imported(self):
+        importer = FakeAutoImporter(
+            self.get_unchanged_data_source(), "example.com",
+            permitted_paths=self.paths)
+
+        self.assertIsNone(importer.auto_import())
+        self.assertTrue(importer.is_unchanged())
+        self.assertEqual([], importer.import_session.imported)
+
+    def test_unchanged_state_is_imported_if_forced(self):
+        importer = FakeAutoImporter(
+            self.get_unchanged_data_source(), "example.com",
+            permitted_paths=self.paths, force_import=True)
+
+        self.assertIsNotNone(importer.auto_import())
+        self.assertEqual(1, len(importer.import_session.imported))
+
+    def test_audit_trail_records_skipped_import(self):
+        audit_base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, audit_base_dir)
+        audit_log = DirectoryAuditLogger(audit_base_dir)
+        importer = FakeAuditTrailAutoImporter(
+            audit_log, self.get_unchanged_data_source(), "example.com",
+            permitted_paths=self.paths)
+
+        importer.auto_import()
+
+        with audit_log.open_audit_file("manifest.json", "r") as f:
+            manifest = json.load(f)
+        self.assertEqual("unchanged", manifest["skipped"])
+        self.assertIn("is_unchanged",
+                      [stats["stage"] for stats in manifest["stages"]])
+
+    def test_audit_trail_measures_sizes_of_logged_results(self):
+        audit_base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, audit_base_dir)
+
+        for instrument in [False, True]:
+            audit_log = DirectoryAuditLogger(audit_base_dir)
+            importer = FakeAuditTrailAutoImporter(
+                audit_log, self.get_data_source(), "example.com",
+                permitted_paths=self.paths, instrument=instrument)
+            importer.auto_import()
+
+            stats = dict((s["stage"], s) for s in importer.get_stage_stats())
+            self.assertIn("events", stats["canonical_new_state"])
+            self.assertEqual(
+                audit_log.get_audit_file_size("canonical_new_state.xml"),
+                stats["canonical_new_state"]["bytes_out"])
+            self.assertEqual(stats["raw_new_state"]["bytes_out"],
+                             stats["canonical_new_state"]["bytes_in"])
+            self.assertGreater(stats["import"]["bytes_out"], 0)
+
+    def test_validation_counts_exclude_concurrent_imports(self):
+        def run_import():
+            importer = FakeAutoImporter(
+                self.get_data_source(), "example.com",
+                permitted_paths=self.paths, concurrency=2)
+            importer.auto_import()
+            return importer.get_validation_counts()
+
+        expected = run_import()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            run_import())) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIn("deletegen.current", expected)
+        self.assertEqual([expected] * 3, results)
+
+    def test_validity_marks_are_held_by_the_import(self):
+        importer = FakeAutoImporter(
+            self.get_data_source(), "example.com", permitted_paths=self.paths,
+            concurrency=2)
+        importer.auto_import()
+        canonical_new_state = importer.get_stages().get("canonical_new_state")
+
+        # Marks don't outlive the import in the process-wide LRU
+        self.assertFalse(is_marked_valid(canonical_new_state))
+        with scoped_validity_marks(importer._validity_marks):
+            self.assertTrue(is_marked_valid(canonical_new_state))
+
+    def test_export_cache_stats_are_per_import(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = ExportCache(cache_dir)
+        cache.record_hit()
+
+        importer = FakeAutoImporter(
+            self.get_data_source(), "example.com", permitted_paths=self.paths,
+            export_cache=cache)
+        cache.record_miss()
+
+        self.assertEqual({"hits": 0, "misses": 1},
+                         importer.get_export_cache_stats())
+
+    def test_stages_are_measured(self):
+        importer = FakeAutoImporter(
+            self.get_data_source(), "example.com", permitted_paths=self.paths,
+            instrument=True)
+
+        importer.auto_import()
+
+        stats = dict((s["stage"], s) for s in importer.get_stage_stats())
+        self.assertEqual(sorted(importer.get_stages().get_stage_names()),
+                         sorted(stats))
+        new_state = self.get_xml_data("deleted_module_future.xml")
+        self.assertEqual(
+            int(new_state.xpath("count(//event)")),
+            stats["canonical_new_state"]["events"])
+        self.assertEqual(stats["raw_new_state"]["bytes_out"],
+                         stats["canonical_new_state"]["bytes_in"])
+        self.assertGreater(stats["import"]["bytes_out"], 0)
+
+        out = StringIO()
+        print_stats_table(importer.get_stage_stats(), out)
+        self.assertEqual(len(stats) + 1, len(out.getvalue().splitlines()))
+
+    def test_stages_are_not_measured_by_default(self):
+        importer = FakeAutoImporter(
+            self.get_data_source(), "example.com", permitted_paths=self.paths)
+
+        importer.auto_import()
+
+        self.assertIsNone(importer.get_stage_stats())
+
+    def test_audit_trail_logs_stages(self):
+        audit_base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, audit_base_dir)
+        audit_log = DirectoryAuditLogger(audit_base_dir)
+        importer = FakeAuditTrailAutoImporter(
+            audit_log, self.get_data_source(), "example.com",
+            permitted_paths=self.paths)
+
+        importer.auto_import()
+
+        self.assertEqual(sorted([
+            "manifest.json",
+            "raw_new_state.xml",
+            "canonical_new_state.xml",
+            "raw_old_state_tripos.foo.I.xml",
+            "fixed_old_state_tripos.foo.I.xml",
+            "merged_old_state.xml",
+            "canonical_merged_old_state.xml",
+            "state_with_deletes.xml",
+            "http_request.txt",
+            "http_response.txt",
+            "validation_counts.json"
+        ]), sorted(os.listdir(audit_log.get_audit_dir())))
+
+
+class NewStateBuilderTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def build(self, modules):
+        builder = NewStateBuilder()
+        for module in modules:
+            builder.add_module(module)
+        return builder
+
+    def test_canonical_state_matches_canonicalise(self):
+        for seed in range(3):
+            api_xml = shuffled(self.get_xml_data("small.xml"), seed)
+            expected = canonicalise(api_xml)
+
+            builder = self.build(api_xml.xpath("/moduleList/module"))
+
+            self.assertEqual(write_c14n_pretty(expected),
+                             write_c14n_pretty(builder.get_canonical_state()))
+
+    def test_raw_state_preserves_module_order(self):
+        api_xml = shuffled(self.get_xml_data("small.xml"), 1)
+        expected = write_c14n_pretty(api_xml)
+
+        builder = self.build(api_xml.xpath("/moduleList/module"))
+
+        self.assertEqual(expected, write_c14n_pretty(builder.get_raw_state()))
+
+    def test_duplicate_modules_are_rejected(self):
+        api_xml = self.get_xml_data("duplicate_module.xml")
+
+        with self.assertRaises(DuplicateKeyException):
+            self.build(api_xml.xpath("/moduleList/module"))
+
+    def test_invalid_modules_are_rejected(self):
+        module = etree.Element("module")
+
+        with self.assertRaises(etree.DocumentInvalid):
+            self.build([module])
+
+    def test_empty_state_is_invalid(self):
+        with self.assertRaises(etree.DocumentInvalid):
+            self.build([]).get_raw_state()
+
+    def count_module_validations(self, data_source):
+        reset_validation_counts()
+        FakeAutoImporter(data_source, "example.com").build_new_state()
+        counts = get_validation_counts()
+        self.assertNotIn("iter_modules", counts)
+        return counts.get("autoimport.new_module", {}).get("validated", 0)
+
+    def test_streamed_modules_are_validated_once(self):
+        api_xml = self.get_xml_data("deleted_module_current.xml")
+        content = write_c14n_pretty(api_xml)
+
+        validated = self.count_module_validations(
+            StreamDataSource(BytesIO(content)))
+
+        self.assertEqual(len(api_xml.getroot()), validated)
+
+    def test_marked_valid_data_source_results_are_not_revalidated(self):
+        name = "deleted_module_current.xml"
+        module_count = len(self.get_xml_data(name).getroot())
+
+        self.assertEqual(0, self.count_module_validations(
+            FakeDataSource(lambda: self.get_xml_data(name))))
+        # Copies aren't marked valid
+        self.assertEqual(module_count, self.count_module_validations(
+            FakeDataSource(lambda: deepcopy(self.get_xml_data(name)))))
+
+    def test_streaming_data_sources_are_imported(self):
+        new_state = self.get_xml_data("deleted_module_future.xml")
+        expected = FakeAutoImporter(
+            FakeDataSource(lambda: deepcopy(new_state)), "example.com",
+            permitted_paths=["/tripos/foo/I"])
+        importer = FakeAutoImporter(
+            FakeStreamingDataSource(deepcopy(new_state)), "example.com",
+            permitted_paths=["/tripos/foo/I"])
+
+        importer.auto_import()
+        expected.auto_import()
+
+        self.assertEqual(write_c14n_pretty(expected.get_state_with_deletes()),
+                         write_c14n_pretty(importer.get_state_with_deletes()))
+        self.assertEqual(1, len(importer.import_session.imported))
+
+
+class AutoImporterStateStoreTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    paths = ["/tripos/foo/I"]
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+
+    def run_import(self, new_state_name="deleted_module_future.xml",
+                   full_export_interval=2):
+        importer = FakeAutoImporter(
+            FakeDataSource(lambda: self.get_xml_data(new_state_name)),
+            "example.com", permitted_paths=self.paths,
+            state_store=StateStore(self.state_dir, full_export_interval))
+        importer.auto_import()
+        return importer
+
+    def test_stored_state_is_used_until_export_is_due(self):
+        exported = [self.run_import().exported_paths for _ in range(4)]
+
+        self.assertEqual([self.paths, [], [], self.paths], exported)
+
+    def test_stored_state_is_the_imported_state(self):
+        self.run_import()
+
+        importer = self.run_import()
+
+        self.assertEqual([], importer.exported_paths)
+        self.assert_api_xml_equal(
+            self.get_xml_data("deleted_module_future.xml"),
+            importer.get_merged_old_state())
+        # The new state is unchanged, so nothing is imported
+        self.assertEqual([], importer.import_session.imported)
+
+    def test_changes_outside_imports_are_detected_on_export(self):
+        # The fake site never changes from its exported state, so the state
+        # stored by the first import appears to have been changed when the
+        # path is exported again.
+        importers = [self.run_import(full_export_interval=1)
+                     for _ in range(3)]
+
+        self.assertEqual([self.paths, [], self.paths],
+                         [i.exported_paths for i in importers])
+        self.assertEqual([[], [], self.paths], [
+            i.get_state_store_stats()["drifted_paths"] for i in importers])
+
+    def test_stored_state_is_forgotten_when_import_fails(self):
+        self.run_import()
+        importer = FailingImportAutoImporter(
+            FakeDataSource(lambda: self.get_xml_data("small.xml")),
+            "example.com", permitted_paths=self.paths,
+            state_store=StateStore(self.state_dir, 2))
+
+        with self.assertRaises(ValueError):
+            importer.auto_import()
+
+        self.assertEqual(self.paths, self.run_import().exported_paths)
+
+    def test_corrupt_stored_state_is_exported(self):
+        self.run_import()
+        store = StateStore(self.state_dir, 2)
+        with open(store._get_path("example.com", self.paths[0], "xml"),
+                  "w") as f:
+            f.write("<moduleList>")
+
+        self.assertIsNone(store.load("example.com", self.paths[0]))
+        self.assertEqual(self.paths, self.run_import().exported_paths)
+
+
+class FailingImportAutoImporter(FakeAutoImporter):
+    def import_to_timetable(self, api_xml):
+        raise ValueError("Import failed")
+
+
+class CompleteDryRunStateStoreTest(TtapiutilsTestCaseMixin,
+                                   unittest.TestCase):
+    paths = ["/tripos/foo/I"]
+
+    def setUp(self):
+        self.state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.state_dir)
+        audit_base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, audit_base_dir)
+        self.audit_log = DirectoryAuditLogger(audit_base_dir)
+
+    def create_importer(self, new_state_name, cls=FakeAutoImporter,
+                        *args, **kwargs):
+        return cls(*(args + (
+            FakeDataSource(lambda: self.get_xml_data(new_state_name)),
+            "example.com")), permitted_paths=self.paths,
+            state_store=StateStore(self.state_dir), **kwargs)
+
+    def test_completed_dry_runs_invalidate_stored_state(self):
+        self.create_importer("deleted_module_future.xml").auto_import()
+        dry_run = self.create_importer(
+            "deleted_module_current.xml", FakeAuditTrailAutoImporter,
+            self.audit_log, is_dry_run=True)
+        dry_run.auto_import()
+        self.assertEqual([], dry_run.exported_paths)
+
+        complete_dry_run(self.audit_log.get_audit_dir(), verify=False,
+                         session=FakeSiteSession(b""))
+        importer = self.create_importer("deleted_module_current.xml")
+        importer.auto_import()
+
+        # The stored state predates the completed import, so the path is
+        # exported instead.
+        self.assertEqual(self.paths, importer.exported_paths)
+
+
+class FakeSiteSession(FakeImportSession):
+    """
+    A FakeImportSession which also serves exports of /tripos/foo/I.
+    """
+    def __init__(self, export_content):
+        super(FakeSiteSession, self).__init__()
+        self.export_content = export_content
+
+    def get(self, url, auth=None, allow_redirects=True, stream=False,
+            headers=None):
+        if url == build_api_export_url("example.com", "/tripos/foo/I"):
+            return FakeResponse(self.export_content)
+        return super(FakeSiteSession, self).get(url, auth=auth)
+
+
+class CompleteDryRunTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    paths = ["/tripos/foo/I"]
+
+    def setUp(self):
+        audit_base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, audit_base_dir)
+        self.audit_log = DirectoryAuditLogger(audit_base_dir)
+        importer = FakeAuditTrailAutoImporter(
+            self.audit_log, FakeDataSource(
+                lambda: self.get_xml_data("deleted_module_future.xml")),
+            "example.com", permitted_paths=self.paths, is_dry_run=True)
+        importer.auto_import()
+        self.state_with_deletes = importer.get_state_with_deletes()
+
+    def get_site_session(self, export_name="deleted_module_current.xml"):
+        return FakeSiteSession(
+            write_c14n_pretty(self.get_xml_data(export_name)))
+
+    def test_dry_run_payload_is_imported(self):
+        session = self.get_site_session()
+
+        complete_dry_run(self.audit_log.get_audit_dir(), session=session)
+
+        self.assertEqual(1, len(session.imported))
+        self.assertIn(write_c14n_pretty(self.state_with_deletes).decode(
+            "utf-8"), read_body(session.imported[0]))
+
+    def test_dry_run_is_only_completed_once(self):
+        complete_dry_run(self.audit_log.get_audit_dir(),
+                         session=self.get_site_session())
+
+        with self.assertRaises(DryRunCompletionException):
+            complete_dry_run(self.audit_log.get_audit_dir(),
+                             session=self.get_site_session())
+
+    def test_changed_state_is_not_imported(self):
+        session = self.get_site_session(
+            export_name="deleted_series_current.xml")
+
+        with self.assertRaises(DryRunCompletionException):
+            complete_dry_run(self.audit_log.get_audit_dir(), session=session)
+        self.assertEqual([], session.imported)
+
+        complete_dry_run(self.audit_log.get_audit_dir(), session=session,
+                         verify=False)
+        self.assertEqual(1, len(session.imported))
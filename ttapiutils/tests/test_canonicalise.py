@@ -0,0 +1,162 @@
+import random
+import unittest
+from copy import deepcopy
+from io import BytesIO
+
+from lxml import etree
+import pkg_resources
+
+from ttapiutils.canonicalise import (
+    canonicalise, canonicalise_native, canonicalise_streaming)
+from ttapiutils.tests.test_deletegen import TtapiutilsTestCaseMixin
+
+
+DELETEGEN_DATA_FILES = [
+    "deleted_module_current.xml",
+    "deleted_module_future.xml",
+    "deleted_series_current.xml",
+    "deleted_series_future.xml",
+    "duplicate_event.xml",
+    "duplicate_module.xml",
+    "duplicate_series.xml",
+    "small.xml"
+]
+
+
+def shuffled(api_xml, seed):
+    """
+    Get a copy of api_xml with its modules, series and events shuffled.
+    """
+    rand = random.Random(seed)
+    api_xml = deepcopy(api_xml)
+    for (parent_path, tag) in [("/moduleList", "module"),
+                               ("//module", "series"),
+                               ("//series", "event")]:
+        for parent in api_xml.xpath(parent_path):
+            children = [c for c in parent if c.tag == tag]
+            rand.shuffle(children)
+            parent[:] = [c for c in parent if c.tag != tag] + children
+    return api_xml
+
+
+class CanonicaliseEquivalenceTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    """
+    The native and XSLT canonicalise engines must produce identical output.
+    """
+    def get_tie_breaking_xml(self):
+        """
+        A document whose series and events differ only in the later sort
+        keys, including events with duration instead of end.
+        """
+        module_list = etree.Element("moduleList")
+        for tripos in ["b", "a"]:
+            module = etree.SubElement(module_list, "module")
+            path = etree.SubElement(module, "path")
+            etree.SubElement(path, "tripos").text = tripos
+            etree.SubElement(path, "part").text = "I"
+            if tripos == "b":
+                etree.SubElement(path, "subject").text = "s"
+            etree.SubElement(module, "name").text = "Module"
+
+            for series_id in ["2", "1", "3"]:
+                series = etree.SubElement(module, "series")
+                etree.SubElement(series, "uniqueid").text = series_id
+                etree.SubElement(series, "name").text = (
+                    "Series" if series_id != "3" else "A series")
+
+                for event_id in range(12):
+                    event = etree.SubElement(series, "event")
+                    etree.SubElement(event, "uniqueid").text = str(
+                        event_id % 3)
+                    etree.SubElement(event, "name").text = "Event"
+                    if event_id % 4:
+                        etree.SubElement(event, "location").text = (
+                            "Room {}".format(event_id % 2))
+                    for lecturer in range(event_id % 3):
+                        etree.SubElement(event, "lecturer").text = (
+                            "Dr {}".format(2 - lecturer))
+                    etree.SubElement(event, "date").text = "2014-10-1{}".format(
+                        event_id % 2)
+                    etree.SubElement(event, "start").text = "10:00:00"
+                    etree.SubElement(
+                        event, "end" if event_id % 2 else "duration"
+                    ).text = "0{}:00:00".format(event_id % 5)
+                    etree.SubElement(event, "type").text = (
+                        "lecture" if event_id % 3 else "class")
+        return module_list.getroottree()
+
+    def assert_engines_equivalent(self, api_xml):
+        xslt_result = canonicalise(api_xml, engine="xslt")
+        native_result = canonicalise(api_xml, engine="native")
+
+        self.assertEqual(etree.tostring(xslt_result),
+                         etree.tostring(native_result))
+
+    def test_data_files(self):
+        for name in DELETEGEN_DATA_FILES:
+            self.assert_engines_equivalent(self.get_xml_data(name))
+
+    def test_shuffled_data_files(self):
+        for name in DELETEGEN_DATA_FILES:
+            for seed in range(5):
+                self.assert_engines_equivalent(
+                    shuffled(self.get_xml_data(name), seed))
+
+    def test_tie_breaking(self):
+        for seed in range(10):
+            self.assert_engines_equivalent(
+                shuffled(self.get_tie_breaking_xml(), seed))
+
+    def test_whitespace_is_handled_identically(self):
+        # Parse without removing whitespace between elements
+        api_xml = etree.parse(pkg_resources.resource_stream(
+            "ttapiutils.tests.test_deletegen",
+            "data/deletegen/deleted_series_current.xml"))
+
+        self.assert_engines_equivalent(api_xml)
+
+    def test_native_engine_copies_input_by_default(self):
+        api_xml = shuffled(self.get_xml_data("small.xml"), 1)
+        original = etree.tostring(api_xml)
+
+        canonicalise_native(api_xml)
+
+        self.assertEqual(original, etree.tostring(api_xml))
+
+    def test_unknown_engine_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            canonicalise(self.get_xml_data("small.xml"), engine="foo")
+
+
+class CanonicaliseStreamingTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def assert_streaming_matches_in_memory(self, api_xml, buffer_size):
+        out = BytesIO()
+        canonicalise_streaming(BytesIO(etree.tostring(api_xml)), out,
+                               buffer_size=buffer_size)
+
+        self.assertEqual(self.canonical_serialisation(api_xml),
+                         out.getvalue())
+
+    def test_data_files_sorted_in_memory(self):
+        for name in DELETEGEN_DATA_FILES:
+            self.assert_streaming_matches_in_memory(
+                shuffled(self.get_xml_data(name), 0), 1024 * 1024)
+
+    def test_data_files_sorted_with_temporary_runs(self):
+        for name in DELETEGEN_DATA_FILES:
+            # A buffer this small spills every module to its own run
+            self.assert_streaming_matches_in_memory(
+                shuffled(self.get_xml_data(name), 0), 1)
+
+    def test_multiple_modules_sorted_with_temporary_runs(self):
+        api_xml = etree.Element("moduleList")
+        for name in DELETEGEN_DATA_FILES:
+            api_xml.extend(self.get_xml_data(name).xpath("/moduleList/*"))
+
+        for buffer_size in [1, 1000, 1024 * 1024]:
+            self.assert_streaming_matches_in_memory(
+                shuffled(api_xml.getroottree(), 1), buffer_size)
+
+    def test_empty_input_is_invalid(self):
+        with self.assertRaises(etree.DocumentInvalid):
+            canonicalise_streaming(BytesIO(b"<moduleList/>"), BytesIO())
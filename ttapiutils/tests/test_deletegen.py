@@ -1,9 +1,13 @@
 import unittest
 from copy import deepcopy
+from io import BytesIO
 
 import pkg_resources
+from lxml import etree
 
-from ttapiutils.deletegen import generate_deletes, DuplicateKeyException
+from ttapiutils.deletegen import (
+    generate_deletes, generate_deletes_streaming, DuplicateKeyException,
+    UnsortedModulesException)
 from ttapiutils.canonicalise import canonicalise
 from ttapiutils.utils import parse_xml, write_c14n_pretty
 
@@ -78,3 +82,142 @@ class DeletegenTest(TtapiutilsTestCaseMixin, unittest.TestCase):
             "]/series["
                 "name='Series not in future state'"
             "]/delete"))
+
+    def test_consuming_future_produces_the_same_result(self):
+        current = self.get_xml_data("deleted_series_current.xml")
+        future = self.get_xml_data("deleted_series_future.xml")
+        expected = generate_deletes(current, future)
+
+        with_deletes = generate_deletes(current, future, consume=True)
+
+        self.assert_api_xml_equal(expected, with_deletes)
+        # The future's events have been moved into the result
+        self.assertEqual([], future.xpath("//event"))
+
+    def test_parallel_merge_produces_the_same_result(self):
+        current = self.get_xml_data("deleted_module_current.xml")
+        future = self.get_xml_data("deleted_module_future.xml")
+        expected = generate_deletes(current, future)
+
+        with_deletes = generate_deletes(current, future, jobs=2)
+
+        self.assert_api_xml_equal(expected, with_deletes)
+
+    def test_parallel_merge_raises_duplicates(self):
+        state = self.get_xml_data("duplicate_event.xml")
+
+        with self.assertRaises(DuplicateKeyException):
+            generate_deletes(state, state, jobs=2)
+
+
+class DeletegenElideUnchangedTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def test_identical_states_produce_empty_module_list(self):
+        state_current = self.get_xml_data("small.xml")
+        state_future = deepcopy(state_current)
+
+        with_deletes = generate_deletes(state_current, state_future,
+                                        elide_unchanged=True)
+
+        self.assertEqual(0, len(with_deletes))
+
+    def test_only_modified_events_are_included(self):
+        state_current = self.get_xml_data("small.xml")
+        state_future = deepcopy(state_current)
+        (location,) = state_future.xpath("//event[uniqueid='2']/location")
+        location.text = "Somewhere else"
+
+        with_deletes = generate_deletes(state_current, state_future,
+                                        elide_unchanged=True)
+
+        self.assertEqual(["2"], with_deletes.xpath(
+            "/moduleList/module/series/event/uniqueid/text()"))
+        self.assertEqual(
+            ["Somewhere else"], with_deletes.xpath("//event/location/text()"))
+
+    def test_deletes_are_included(self):
+        current = self.get_xml_data("deleted_series_current.xml")
+        future = self.get_xml_data("deleted_series_future.xml")
+
+        with_deletes = generate_deletes(current, future, elide_unchanged=True)
+
+        self.assertTrue(with_deletes.xpath(
+            "/moduleList/module/series["
+                "name='Series not in future state'"
+            "]/delete"))
+
+    def test_series_with_only_own_fields_modified_is_included_whole(self):
+        state_current = self.get_xml_data("small.xml")
+        state_future = deepcopy(state_current)
+        (name,) = state_future.xpath("//series/name")
+        name.text = "New name"
+
+        with_deletes = generate_deletes(state_current, state_future,
+                                        elide_unchanged=True)
+
+        self.assert_api_xml_equal(state_future, with_deletes)
+
+
+class DeletegenStreamingTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def canonical_file(self, name):
+        return BytesIO(self.canonical_serialisation(self.get_xml_data(name)))
+
+    def generate_deletes_streaming(self, current, future, **kwargs):
+        out = BytesIO()
+        generate_deletes_streaming(current, future, out, **kwargs)
+        out.seek(0)
+        return parse_xml(out)
+
+    def assert_streaming_matches_in_memory(self, current_name, future_name):
+        with_deletes = generate_deletes(self.get_xml_data(current_name),
+                                        self.get_xml_data(future_name))
+        streamed = self.generate_deletes_streaming(
+            self.canonical_file(current_name),
+            self.canonical_file(future_name))
+
+        self.assert_api_xml_equal(with_deletes, streamed)
+
+    def test_deleted_modules_match_in_memory_result(self):
+        self.assert_streaming_matches_in_memory(
+            "deleted_module_current.xml", "deleted_module_future.xml")
+        self.assert_streaming_matches_in_memory(
+            "deleted_module_future.xml", "deleted_module_current.xml")
+
+    def test_deleted_series_match_in_memory_result(self):
+        self.assert_streaming_matches_in_memory(
+            "deleted_series_current.xml", "deleted_series_future.xml")
+
+    def test_unsorted_modules_raise_exception(self):
+        unsorted = BytesIO(b"""<moduleList>
+            <module>
+                <path><tripos>b</tripos><part>I</part></path>
+                <name>B</name><delete/>
+            </module>
+            <module>
+                <path><tripos>a</tripos><part>I</part></path>
+                <name>A</name><delete/>
+            </module>
+        </moduleList>""")
+
+        with self.assertRaises(UnsortedModulesException):
+            generate_deletes_streaming(
+                unsorted, self.canonical_file("small.xml"), BytesIO())
+
+    def test_duplicate_modules_raise_exception(self):
+        duplicates = BytesIO(self.canonical_serialisation(
+            self.get_xml_data("duplicate_module.xml")))
+
+        with self.assertRaises(DuplicateKeyException):
+            generate_deletes_streaming(
+                duplicates, self.canonical_file("small.xml"), BytesIO())
+
+    def test_empty_inputs_are_invalid(self):
+        for (current, future) in [(b"<moduleList/>", b"<moduleList/>"),
+                                  (b"<moduleList/>", None),
+                                  (None, b"<moduleList/>")]:
+            current = (self.canonical_file("small.xml") if current is None
+                       else BytesIO(current))
+            future = (self.canonical_file("small.xml") if future is None
+                      else BytesIO(future))
+
+            with self.assertRaises(etree.DocumentInvalid):
+                generate_deletes_streaming(current, future, BytesIO())
@@ -0,0 +1,66 @@
+import unittest
+from copy import deepcopy
+
+from ttapiutils.canonicalise import canonicalise
+from ttapiutils.fingerprint import (
+    diff, fingerprint, fingerprint_index, indexed_fingerprint)
+from ttapiutils.tests.test_canonicalise import shuffled
+from ttapiutils.tests.test_deletegen import TtapiutilsTestCaseMixin
+
+
+MODULE_KEY = ("foo", "I", "", "Module Foo")
+
+
+class FingerprintTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def test_fingerprint_is_independent_of_order(self):
+        state = self.get_xml_data("deleted_module_current.xml")
+
+        for seed in range(5):
+            self.assertEqual(fingerprint(state),
+                             fingerprint(shuffled(state, seed)))
+
+    def test_fingerprint_matches_canonical_form(self):
+        state = shuffled(self.get_xml_data("deleted_series_current.xml"), 1)
+
+        self.assertEqual(fingerprint(state), fingerprint(canonicalise(state)))
+
+    def test_modified_event_changes_fingerprint(self):
+        state = self.get_xml_data("small.xml")
+        modified = deepcopy(state)
+        (lecturer,) = modified.xpath("//event[uniqueid='1']/lecturer")
+        lecturer.text = "Someone else"
+
+        self.assertNotEqual(fingerprint(state), fingerprint(modified))
+
+    def test_indexed_fingerprint_matches_element_fingerprint(self):
+        state = self.get_xml_data("deleted_module_current.xml")
+
+        self.assertEqual(fingerprint(state),
+                         indexed_fingerprint(fingerprint_index(state)))
+
+    def test_identical_documents_have_no_diff(self):
+        state = self.get_xml_data("small.xml")
+
+        self.assertEqual([], diff(state, shuffled(state, 0)))
+
+    def test_diff_locates_removed_series(self):
+        current = self.get_xml_data("deleted_series_current.xml")
+        future = self.get_xml_data("deleted_series_future.xml")
+
+        self.assertEqual([("removed", MODULE_KEY + ("blarg",))],
+                         diff(current, future))
+        self.assertEqual([("added", MODULE_KEY + ("blarg",))],
+                         diff(future, current))
+
+    def test_diff_locates_changed_series_and_events(self):
+        current = self.get_xml_data("deleted_series_current.xml")
+        future = deepcopy(current)
+        (series_name,) = future.xpath("//series[uniqueid='blah']/name")
+        series_name.text = "Renamed"
+        (event_date,) = future.xpath("//event[uniqueid='def']/date")
+        event_date.text = "2014-01-01"
+
+        self.assertEqual(
+            [("changed", MODULE_KEY + ("blah",)),
+             ("changed", MODULE_KEY + ("blah", "def"))],
+            diff(current, future))
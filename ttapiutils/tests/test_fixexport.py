@@ -0,0 +1,60 @@
+import unittest
+
+from lxml import etree
+
+from ttapiutils.fixexport import fix_export_ids
+from ttapiutils.tests.test_canonicalise import DELETEGEN_DATA_FILES
+from ttapiutils.tests.test_deletegen import TtapiutilsTestCaseMixin
+from ttapiutils.utils import is_marked_valid, write_c14n_pretty
+
+
+def add_import_prefixes(api_xml):
+    """
+    Prefix the uniqueids of events and series with import-, as the API
+    does to event IDs.
+    """
+    for uniqueid in api_xml.xpath("//uniqueid"):
+        uniqueid.text = "import-" + (uniqueid.text or "")
+    return api_xml
+
+
+class FixExportIdsEquivalenceTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def assert_engines_equivalent(self, api_xml):
+        self.assertEqual(
+            write_c14n_pretty(fix_export_ids(api_xml, engine="xslt")),
+            write_c14n_pretty(fix_export_ids(api_xml, engine="native")))
+
+    def test_native_engine_matches_xslt(self):
+        for name in DELETEGEN_DATA_FILES:
+            api_xml = add_import_prefixes(self.get_xml_data(name))
+            self.assert_engines_equivalent(api_xml)
+
+    def test_only_event_ids_are_fixed(self):
+        api_xml = add_import_prefixes(self.get_xml_data("small.xml"))
+
+        fixed_xml = fix_export_ids(api_xml)
+
+        self.assertEqual([], [
+            uid for uid in fixed_xml.xpath("//event/uniqueid/text()")
+            if uid.startswith("import-")])
+        self.assertTrue(all(
+            uid.startswith("import-")
+            for uid in fixed_xml.xpath("//series/uniqueid/text()")))
+
+    def test_ids_which_are_only_the_prefix_become_empty(self):
+        api_xml = self.get_xml_data("small.xml")
+        api_xml.xpath("//event/uniqueid")[0].text = "import-"
+
+        self.assert_engines_equivalent(api_xml)
+
+    def test_input_is_only_modified_in_place(self):
+        api_xml = add_import_prefixes(self.get_xml_data("small.xml"))
+        original = etree.tostring(api_xml)
+
+        fix_export_ids(api_xml)
+        self.assertEqual(original, etree.tostring(api_xml))
+
+        fixed_xml = fix_export_ids(api_xml, in_place=True)
+        self.assertIs(api_xml, fixed_xml)
+        self.assertNotEqual(original, etree.tostring(api_xml))
+        self.assertTrue(is_marked_valid(fixed_xml))
@@ -0,0 +1,46 @@
+import unittest
+
+from ttapiutils.index import (
+    DuplicateKeyException, event_key, index_module_list, module_key,
+    series_key)
+from ttapiutils.tests.test_deletegen import TtapiutilsTestCaseMixin
+
+
+class IndexTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def test_keys_match_element_key_functions(self):
+        state = self.get_xml_data("small.xml")
+        indexed = index_module_list(state)
+
+        for (key, module) in indexed.children.items():
+            self.assertEqual(module_key(module.element), key)
+            for (key, series) in module.children.items():
+                self.assertEqual(series_key(series.element), key)
+                for (key, event) in series.children.items():
+                    self.assertEqual(event_key(event.element), key)
+
+    def test_event_keys_inherit_parent_keys(self):
+        state = self.get_xml_data("small.xml")
+        indexed = index_module_list(state)
+
+        event_keys = set(
+            key for module in indexed.children.values()
+            for series in module.children.values()
+            for key in series.children.keys())
+
+        self.assertEqual(set([
+            ("asnc", "I", "", "Paper 1 - England before the Norman Conquest",
+             "-", "1"),
+            ("asnc", "I", "", "Paper 1 - England before the Norman Conquest",
+             "-", "2")
+        ]), event_keys)
+
+    def test_duplicates_are_raised_when_children_are_accessed(self):
+        state = self.get_xml_data("duplicate_event.xml")
+        # Building the index is fine...
+        indexed = index_module_list(state)
+        (module,) = indexed.children.values()
+        (series,) = module.children.values()
+
+        # ...but duplicates can't be used
+        with self.assertRaises(DuplicateKeyException):
+            series.children
@@ -0,0 +1,212 @@
+import io
+import json
+import threading
+import time
+import unittest
+
+from ttapiutils.serve import Job, JobRunner, JobsFileException, load_jobs, Scheduler
+
+
+def make_job(name, interval=0, **kwargs):
+    return Job(name, "example", "example.com", ["/a"], interval, **kwargs)
+
+
+class ConcurrencyRecorder(object):
+    """
+    A run_job function which records how many jobs, and how many runs of
+    each job, are running at once.
+    """
+    def __init__(self, duration=0.02, fail=()):
+        self.duration = duration
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.running = []
+        self.max_running = 0
+        self.overlapping_runs = []
+
+    def __call__(self, job):
+        with self.lock:
+            if job.name in self.running:
+                self.overlapping_runs.append(job.name)
+            self.running.append(job.name)
+            self.max_running = max(self.max_running, len(self.running))
+        time.sleep(self.duration)
+        with self.lock:
+            self.running.remove(job.name)
+        if job.name in self.fail:
+            raise ValueError("Job failed")
+        return True
+
+
+class SchedulerTest(unittest.TestCase):
+    def run_jobs(self, jobs, run_job, max_runs, max_parallel_jobs=1):
+        scheduler = Scheduler(jobs, run_job,
+                              max_parallel_jobs=max_parallel_jobs,
+                              log=lambda message: None)
+        scheduler.run(max_runs=max_runs)
+        return scheduler
+
+    def test_each_job_is_run_max_runs_times(self):
+        jobs = [make_job("a"), make_job("b")]
+
+        scheduler = self.run_jobs(jobs, ConcurrencyRecorder(), max_runs=3)
+
+        self.assertEqual({"a": 3, "b": 3}, scheduler.runs)
+        self.assertEqual(set(), scheduler.get_running_jobs())
+
+    def test_parallel_jobs_are_bounded(self):
+        jobs = [make_job(name) for name in "abcde"]
+        recorder = ConcurrencyRecorder()
+
+        self.run_jobs(jobs, recorder, max_runs=2, max_parallel_jobs=2)
+
+        self.assertEqual(2, recorder.max_running)
+
+    def test_jobs_waiting_for_a_slot_do_not_busy_wait(self):
+        clock_calls = []
+
+        def clock():
+            clock_calls.append(None)
+            return time.time()
+
+        scheduler = Scheduler([make_job("a"), make_job("b")],
+                              ConcurrencyRecorder(duration=0.2),
+                              max_parallel_jobs=1, clock=clock,
+                              log=lambda message: None)
+        scheduler.run(max_runs=1)
+
+        # A few calls per run and per scheduling pass, not one per spin
+        self.assertLess(len(clock_calls), 20)
+
+    def test_runs_of_a_job_do_not_overlap(self):
+        recorder = ConcurrencyRecorder()
+
+        self.run_jobs([make_job("a")], recorder, max_runs=5,
+                      max_parallel_jobs=4)
+
+        self.assertEqual(1, recorder.max_running)
+        self.assertEqual([], recorder.overlapping_runs)
+
+    def test_jobs_wait_for_their_interval(self):
+        runs = []
+        scheduler = Scheduler([make_job("a", interval=60)], runs.append,
+                              log=lambda message: None)
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        time.sleep(0.1)
+        scheduler.stop()
+        thread.join()
+
+        self.assertEqual(1, len(runs))
+
+    def test_jobs_are_not_left_running_if_scheduling_fails(self):
+        scheduler = Scheduler([make_job("a", interval="60")], lambda job: True,
+                              log=lambda message: None)
+        errors = []
+
+        def start(job):
+            # Run the job in the scheduler's thread to catch its error
+            scheduler._running.add(job.name)
+            scheduler._run(job)
+
+        def run():
+            try:
+                scheduler.run(max_runs=1)
+            except TypeError as e:
+                errors.append(e)
+
+        scheduler._start = start
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(1, len(errors))
+        self.assertEqual(set(), scheduler.get_running_jobs())
+
+    def test_failed_jobs_are_counted_and_rerun(self):
+        jobs = [make_job("a"), make_job("b")]
+
+        scheduler = self.run_jobs(jobs, ConcurrencyRecorder(fail=["a"]),
+                                  max_runs=2)
+
+        self.assertEqual({"a": 2, "b": 2}, scheduler.runs)
+        self.assertEqual({"a": 2, "b": 0}, scheduler.failures)
+
+
+class LoadJobsTest(unittest.TestCase):
+    def load(self, jobs_json):
+        return load_jobs(io.StringIO(jobs_json))
+
+    def test_jobs_are_loaded(self):
+        jobs = self.load(u"""[{
+            "name": "a", "data_source": "example", "domain": "example.com",
+            "paths": ["/a", "/b"], "interval": 60, "https": false,
+            "params": {"x": "1", "y": ["2", "3"]}
+        }]""")
+
+        self.assertEqual(1, len(jobs))
+        self.assertEqual(["/a", "/b"], jobs[0].paths)
+        self.assertEqual("http", jobs[0].proto)
+        self.assertEqual({"x": ["1"], "y": ["2", "3"]},
+                         jobs[0].get_data_source_params())
+
+    def test_missing_keys_are_rejected(self):
+        with self.assertRaises(JobsFileException):
+            self.load(u'[{"name": "a", "data_source": "example"}]')
+
+    def test_unknown_keys_are_rejected(self):
+        with self.assertRaises(JobsFileException):
+            self.load(u"""[{
+                "name": "a", "data_source": "example", "domain": "example.com",
+                "paths": ["/a"], "interval": 60, "colour": "blue"
+            }]""")
+
+    def test_users_without_password_envars_are_rejected(self):
+        with self.assertRaises(JobsFileException):
+            self.load(u"""[{
+                "name": "a", "data_source": "example", "domain": "example.com",
+                "paths": ["/a"], "interval": 60, "user": "someone"
+            }]""")
+
+    def test_non_positive_numbers_are_rejected(self):
+        for key, value in [("interval", u'"60"'), ("interval", u"0"),
+                           ("interval", u"true"), ("concurrency", u"-1"),
+                           ("full_export_every", u"null")]:
+            job = {u"name": u"a", u"data_source": u"example",
+                   u"domain": u"example.com", u"paths": [u"/a"],
+                   u"interval": 60}
+            job[key] = json.loads(value)
+            with self.assertRaises(JobsFileException):
+                self.load(json.dumps([job]).decode("utf-8"))
+
+    def test_duplicate_names_are_rejected(self):
+        job = u"""{
+            "name": "a", "data_source": "example", "domain": "example.com",
+            "paths": ["/a"], "interval": 60
+        }"""
+        with self.assertRaises(JobsFileException):
+            self.load(u"[{}, {}]".format(job, job))
+
+
+class FakeEntryPoint(object):
+    def __init__(self, factory):
+        self.factory = factory
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return self.factory
+
+
+class JobRunnerTest(unittest.TestCase):
+    def test_resources_are_shared_between_jobs(self):
+        entrypoint = FakeEntryPoint(lambda params: None)
+        runner = JobRunner(data_source_entrypoints={"example": entrypoint})
+
+        a = runner.create_auto_importer(make_job("a"))
+        b = runner.create_auto_importer(make_job("b"))
+
+        self.assertEqual(1, entrypoint.loads)
+        self.assertIs(a.get_session(), b.get_session())
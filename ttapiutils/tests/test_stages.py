@@ -0,0 +1,76 @@
+import contextlib
+import threading
+import unittest
+
+from ttapiutils.stages import NoSuchStageException, StageGraph
+
+
+class StageGraphTest(unittest.TestCase):
+    def create_stages(self, concurrency=1):
+        self.calls = []
+        self.calls_lock = threading.Lock()
+        stages = StageGraph(concurrency=concurrency)
+
+        def stage(name, value):
+            def func(*args):
+                with self.calls_lock:
+                    self.calls.append(name)
+                return value + sum(args)
+            return func
+
+        stages.add_stage("a", stage("a", 1))
+        stages.add_stage("b", stage("b", 10), ["a"])
+        stages.add_stage("c", stage("c", 100), ["a"])
+        stages.add_stage("d", stage("d", 1000), ["b", "c"])
+        return stages
+
+    def test_stages_are_computed_from_dependencies(self):
+        stages = self.create_stages()
+
+        self.assertEqual(1000 + 11 + 101, stages.get("d"))
+
+    def test_stages_are_computed_once(self):
+        for concurrency in [1, 2]:
+            stages = self.create_stages(concurrency=concurrency)
+
+            stages.get("d")
+            stages.get("b")
+
+            self.assertEqual(["a", "b", "c", "d"], sorted(self.calls))
+
+    def test_only_required_stages_are_computed(self):
+        stages = self.create_stages()
+
+        stages.get("b")
+
+        self.assertEqual(["a", "b"], self.calls)
+        self.assertFalse(stages.is_computed("c"))
+
+    def test_hooks_receive_each_result(self):
+        stages = self.create_stages()
+        results = []
+        stages.add_hook(lambda name, result: results.append((name, result)))
+
+        stages.get("d")
+
+        self.assertEqual([("a", 1), ("b", 11), ("c", 101), ("d", 1112)],
+                         sorted(results))
+
+    def test_unknown_stages_raise_exception(self):
+        with self.assertRaises(NoSuchStageException):
+            self.create_stages().get("e")
+
+    def test_stages_are_run_within_context(self):
+        entered = []
+
+        @contextlib.contextmanager
+        def context():
+            entered.append(threading.current_thread())
+            yield
+
+        stages = self.create_stages(concurrency=2)
+        stages.context = context
+
+        stages.get("d")
+
+        self.assertEqual(4, len(entered))
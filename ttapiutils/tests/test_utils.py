@@ -1,12 +1,52 @@
 # coding=utf-8
+from copy import deepcopy
+from io import BytesIO
+import random
 import unittest
 
 from lxml import etree
 
-from ttapiutils.utils import write_c14n_pretty
+from ttapiutils.tests.test_canonicalise import DELETEGEN_DATA_FILES
+from ttapiutils.tests.test_deletegen import TtapiutilsTestCaseMixin
+from ttapiutils.canonicalise import canonicalise
+from ttapiutils.merge import merge
+from ttapiutils.utils import (
+    assert_valid, forget_validation, get_validation_counts, is_marked_valid,
+    iter_modules, memoize, reset_validation_counts, scoped_validity_marks,
+    set_strict_validation, VALIDATED_TREES_MAX, write_c14n_pretty)
 
 
-class UtilsTest(unittest.TestCase):
+def reparse_c14n_pretty(xml):
+    """
+    The reference implementation of write_c14n_pretty(): pretty print,
+    re-parse and write the C14N serialisation.
+    """
+    out = BytesIO()
+    pretty_xml = etree.fromstring(
+        etree.tostring(xml, pretty_print=True, encoding="utf-8"))
+    pretty_xml.getroottree().write_c14n(out)
+    return out.getvalue()
+
+
+def random_tree(rand, depth=0):
+    element = etree.Element(rand.choice(["a", "b", u"ƒ"]))
+    if rand.random() < 0.3:
+        element.text = rand.choice(
+            [u"", u" ", u"text", u"a&b<c>d\r\ne\"'", u"ƒ˙¬", u"\n  ", u"]]>"])
+    if rand.random() < 0.1:
+        element.set(rand.choice(["x", "y"]), rand.choice(["", "a\tb\"<>&"]))
+    if rand.random() < 0.05:
+        element.append(etree.Comment(" comment "))
+    if depth < 5:
+        for _ in range(rand.randint(0, 3)):
+            child = random_tree(rand, depth + 1)
+            if rand.random() < 0.15:
+                child.tail = rand.choice([u"", u" ", u"tail", u"\n"])
+            element.append(child)
+    return element
+
+
+class UtilsTest(TtapiutilsTestCaseMixin, unittest.TestCase):
     def test_write_c14n_pretty_maintains_unicode(self):
         elem = etree.Element("foo")
         elem_text = u"ƒ˙¬˚ßå∆ƒ∆ß¬å"
@@ -15,3 +55,115 @@ class UtilsTest(unittest.TestCase):
         serialised = write_c14n_pretty(elem)
         self.assertEqual(
             u"<foo>{}</foo>".format(elem_text).encode("utf-8"), serialised)
+
+    def test_write_c14n_pretty_matches_reparsed_serialisation(self):
+        for name in DELETEGEN_DATA_FILES:
+            api_xml = self.get_xml_data(name)
+            self.assertEqual(reparse_c14n_pretty(api_xml),
+                             write_c14n_pretty(api_xml))
+
+    def test_write_c14n_pretty_matches_reparsed_serialisation_of_any_tree(self):
+        rand = random.Random(0)
+        for _ in range(500):
+            tree = random_tree(rand)
+            self.assertEqual(reparse_c14n_pretty(tree),
+                             write_c14n_pretty(tree))
+
+    def test_write_c14n_pretty_writes_to_file(self):
+        api_xml = self.get_xml_data("small.xml")
+        out = BytesIO()
+
+        write_c14n_pretty(api_xml, out)
+
+        self.assertEqual(write_c14n_pretty(api_xml), out.getvalue())
+
+    def test_memoize_calls_function_once(self):
+        calls = []
+
+        @memoize
+        def get_value():
+            calls.append(None)
+            return object()
+
+        self.assertEqual([], calls)
+        self.assertIs(get_value(), get_value())
+        self.assertEqual(1, len(calls))
+
+
+class ValidateOnceTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def setUp(self):
+        reset_validation_counts()
+
+    def tearDown(self):
+        set_strict_validation(False)
+        reset_validation_counts()
+
+    def test_parsed_trees_are_not_validated_again(self):
+        api_xml = self.get_xml_data("small.xml")
+        self.assertTrue(is_marked_valid(api_xml))
+
+        assert_valid(api_xml, stage="test")
+
+        self.assertEqual({"validated": 0, "skipped": 1},
+                         get_validation_counts()["test"])
+
+    def test_canonicalised_trees_are_marked_valid(self):
+        canonical_xml = canonicalise(self.get_xml_data("small.xml"))
+        self.assertTrue(is_marked_valid(canonical_xml))
+
+    def test_strict_validation_validates_marked_trees(self):
+        api_xml = self.get_xml_data("small.xml")
+        set_strict_validation(True)
+
+        assert_valid(api_xml, stage="test")
+
+        self.assertEqual({"validated": 1, "skipped": 0},
+                         get_validation_counts()["test"])
+
+    def test_forgotten_trees_are_validated(self):
+        api_xml = self.get_xml_data("small.xml")
+        api_xml.getroot().append(etree.Element("invalid"))
+        forget_validation(api_xml)
+
+        self.assertFalse(is_marked_valid(api_xml))
+        with self.assertRaises(etree.DocumentInvalid):
+            assert_valid(api_xml, stage="test")
+
+    def test_streamed_modules_do_not_evict_marked_trees(self):
+        api_xml = self.get_xml_data("small.xml")
+        module_list = etree.Element("moduleList")
+        module = api_xml.getroot().find("module")
+        module_list.extend(deepcopy(module)
+                           for _ in range(VALIDATED_TREES_MAX + 8))
+
+        for _ in iter_modules(BytesIO(etree.tostring(module_list))):
+            pass
+
+        self.assertEqual(VALIDATED_TREES_MAX + 8,
+                         get_validation_counts()["iter_modules"]["validated"])
+        self.assertTrue(is_marked_valid(api_xml))
+
+    def test_scoped_marks_are_held_by_their_scope(self):
+        marks = {}
+        with scoped_validity_marks(marks):
+            api_xml = self.get_xml_data("small.xml")
+            self.assertTrue(is_marked_valid(api_xml))
+
+        self.assertEqual([api_xml.getroot()], list(marks.values()))
+        self.assertFalse(is_marked_valid(api_xml))
+        with scoped_validity_marks(marks):
+            forget_validation(api_xml)
+        self.assertEqual({}, marks)
+
+    def test_merged_inputs_are_no_longer_marked_valid(self):
+        api_xml = self.get_xml_data("small.xml")
+
+        merged = merge([api_xml])
+
+        self.assertTrue(is_marked_valid(merged))
+        self.assertFalse(is_marked_valid(api_xml))
+
+    def test_copies_of_marked_trees_are_not_marked_valid(self):
+        api_xml = self.get_xml_data("small.xml")
+        self.assertFalse(is_marked_valid(etree.ElementTree(
+            etree.fromstring(etree.tostring(api_xml)))))
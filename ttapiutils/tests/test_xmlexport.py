@@ -0,0 +1,194 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import pkg_resources
+import requests
+from lxml import etree
+
+from ttapiutils.exportcache import ExportCache
+from ttapiutils.fixexport import fix_export_ids
+from ttapiutils.tests.test_deletegen import TtapiutilsTestCaseMixin
+from ttapiutils.utils import write_c14n_pretty
+from ttapiutils.xmlexport import (
+    build_api_export_url, xmlexport, xmlexport_paths, XMLParseExportException)
+
+
+class FakeResponse(object):
+    def __init__(self, content, status_code=requests.codes.ok, headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {} if headers is None else headers
+        self.closed = False
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+    """
+    A stand-in for a requests Session which serves (path, content) pairs,
+    responding to requests for earlier paths more slowly.
+    """
+    def __init__(self, files):
+        self.files = files
+        self.lock = threading.Lock()
+        self.requested = []
+
+    def get(self, url, auth=None, allow_redirects=True, stream=False,
+            headers=None):
+        with self.lock:
+            self.requested.append(url)
+        for (i, (path, content)) in enumerate(self.files):
+            if url == build_api_export_url("example.com", path):
+                time.sleep(0.01 * (len(self.files) - i))
+                return FakeResponse(content)
+        raise AssertionError("Unexpected URL: {}".format(url))
+
+
+class XmlexportPathsTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    files = [
+        ("/a", "small.xml"),
+        ("/b", "deleted_module_current.xml"),
+        ("/c", "deleted_series_current.xml")
+    ]
+
+    def assert_exports_in_path_order(self, concurrency):
+        session = FakeSession([
+            (path, pkg_resources.resource_string(
+                "ttapiutils.tests.test_deletegen",
+                "data/deletegen/{}".format(name)))
+            for (path, name) in self.files])
+
+        exports = xmlexport_paths(
+            "example.com", [path for (path, _) in self.files],
+            fix_ids=False, session=session, concurrency=concurrency)
+
+        self.assertEqual(len(self.files), len(session.requested))
+        self.assertEqual(len(self.files), len(exports))
+        for ((_, name), export) in zip(self.files, exports):
+            self.assert_api_xml_equal(self.get_xml_data(name), export)
+
+    def test_serial_exports_are_in_path_order(self):
+        self.assert_exports_in_path_order(concurrency=1)
+
+    def test_concurrent_exports_are_in_path_order(self):
+        self.assert_exports_in_path_order(concurrency=3)
+
+
+class XmlexportTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def get_export_data(self):
+        """
+        Get small.xml with event IDs prefixed as the API exports them.
+        """
+        api_xml = self.get_xml_data("small.xml")
+        for uniqueid in api_xml.xpath(
+                "/moduleList/module/series/event/uniqueid"):
+            uniqueid.text = "import-" + uniqueid.text
+        return write_c14n_pretty(api_xml)
+
+    def export(self, content, **kwargs):
+        session = FakeSession([("/a", content)])
+        return xmlexport("example.com", "/a", session=session, **kwargs)
+
+    def test_ids_are_fixed_during_parsing(self):
+        content = self.get_export_data()
+        expected = fix_export_ids(etree.ElementTree(etree.fromstring(content)))
+
+        self.assert_api_xml_equal(expected, self.export(content))
+        self.assertEqual(
+            write_c14n_pretty(expected),
+            write_c14n_pretty(self.export(content, fix_ids=True)))
+
+    def test_ids_are_not_fixed_without_fix_ids(self):
+        content = self.get_export_data()
+
+        exported = self.export(content, fix_ids=False)
+
+        self.assertEqual(content, write_c14n_pretty(exported))
+
+
+class ConditionalFakeSession(object):
+    """
+    A stand-in for a requests Session serving content with an ETag, which
+    responds with 304 Not Modified to conditional requests for it.
+    """
+    def __init__(self, content, etag=None):
+        self.content = content
+        self.etag = etag
+        self.statuses = []
+
+    def get(self, url, auth=None, allow_redirects=True, stream=False,
+            headers=None):
+        headers = {} if headers is None else headers
+        if self.etag is not None and headers.get("If-None-Match") == self.etag:
+            response = FakeResponse(b"", requests.codes.not_modified)
+        else:
+            response = FakeResponse(self.content, headers={"ETag": self.etag}
+                                    if self.etag is not None else {})
+        self.statuses.append(response.status_code)
+        return response
+
+
+class XmlexportCacheTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.content = write_c14n_pretty(self.get_xml_data("small.xml"))
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def export(self, session, cache):
+        return xmlexport("example.com", "/a", session=session, cache=cache)
+
+    def test_unmodified_exports_are_read_from_cache(self):
+        session = ConditionalFakeSession(self.content, etag='"v1"')
+
+        first = self.export(session, ExportCache(self.cache_dir))
+        cache = ExportCache(self.cache_dir)
+        second = self.export(session, cache)
+
+        self.assertEqual([200, 304], session.statuses)
+        self.assertEqual({"hits": 1, "misses": 0}, cache.get_stats())
+        self.assertEqual(write_c14n_pretty(first), write_c14n_pretty(second))
+
+    def test_modified_exports_are_downloaded(self):
+        self.export(ConditionalFakeSession(self.content, etag='"v1"'),
+                    ExportCache(self.cache_dir))
+        new_content = write_c14n_pretty(
+            self.get_xml_data("deleted_module_current.xml"))
+        session = ConditionalFakeSession(new_content, etag='"v2"')
+        cache = ExportCache(self.cache_dir)
+
+        exported = self.export(session, cache)
+
+        self.assertEqual([200], session.statuses)
+        self.assertEqual({"hits": 0, "misses": 1}, cache.get_stats())
+        self.assertEqual(new_content, write_c14n_pretty(exported))
+
+    def test_fresh_exports_are_used_without_a_request(self):
+        self.export(ConditionalFakeSession(self.content),
+                    ExportCache(self.cache_dir))
+        session = ConditionalFakeSession(self.content)
+        cache = ExportCache(self.cache_dir, max_age=60)
+
+        exported = self.export(session, cache)
+
+        self.assertEqual([], session.statuses)
+        self.assertEqual({"hits": 1, "misses": 0}, cache.get_stats())
+        self.assertEqual(self.content, write_c14n_pretty(exported))
+
+    def test_invalid_exports_are_not_cached(self):
+        cache = ExportCache(self.cache_dir)
+        with self.assertRaises(XMLParseExportException):
+            self.export(ConditionalFakeSession(b"<moduleList/>", etag='"v1"'),
+                        cache)
+
+        self.assertIsNone(cache.lookup(
+            build_api_export_url("example.com", "/a")))
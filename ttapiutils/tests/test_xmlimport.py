@@ -0,0 +1,218 @@
+from io import BytesIO
+import gzip
+import threading
+import unittest
+
+from lxml import etree
+import pkg_resources
+import requests
+
+from ttapiutils.tests.test_deletegen import TtapiutilsTestCaseMixin
+from ttapiutils.utils import parse_xml
+from ttapiutils.xmlimport import (
+    BatchImportError, ImportClient, ImportError, split_module_list,
+    UnexpectedPathException, xmlimport_batched)
+
+
+class FakeImportResponse(object):
+    def __init__(self, status_code, request=None, csrf_token="token"):
+        self.status_code = status_code
+        self.reason = "Fake"
+        self.request = request
+        self.cookies = {"csrftoken": csrf_token}
+        self.headers = {}
+        self.content = ""
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+
+class FakeImportSession(object):
+    """
+    A stand-in for a requests Session which accepts imports, except the
+    first attempt to import modules named in fail_once.
+    """
+    def __init__(self, fail_once=()):
+        self.fail_once = set(fail_once)
+        self.csrf_token = "token"
+        self.lock = threading.Lock()
+        self.csrf_token_requests = 0
+        self.imported = []
+
+    def get(self, url, auth=None, allow_redirects=True):
+        with self.lock:
+            self.csrf_token_requests += 1
+            return FakeImportResponse(requests.codes.ok,
+                                      csrf_token=self.csrf_token)
+
+    def send(self, request, allow_redirects=True):
+        body = read_body(request)
+        with self.lock:
+            if self.csrf_token not in body:
+                return FakeImportResponse(requests.codes.forbidden, request)
+            names = [name for name in self.fail_once if name in body]
+            if names:
+                self.fail_once.difference_update(names)
+                return FakeImportResponse(500, request)
+            self.imported.append(request)
+        return FakeImportResponse(requests.codes.ok, request)
+
+
+def read_body(request):
+    request.body.seek(0)
+    body = request.body.read()
+    if request.headers.get("Content-Encoding") == "gzip":
+        body = gzip.GzipFile(fileobj=BytesIO(body)).read()
+    return body.decode("utf-8")
+
+
+def module_names(api_xml):
+    return api_xml.xpath("/moduleList/module/name/text()")
+
+
+class XmlimportBatchedTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def test_batches_are_limited_by_module_count(self):
+        api_xml = self.get_xml_data("deleted_module_current.xml")
+
+        batches = split_module_list(api_xml, max_modules=1)
+
+        self.assertTrue(all(len(batch) == 1 for batch in batches))
+        self.assertEqual(module_names(api_xml),
+                         [name for batch in batches
+                          for name in module_names(batch)])
+
+    def test_batches_are_limited_by_size(self):
+        api_xml = self.get_xml_data("deleted_module_current.xml")
+        sizes = [len(etree.tostring(module, encoding="utf-8"))
+                 for module in api_xml.xpath("/moduleList/module")]
+
+        batches = split_module_list(api_xml, max_bytes=max(sizes))
+
+        self.assertEqual(len(sizes), len(batches))
+        self.assertEqual(1, len(split_module_list(api_xml,
+                                                  max_bytes=sum(sizes))))
+
+    def test_only_failed_batches_are_retried(self):
+        api_xml = self.get_xml_data("deleted_module_current.xml")
+        names = module_names(api_xml)
+        session = FakeImportSession(fail_once=names[:1])
+
+        results = xmlimport_batched(api_xml, "example.com", max_modules=1,
+                                    retries=1, session=session,
+                                    concurrency=2)
+
+        self.assertEqual([2] + [1] * (len(names) - 1),
+                         [result.attempts for result in results])
+        self.assertEqual(len(names), len(session.imported))
+
+    def test_failures_after_retries_raise_exception(self):
+        api_xml = self.get_xml_data("deleted_module_current.xml")
+        session = FakeImportSession(fail_once=module_names(api_xml)[:1])
+
+        with self.assertRaises(BatchImportError) as cm:
+            xmlimport_batched(api_xml, "example.com", max_modules=1,
+                              retries=0, session=session)
+
+        results = cm.exception.args[1]
+        self.assertEqual([False] + [True] * (len(results) - 1),
+                         [result.succeeded for result in results])
+
+    def test_every_batch_must_only_affect_paths(self):
+        api_xml = self.get_xml_data("deleted_module_current.xml")
+        api_xml.xpath("/moduleList/module/path/tripos")[-1].text = "bar"
+        session = FakeImportSession()
+        paths = ["/tripos/foo/I"]
+
+        with self.assertRaises(UnexpectedPathException):
+            xmlimport_batched(api_xml, "example.com", paths=paths,
+                              max_modules=1, session=session)
+        self.assertEqual([], session.imported)
+
+
+class ImportClientTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def test_csrf_token_is_reused(self):
+        session = FakeImportSession()
+        client = ImportClient("example.com", session=session)
+
+        for _ in range(3):
+            client.import_xml(self.get_xml_data("small.xml"))
+
+        self.assertEqual(1, session.csrf_token_requests)
+        self.assertEqual(3, len(session.imported))
+
+    def test_rejected_csrf_token_is_refreshed_once(self):
+        session = FakeImportSession()
+        client = ImportClient("example.com", session=session)
+        client.import_xml(self.get_xml_data("small.xml"))
+        session.csrf_token = "new-token"
+
+        request, response = client.import_xml(self.get_xml_data("small.xml"))
+
+        self.assertEqual(requests.codes.ok, response.status_code)
+        self.assertIn("new-token", read_body(request))
+        self.assertEqual(2, session.csrf_token_requests)
+
+    def test_repeated_rejections_raise_exception(self):
+        session = FakeImportSession()
+        session.send = lambda request, allow_redirects=True: (
+            FakeImportResponse(requests.codes.forbidden, request))
+        client = ImportClient("example.com", session=session)
+
+        with self.assertRaises(ImportError):
+            client.import_xml(self.get_xml_data("small.xml"))
+        self.assertEqual(2, session.csrf_token_requests)
+
+
+def parse_form(request):
+    """
+    Parse the multipart/form-data body of request into a dict of fields.
+    """
+    content_type = request.headers["Content-Type"]
+    boundary = content_type.split("boundary=")[1]
+    fields = {}
+    for part in read_body(request).split("--" + boundary)[1:-1]:
+        headers, value = part.split("\r\n\r\n", 1)
+        name = headers.split('name="')[1].split('"')[0]
+        fields[name] = value[:-len("\r\n")]
+    return fields
+
+
+class ImportRequestBodyTest(TtapiutilsTestCaseMixin, unittest.TestCase):
+    def assert_form_contains(self, request, api_xml):
+        fields = parse_form(request)
+        self.assertEqual("token", fields["csrfmiddlewaretoken"])
+        self.assert_api_xml_equal(
+            api_xml, parse_xml(BytesIO(fields["file"].encode("utf-8"))))
+
+    def test_form_contains_token_and_xml(self):
+        api_xml = self.get_xml_data("small.xml")
+        client = ImportClient("example.com", session=FakeImportSession())
+
+        request, _ = client.import_xml(api_xml, dry_run=True)
+
+        self.assert_form_contains(request, api_xml)
+        self.assertEqual(str(len(read_body(request).encode("utf-8"))),
+                         request.headers["Content-Length"])
+
+    def test_gzip_encoded_form_contains_token_and_xml(self):
+        api_xml = self.get_xml_data("small.xml")
+        client = ImportClient("example.com", session=FakeImportSession(),
+                              use_gzip=True)
+
+        request, _ = client.import_xml(api_xml, dry_run=True)
+
+        self.assertEqual("gzip", request.headers["Content-Encoding"])
+        self.assert_form_contains(request, api_xml)
+
+    def test_xml_file_is_sent_as_it_is(self):
+        filename = pkg_resources.resource_filename(
+            "ttapiutils.tests.test_deletegen", "data/deletegen/small.xml")
+        client = ImportClient("example.com", session=FakeImportSession())
+
+        request, _ = client.import_xml(self.get_xml_data("small.xml"),
+                                       dry_run=True, api_xml_file=filename)
+
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read().decode("utf-8"),
+                             parse_form(request)["file"])
@@ -1,13 +1,19 @@
 from __future__ import print_function, unicode_literals
 
+from collections import Counter, defaultdict, OrderedDict
+import contextlib
 from cStringIO import StringIO
+from io import BytesIO
 import datetime
+import functools
 import getpass
 import json
 import os
+import re
+import shutil
+import threading
 
 from lxml import etree
-from requests.auth import HTTPBasicAuth
 import pkg_resources
 import pytz
 
@@ -18,40 +24,321 @@ class TimetableApiUtilsException(Exception):
     """
 
 
-def _get_api_xml_schema():
+class StreamParseException(TimetableApiUtilsException):
+    pass
+
+
+def memoize(func):
+    """
+    Decorate a function taking no arguments so that it's only called once,
+    the first time its value is needed. Subsequent calls return the same
+    value.
+    """
+    result = []
+
+    @functools.wraps(func)
+    def memoized():
+        if not result:
+            result.append(func())
+        return result[0]
+    return memoized
+
+
+@memoize
+def get_api_schema():
     schema_xsl = pkg_resources.resource_stream(
         "ttapiutils.utils", "data/schema.xsd")
     return etree.XMLSchema(etree.parse(schema_xsl))
 
 
-API_SCHEMA = _get_api_xml_schema()
+# Validation provenance. Trees which have been validated, or produced from
+# valid trees by schema-preserving transformations, are remembered so
+# that they needn't be validated again. Their root elements are held in an
+# LRU dict keyed on the element's id(); holding the element keeps its id
+# from being reused. Long-running users can hold the trees they mark in
+# their own dict instead with scoped_validity_marks().
+VALIDATED_TREES_MAX = 32
+_validated_trees = OrderedDict()
+_validated_trees_lock = threading.Lock()
+_thread_validity_marks = threading.local()
+_validation_counts = defaultdict(Counter)
+# Counters recording the validations of the current thread, in addition to
+# _validation_counts
+_thread_validation_counts = threading.local()
+_strict_validation = [bool(os.environ.get("TTAPIUTILS_STRICT_VALIDATION"))]
+
+
+def _get_root_element(api_xml):
+    if isinstance(api_xml, etree._ElementTree):
+        return api_xml.getroot()
+    return api_xml
+
+
+def _get_scoped_marks():
+    stack = getattr(_thread_validity_marks, "stack", None)
+    return stack[-1] if stack else None
+
+
+@contextlib.contextmanager
+def scoped_validity_marks(marks):
+    """
+    Hold the trees marked valid by the current thread within the with block
+    in marks, a dict, instead of the process-wide LRU. The trees are then
+    only known to be valid within blocks using marks, and are released
+    along with marks rather than being kept alive by the LRU.
+    """
+    stack = getattr(_thread_validity_marks, "stack", None)
+    if stack is None:
+        stack = _thread_validity_marks.stack = []
+    stack.append(marks)
+    try:
+        yield marks
+    finally:
+        stack.pop()
+
+
+def mark_valid(api_xml):
+    """
+    Record that api_xml is known to be valid, so that assert_valid() can
+    skip validating it.
+
+    Only call this for trees which have been validated, or produced by a
+    transformation which preserves validity from a valid tree.
+    """
+    root = _get_root_element(api_xml)
+    marks = _get_scoped_marks()
+    with _validated_trees_lock:
+        if marks is not None:
+            marks[id(root)] = root
+            return
+        _validated_trees.pop(id(root), None)
+        _validated_trees[id(root)] = root
+        while len(_validated_trees) > VALIDATED_TREES_MAX:
+            _validated_trees.popitem(last=False)
+
+
+def is_marked_valid(api_xml):
+    root = _get_root_element(api_xml)
+    marks = _get_scoped_marks()
+    with _validated_trees_lock:
+        return (_validated_trees.get(id(root)) is root or
+                (marks is not None and marks.get(id(root)) is root))
+
+
+def forget_validation(api_xml):
+    """
+    Forget that api_xml is valid. This must be called after modifying a
+    tree in a way which could make it invalid.
+    """
+    root = _get_root_element(api_xml)
+    marks = _get_scoped_marks()
+    with _validated_trees_lock:
+        for trees in [_validated_trees, marks]:
+            if trees is not None and trees.get(id(root)) is root:
+                del trees[id(root)]
+
+
+def set_strict_validation(strict):
+    """
+    Enable or disable strict validation. When enabled, assert_valid()
+    always validates, even if a tree is known to be valid. It's enabled by
+    default if the TTAPIUTILS_STRICT_VALIDATION envar is set.
+    """
+    _strict_validation[0] = bool(strict)
+
+
+def get_validation_counts(validation_counts=None):
+    """
+    Get a dict mapping each stage passed to assert_valid() to a dict of the
+    number of trees "validated" and "skipped" at that stage.
+
+    The counts of the whole process are used unless validation_counts, a
+    defaultdict(Counter) passed to recording_validation_counts(), is
+    provided.
+    """
+    if validation_counts is None:
+        validation_counts = _validation_counts
+    with _validated_trees_lock:
+        return dict((stage, dict(validated=counts["validated"],
+                                 skipped=counts["skipped"]))
+                    for (stage, counts) in validation_counts.items())
+
+
+def reset_validation_counts():
+    _validation_counts.clear()
 
 
-def assert_valid(api_xml):
-    API_SCHEMA.assertValid(api_xml)
+@contextlib.contextmanager
+def recording_validation_counts(validation_counts):
+    """
+    Also count the validations made by the current thread in the with block
+    in validation_counts, a defaultdict(Counter). Unlike the process-wide
+    counts, these exclude validations made by other threads.
+    """
+    stack = getattr(_thread_validation_counts, "stack", None)
+    if stack is None:
+        stack = _thread_validation_counts.stack = []
+    stack.append(validation_counts)
+    try:
+        yield validation_counts
+    finally:
+        stack.pop()
+
+
+def _count_validation(stage, outcome):
+    stack = getattr(_thread_validation_counts, "stack", [])
+    # Nested blocks may record to the same counts
+    counters = dict((id(counts), counts) for counts in stack)
+    with _validated_trees_lock:
+        _validation_counts[stage][outcome] += 1
+        for counts in counters.values():
+            counts[stage][outcome] += 1
+
+
+def assert_valid(api_xml, stage="unknown", remember=True):
+    """
+    Raise etree.DocumentInvalid if api_xml is not valid Timetable API XML.
+
+    Validation is skipped if api_xml is known to be valid, unless strict
+    validation is enabled. stage identifies the caller in the counts
+    returned by get_validation_counts(). If remember is False a valid
+    api_xml isn't marked valid, which avoids evicting other trees when
+    validating many short-lived trees.
+    """
+    if not _strict_validation[0] and is_marked_valid(api_xml):
+        _count_validation(stage, "skipped")
+        return
+
+    get_api_schema().assertValid(api_xml)
+    _count_validation(stage, "validated")
+    if remember:
+        mark_valid(api_xml)
 
 
 def parse_xml(file):
     xml = etree.parse(file, _parser)
-    assert_valid(xml)
+    assert_valid(xml, stage="parse_xml")
     return xml
 _parser = etree.XMLParser(remove_blank_text=True)
 
 
+def parse_xml_chunks(chunks, tag=None, on_end=None):
+    """
+    Parse and validate XML from an iterable of byte strings, parsing each
+    chunk as soon as it's produced rather than buffering the whole
+    document.
+
+    If on_end is provided it's called with each element with the tag tag as
+    soon as the element's end tag has been parsed, and may modify it.
+    """
+    if on_end is None:
+        parser = etree.XMLParser(remove_blank_text=True)
+    else:
+        parser = etree.XMLPullParser(events=("end",), tag=tag,
+                                     remove_blank_text=True)
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        if on_end is not None:
+            for (_, element) in parser.read_events():
+                on_end(element)
+
+    xml = parser.close().getroottree()
+    assert_valid(xml, stage="parse_xml_chunks")
+    return xml
+
+
+def iter_modules(file, validate=True):
+    """
+    Incrementally parse a moduleList from file, yielding each module as
+    soon as it has been parsed.
+
+    Only a single module is held in memory at a time (as long as the
+    caller doesn't keep hold of them). Each module is yielded as the only
+    child of a new moduleList element, which is validated unless validate
+    is False. The moduleLists aren't marked valid, as there's one per
+    module and they'd evict other trees from the validation cache. If
+    validate is True, etree.DocumentInvalid is raised for documents
+    without any modules.
+    """
+    modules = etree.iterparse(file, events=("end",), tag="module",
+                              remove_blank_text=True)
+    module_count = 0
+    for (_, module) in modules:
+        module_list = module.getparent()
+        if (module_list is None or module_list.tag != "moduleList" or
+                module_list.getparent() is not None):
+            raise StreamParseException(
+                "Encountered a module which is not a child of a root "
+                "moduleList element")
+
+        # Detach the module from the document being parsed so that the
+        # document doesn't grow as modules are parsed.
+        wrapper = etree.Element("moduleList")
+        wrapper.append(module)
+        if validate:
+            assert_valid(wrapper, stage="iter_modules", remember=False)
+        module_count += 1
+        yield module
+
+    if validate and module_count == 0:
+        # A document without modules is invalid, but there were no modules
+        # to find that out by validating.
+        assert_valid(modules.root, stage="iter_modules", remember=False)
+
+
+# The pretty-printed serialisation of a tree without attributes, namespace
+# declarations, comments, PIs, CDATA sections, DOCTYPEs or entity
+# references can be converted to its C14N form without re-parsing it.
+# Attributes and namespace declarations are detected by =" which is
+# conservative, as it may also occur in text.
+_C14N_UNSAFE_SUBSTRINGS = [b'="', b"<!", b"<?"]
+_C14N_UNSAFE_ENTITY = re.compile(br"&(?!amp;|lt;|gt;|#13;)")
+_SELF_CLOSING_TAG = re.compile(br"<([^\s<>/!?]+)/>")
+
+
+def _is_c14n_safe(pretty_xml):
+    return not (
+        any(unsafe in pretty_xml for unsafe in _C14N_UNSAFE_SUBSTRINGS) or
+        _C14N_UNSAFE_ENTITY.search(pretty_xml))
+
+
+def _pretty_to_c14n(pretty_xml):
+    """
+    Convert the pretty-printed serialisation of a tree without any of the
+    constructs excluded by _is_c14n_safe() to its C14N serialisation.
+
+    In that case the only differences are self-closing tags, the escaping
+    of carriage returns and the trailing newline.
+    """
+    c14n = _SELF_CLOSING_TAG.sub(br"<\1></\1>", pretty_xml)
+    if b"&#13;" in c14n:
+        c14n = c14n.replace(b"&#13;", b"&#xD;")
+    return c14n[:-1] if c14n.endswith(b"\n") else c14n
+
 
 def write_c14n_pretty(xml, file=None):
     """
     Insert indentation into xml before writing to file using
     write_c14n().
+
+    The tree is only serialised once; the result is identical to
+    re-parsing the pretty-printed serialisation and writing it with
+    write_c14n().
     """
-    out = StringIO() if file is None else file
+    pretty_xml = etree.tostring(xml, pretty_print=True, encoding="utf-8",
+                                with_tail=False)
 
-    pretty_xml = etree.fromstring(
-        etree.tostring(xml, pretty_print=True, encoding="utf-8"))
-    pretty_xml.getroottree().write_c14n(out)
+    if _is_c14n_safe(pretty_xml):
+        c14n = _pretty_to_c14n(pretty_xml)
+    else:
+        out = BytesIO()
+        etree.fromstring(pretty_xml).getroottree().write_c14n(out)
+        c14n = out.getvalue()
 
     if file is None:
-        return out.getvalue()
+        return c14n
+    file.write(c14n)
 
 
 def read_password(envar):
@@ -63,6 +350,9 @@ def read_password(envar):
 def get_credentials(args):
     user = args.get("--user")
     if user:
+        # Imported here as requests is slow to import and most commands
+        # don't need it.
+        from requests.auth import HTTPBasicAuth
         return HTTPBasicAuth(user, read_password(args.get("--pass-envar")))
     return None
 
@@ -71,6 +361,39 @@ def get_proto(args):
     return "http" if args.get("--no-https") else "https"
 
 
+def create_session(pool_size=10):
+    """
+    Create a requests Session which keeps up to pool_size connections
+    open to each host, so that concurrent requests can reuse them.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def map_concurrently(func, items, concurrency=1):
+    """
+    As map(func, items), but with up to concurrency calls of func made at
+    once in separate threads. The results are in the order of items.
+    """
+    items = list(items)
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(concurrency, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def _serialise_headers(headers, file):
     headers = "\n".join("{}: {}".format(k, v)
                         for (k, v) in headers.items())
@@ -89,7 +412,12 @@ def serialise_http_request(p, file=None):
     print("{} {}".format(p.method, p.url), file=out)
     _serialise_headers(p.headers, out)
     print(file=out)
-    print(p.body, file=out, end="")
+    if hasattr(p.body, "read"):
+        # Stream file bodies rather than reading them into memory
+        p.body.seek(0)
+        shutil.copyfileobj(p.body, out)
+    else:
+        print(p.body, file=out, end="")
 
     if file is None:
         return out.getvalue()
@@ -147,6 +475,9 @@ class DirectoryAuditLogger(object):
             write_c14n_pretty(xml, f)
         return xml
 
+    def get_audit_file_size(self, filename):
+        return os.path.getsize(os.path.join(self.get_audit_dir(), filename))
+
     def log_json(self, name, obj):
         with self.open_audit_file("{}.json".format(name)) as f:
             json.dump(obj, f, indent=4)
@@ -25,10 +25,20 @@ options:
     --no-fix-ids
         Don't fix event IDs
 
+    --concurrency=<n>
+        The maximum number of <path>s to export at once [default: 4].
+
+    --cache-dir=<dir>
+        Cache exports in <dir>, and only download exports again if they've
+        changed since they were cached.
+
+    --cache-max-age=<seconds>
+        Use exports cached less than <seconds> ago without checking if
+        they've changed.
+
     -h, --help
         Show this help message
 """
-from cStringIO import StringIO
 import sys
 import urlparse
 
@@ -37,11 +47,12 @@ from requests.exceptions import RequestException
 import docopt
 import requests
 
+from ttapiutils.exportcache import ExportCache
 from ttapiutils.merge import merge
-from ttapiutils.fixexport import fix_export_ids
+from ttapiutils.fixexport import fix_event_uniqueid
 from ttapiutils.utils import (
-    write_c14n_pretty, parse_xml, assert_valid, read_password,
-    get_credentials, get_proto)
+    write_c14n_pretty, parse_xml_chunks, read_password, get_credentials,
+    get_proto, create_session, map_concurrently)
 
 
 class ExportException(Exception):
@@ -61,31 +72,106 @@ def build_api_export_url(domain, path, proto="https"):
     return urlparse.urlunparse((proto, domain, full_path, None, None, None))
 
 
-def xmlexport(domain, path, auth=None, proto="https", fix_ids=True):
+# The size of the pieces of the response body fed to the parser
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+
+def _parse_export(chunks, fix_ids):
+    return parse_xml_chunks(chunks, tag="uniqueid",
+                            on_end=fix_event_uniqueid if fix_ids else None)
+
+
+def _parse_cached_export(entry, fix_ids):
+    with entry.open_body() as f:
+        return _parse_export(
+            iter(lambda: f.read(RESPONSE_CHUNK_SIZE), b""), fix_ids)
+
+
+def xmlexport(domain, path, auth=None, proto="https", fix_ids=True,
+              session=None, cache=None):
+    """
+    Export the XML of path from domain. The request is made with session
+    if provided, allowing its connections to be reused.
+
+    The response is parsed as it's received. If fix_ids is True event IDs
+    are fixed (as by ttapiutils fixexport) during parsing.
+
+    If an ExportCache is provided, a cached export is used if it's fresh or
+    the server reports that it's not modified, otherwise the response is
+    cached.
+    """
     url = build_api_export_url(domain, path, proto=proto)
+    http = requests if session is None else session
+
+    entry = None if cache is None else cache.lookup(url)
+    if entry is not None and cache.is_fresh(entry):
+        cache.record_hit()
+        return _parse_cached_export(entry, fix_ids)
+
+    headers = {} if entry is None else cache.get_conditional_headers(entry)
     try:
-        response = requests.get(url, auth=auth, allow_redirects=False)
+        response = http.get(url, auth=auth, allow_redirects=False,
+                            stream=True, headers=headers)
+    except RequestException as e:
+        raise HttpRequestExportException("Error requesting timetable: {}. {}"
+                                         .format(url, e))
+
+    try:
+        if (entry is not None and
+                response.status_code == requests.codes.not_modified):
+            cache.refresh(entry, response.headers)
+            cache.record_hit()
+            return _parse_cached_export(entry, fix_ids)
+
         if response.status_code != requests.codes.ok:
             response.raise_for_status()
             raise HttpRequestExportException(
                 "Non-200 response received to request for: {}. {}".format(
                     url, response.status_code))
+
+        chunks = response.iter_content(RESPONSE_CHUNK_SIZE)
+        if cache is None:
+            return _parse_export(chunks, fix_ids)
+
+        cache.record_miss()
+        with cache.writer(url, response.headers) as writer:
+            return _parse_export(writer.tee(chunks), fix_ids)
     except RequestException as e:
         raise HttpRequestExportException("Error requesting timetable: {}. {}"
                                          .format(url, e))
-
-    try:
-        xml = parse_xml(StringIO(response.content))
     except etree.Error as e:
         raise XMLParseExportException(
             "Unable to parse response as XML: {}".format(e), e, response)
+    finally:
+        response.close()
+
+
+def xmlexport_paths(domain, paths, auth=None, proto="https", fix_ids=True,
+                    session=None, concurrency=1, cache=None):
+    """
+    Export each of paths from domain, with up to concurrency exports in
+    progress at once. The exports are returned in the order of paths.
+    """
+    if session is None:
+        session = create_session(pool_size=max(concurrency, 1))
+
+    def export(path):
+        return xmlexport(domain, path, auth=auth, proto=proto,
+                         fix_ids=fix_ids, session=session, cache=cache)
 
-    assert_valid(xml)
+    return map_concurrently(export, paths, concurrency=concurrency)
 
-    if fix_ids:
-        xml = fix_export_ids(xml)
 
-    return xml
+def get_export_cache(args):
+    """
+    Get the ExportCache specified by the --cache-dir and --cache-max-age
+    options, or None if there isn't one.
+    """
+    if not args.get("--cache-dir"):
+        return None
+    max_age = args.get("--cache-max-age")
+    return ExportCache(args["--cache-dir"],
+                       max_age=None if max_age is None else float(max_age))
 
 
 def main(argv):
@@ -96,9 +182,11 @@ def main(argv):
     domain = args["<domain>"]
     paths = args["<path>"]
     fix_ids = not args.get("--no-fix-ids")
+    cache = get_export_cache(args)
 
-    exports = [xmlexport(domain, path, auth=credentials, proto=proto,
-                         fix_ids=fix_ids)
-               for path in paths]
+    exports = xmlexport_paths(domain, paths, auth=credentials, proto=proto,
+                              fix_ids=fix_ids,
+                              concurrency=int(args["--concurrency"]),
+                              cache=cache)
 
     write_c14n_pretty(merge(exports), sys.stdout)
@@ -41,13 +41,38 @@ options:
         Do everything except actually send the POST with the API XML. The
         HTTP request that would be made is sent to stdout
 
+    --batch-modules=<n>
+        Import the modules in batches of at most <n> modules, with a
+        separate request for each batch.
+
+    --batch-bytes=<n>
+        Import the modules in batches of at most <n> bytes of serialised
+        XML (or a single module, if it's larger than <n>).
+
+    --concurrency=<n>
+        The maximum number of batches to import at once [default: 1].
+
+    --retries=<n>
+        The number of times to retry importing batches which fail
+        [default: 2].
+
+    --gzip
+        Compress the upload with gzip Content-Encoding. Only use this if
+        the server accepts gzip encoded requests.
+
     -v, --verbose
         Be more verbose.
 """
 from __future__ import unicode_literals, print_function
 
+from copy import deepcopy
+import gzip
+import shutil
 import sys
+import tempfile
+import threading
 import urlparse
+import uuid
 
 from lxml import etree
 from requests.exceptions import RequestException
@@ -56,7 +81,8 @@ import requests
 
 from ttapiutils.utils import (
     parse_xml, read_password, get_credentials, get_proto, assert_valid,
-    TimetableApiUtilsException, serialise_http_request)
+    TimetableApiUtilsException, serialise_http_request, create_session,
+    map_concurrently)
 
 
 # The field name of the XML file in the multipart POST payload to /api/v0/xmlimport
@@ -71,21 +97,31 @@ class ImportError(TimetableApiUtilsException):
     pass
 
 
+class BatchImportError(ImportError):
+    pass
+
+
 def build_api_import_url(domain, proto="https"):
     return urlparse.urlunparse(
         (proto, domain, "/api/v0/xmlimport/", None, None, None))
 
 
+def get_timetable_path(path_elem):
+    """
+    Get the timetable path, e.g. /tripos/engineering/IA, of a module's path
+    element.
+    """
+    return "/tripos/" + "/".join(filter(bool, [
+        path_elem.xpath("string(tripos)"),
+        path_elem.xpath("string(part)"),
+        path_elem.xpath("string(subject)")
+    ]))
+
+
 def ensure_xml_only_affects_paths(api_xml, paths):
     path_elements = api_xml.xpath("/moduleList/module/path")
     affected_paths = set(
-        "/tripos/" + "/".join(filter(bool, [
-            path_elem.xpath("string(tripos)"),
-            path_elem.xpath("string(part)"),
-            path_elem.xpath("string(subject)")
-        ]))
-        for path_elem in path_elements
-    )
+        get_timetable_path(path_elem) for path_elem in path_elements)
     expected_paths = set(paths)
 
     if not affected_paths.issubset(expected_paths):
@@ -96,10 +132,11 @@ def ensure_xml_only_affects_paths(api_xml, paths):
             .format(paths_repr))
 
 
-def get_csrf_token(url, auth=None):
+def get_csrf_token(url, auth=None, session=None):
+    http = requests if session is None else session
     response = None
     try:
-        response = requests.get(url, auth=auth, allow_redirects=False)
+        response = http.get(url, auth=auth, allow_redirects=False)
         if response.status_code != requests.codes.ok:
             response.raise_for_status()
             raise ImportError("Non-200 status code received to request for: "
@@ -114,59 +151,269 @@ def get_csrf_token(url, auth=None):
             .format(url), response, e)
 
 
-def xmlimport(api_xml, domain, paths=None, proto="https", auth=None,
-              dry_run=False):
+def write_multipart_form(out, boundary, csrf_token, api_xml,
+                         api_xml_file=None):
     """
-    Make an import request to the Timetable API with the provided xml.
-
-    Returns a tuple of (request, response). If dry_run is True response will
-    be None as no request will be made.
+    Write the multipart/form-data body of an import request to the file
+    out, serialising api_xml directly into it (or copying the content of
+    the file at the path api_xml_file).
     """
-    if paths is not None:
-        ensure_xml_only_affects_paths(api_xml, paths)
+    boundary = boundary.encode("ascii")
+    out.write(b"--" + boundary + b"\r\n")
+    out.write(b'Content-Disposition: form-data; '
+              b'name="csrfmiddlewaretoken"\r\n\r\n')
+    out.write(csrf_token.encode("utf-8") + b"\r\n")
+
+    out.write(b"--" + boundary + b"\r\n")
+    out.write('Content-Disposition: form-data; name="{}"; '
+              'filename="timetable.xml"\r\n'.format(FORM_FILE_FIELD)
+              .encode("ascii"))
+    out.write(b"Content-Type: application/xml\r\n\r\n")
+    if api_xml_file is None:
+        if isinstance(api_xml, etree._ElementTree):
+            api_xml = api_xml.getroot()
+        with etree.xmlfile(out, encoding="utf-8") as xf:
+            xf.write(api_xml)
+    else:
+        with open(api_xml_file, "rb") as f:
+            shutil.copyfileobj(f, out)
+    out.write(b"\r\n--" + boundary + b"--\r\n")
+
+
+class ImportClient(object):
+    """
+    Makes import requests to the Timetable API on domain over a single
+    session.
 
-    url = build_api_import_url(domain, proto=proto)
+    The CSRF token required by the import endpoint is fetched when it's
+    first needed and reused by later imports. If an import is rejected with
+    403 Forbidden (as happens when the token expires) the token is fetched
+    again and the import retried once.
 
-    # The endpoint has CSRF protection via a CSRF token in a cookie. To avoid
-    # being killed by it, we need to obtain the CSRF token by GETting the
-    # page before trying to POST
-    csrf_token = get_csrf_token(url, auth=auth)
-    cookies = {"csrftoken": csrf_token}
-    data = {"csrfmiddlewaretoken": csrf_token}
-    headers = {"Referer": url}
+    Request bodies are streamed from temporary files, and are gzip encoded
+    if use_gzip is True.
+    """
+    def __init__(self, domain, proto="https", auth=None, session=None,
+                 use_gzip=False):
+        self.domain = domain
+        self.proto = proto
+        self.auth = auth
+        self.use_gzip = use_gzip
+        self.session = requests.Session() if session is None else session
+        self.url = build_api_import_url(domain, proto=proto)
+        self._csrf_token = None
+        self._csrf_token_lock = threading.Lock()
+
+    def get_csrf_token(self, stale_token=None):
+        """
+        Get the CSRF token, fetching it if it's not been fetched yet, or if
+        it's stale_token.
+        """
+        with self._csrf_token_lock:
+            if self._csrf_token is None or self._csrf_token == stale_token:
+                self._csrf_token = get_csrf_token(
+                    self.url, auth=self.auth, session=self.session)
+            return self._csrf_token
+
+    def prepare_request(self, api_xml, csrf_token, api_xml_file=None):
+        """
+        Prepare the POST of api_xml in a multi-part form. The body is a
+        temporary file, which is deleted when the request is garbage
+        collected. If api_xml_file is provided, its content is sent as the
+        XML rather than serialising api_xml.
+        """
+        boundary = uuid.uuid4().hex
+        body = tempfile.TemporaryFile()
+        if self.use_gzip:
+            with gzip.GzipFile(fileobj=body, mode="wb") as out:
+                write_multipart_form(out, boundary, csrf_token, api_xml,
+                                     api_xml_file)
+        else:
+            write_multipart_form(body, boundary, csrf_token, api_xml,
+                                 api_xml_file)
+        body.seek(0)
+
+        headers = {
+            "Referer": self.url,
+            "Content-Type": "multipart/form-data; boundary={}".format(
+                boundary)
+        }
+        if self.use_gzip:
+            headers["Content-Encoding"] = "gzip"
+
+        return requests.Request(
+            b"POST", self.url, data=body, headers=headers,
+            cookies={"csrftoken": csrf_token}, auth=self.auth).prepare()
+
+    def import_xml(self, api_xml, paths=None, dry_run=False,
+                   api_xml_file=None):
+        """
+        Make an import request with the provided xml.
+
+        Returns a tuple of (request, response). If dry_run is True response
+        will be None as no request will be made. If api_xml_file is
+        provided it must be the path of a file containing api_xml, which is
+        uploaded as it is.
+        """
+        if paths is not None:
+            ensure_xml_only_affects_paths(api_xml, paths)
+
+        # The endpoint has CSRF protection via a CSRF token in a cookie. To
+        # avoid being killed by it, we need to obtain the CSRF token by
+        # GETting the page before trying to POST
+        csrf_token = self.get_csrf_token()
+
+        response = None
+        try:
+            # Construct a request explicitly so that we can return a prepared
+            # request for dry runs.
+            request = self.prepare_request(api_xml, csrf_token,
+                                           api_xml_file=api_xml_file)
+
+            # Don't actually send the POST if it's a dry_run
+            if dry_run:
+                return (request, None)
+
+            response = self.session.send(request, allow_redirects=False)
+            if response.status_code == requests.codes.forbidden:
+                request = self.prepare_request(
+                    api_xml, self.get_csrf_token(stale_token=csrf_token),
+                    api_xml_file=api_xml_file)
+                response = self.session.send(request, allow_redirects=False)
+
+            if response.status_code != requests.codes.ok:
+                response.raise_for_status()
+                raise ImportError("Non-200 status code received to request "
+                                  "for: {}. {}".format(self.url,
+                                                       response.status_code))
+        except RequestException as e:
+            if response is None:
+                raise ImportError(
+                    "Unable to make import request: {}".format(e), None, e)
+
+            raise ImportError(
+                "non-200 response received: {:d}".format(response.status_code),
+                response, e)
+        return (response.request, response)
 
-    # POST the XML file in a multi-part form.
-    files = {
-        FORM_FILE_FIELD: ("timetable.xml",
-                          etree.tostring(api_xml, encoding="utf-8"),
-                          "application/xml")
-    }
 
-    response = None
-    try:
-        # Construct a request explicitly so that we can return a prepared
-        # request for dry runs.
-        request = requests.Request(
-            b"POST", url, files=files, data=data, headers=headers,
-            cookies=cookies, auth=auth)
+def xmlimport(api_xml, domain, paths=None, proto="https", auth=None,
+              dry_run=False, session=None):
+    """
+    Make an import request to the Timetable API with the provided xml.
+    See ImportClient.import_xml().
+    """
+    client = ImportClient(domain, proto=proto, auth=auth, session=session)
+    return client.import_xml(api_xml, paths=paths, dry_run=dry_run)
 
-        # Don't actually send the POST if it's a dry_run
-        if dry_run:
-            return (request.prepare(), None)
 
-        response = requests.Session().send(request.prepare(), allow_redirects=False)
-        if response.status_code != requests.codes.ok:
-            response.raise_for_status()
-            raise ImportError("Non-200 status code received to request for: "
-                              "{}. {}".format(url, response.status_code))
-    except RequestException as e:
-        if response is None:
-            raise ImportError("Unable to make import request: {}".format(e), None, e)
+def split_module_list(api_xml, max_modules=None, max_bytes=None):
+    """
+    Split the modules of api_xml into a list of moduleList elements, each
+    with at most max_modules modules and max_bytes bytes of serialised
+    modules. A module larger than max_bytes is put in a batch on its own.
 
-        raise ImportError(
-            "non-200 response received: {:d}".format(response.status_code),
-            response, e)
-    return (response.request, response)
+    The modules are copied, and retain their order across the batches.
+    """
+    batches = []
+    batch = None
+    batch_bytes = 0
+    for module in api_xml.xpath("/moduleList/module"):
+        module_bytes = 0
+        if max_bytes is not None:
+            module_bytes = len(etree.tostring(module, encoding="utf-8"))
+
+        if (batch is None or
+                (max_modules is not None and len(batch) >= max_modules) or
+                (max_bytes is not None and
+                 batch_bytes + module_bytes > max_bytes)):
+            batch = etree.Element("moduleList")
+            batches.append(batch)
+            batch_bytes = 0
+
+        batch.append(deepcopy(module))
+        batch_bytes += module_bytes
+    return batches
+
+
+class BatchResult(object):
+    """
+    The outcome of importing one batch of modules. request and response
+    are those of the last attempt, and error is the ImportError it raised,
+    if it failed.
+    """
+    def __init__(self, index, api_xml):
+        self.index = index
+        self.api_xml = api_xml
+        self.attempts = 0
+        self.request = None
+        self.response = None
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.attempts > 0 and self.error is None
+
+    def to_json(self):
+        return {
+            "index": self.index,
+            "modules": len(self.api_xml),
+            "attempts": self.attempts,
+            "status_code": (None if self.response is None
+                            else self.response.status_code),
+            "error": None if self.error is None else "{}".format(
+                self.error.args[0])
+        }
+
+
+def xmlimport_batched(api_xml, domain, paths=None, proto="https", auth=None,
+                      dry_run=False, max_modules=None, max_bytes=None,
+                      concurrency=1, retries=0, session=None, client=None):
+    """
+    Import api_xml in batches of modules (see split_module_list()), with up
+    to concurrency batches being imported at once. Batches which fail are
+    retried up to retries times. The batches are imported with client if
+    it's provided, otherwise with a new ImportClient using session.
+
+    Every batch is checked to only affect paths before any are imported.
+    Returns a list of BatchResult in batch order, or raises
+    BatchImportError with the list as its second argument if any batches
+    failed.
+    """
+    results = [BatchResult(i, batch) for (i, batch) in enumerate(
+        split_module_list(api_xml, max_modules=max_modules,
+                          max_bytes=max_bytes))]
+
+    if paths is not None:
+        for result in results:
+            ensure_xml_only_affects_paths(result.api_xml, paths)
+
+    if client is None:
+        if session is None:
+            session = create_session(pool_size=max(concurrency, 1))
+        client = ImportClient(domain, proto=proto, auth=auth, session=session)
+
+    def import_batch(result):
+        result.attempts += 1
+        try:
+            result.request, result.response = client.import_xml(
+                result.api_xml, paths=paths, dry_run=dry_run)
+            result.error = None
+        except ImportError as e:
+            result.error = e
+            if len(e.args) > 1 and e.args[1] is not None:
+                result.response = e.args[1]
+
+    pending = results
+    for _ in range(retries + 1):
+        map_concurrently(import_batch, pending, concurrency=concurrency)
+        pending = [result for result in results if not result.succeeded]
+        if not pending:
+            return results
+
+    raise BatchImportError(
+        "{:d} of {:d} batches failed to import".format(
+            len(pending), len(results)), results)
 
 
 def print_response(response):
@@ -192,12 +439,21 @@ def main(argv):
     api_xml_file = args["<api-xml>"] or sys.stdin
     api_xml = parse_xml(api_xml_file)
 
+    client = ImportClient(domain, proto=proto, auth=credentials,
+                          session=create_session(
+                              pool_size=int(args["--concurrency"])),
+                          use_gzip=args["--gzip"])
+
+    if args["--batch-modules"] or args["--batch-bytes"]:
+        batched_import_main(args, api_xml, client, paths)
+        return
+
     try:
-        response = xmlimport(api_xml, domain, paths=paths, proto=proto,
-                             auth=credentials, dry_run=dry_run)
+        request, response = client.import_xml(
+            api_xml, paths=paths, dry_run=dry_run,
+            api_xml_file=args["<api-xml>"])
         if dry_run:
-            prepared_request = response
-            print_dry_run_prepared_request(prepared_request)
+            print_dry_run_prepared_request(request)
             return
     except ImportError as e:
         if args["--verbose"] and e.args[1] is not None:
@@ -207,3 +463,37 @@ def main(argv):
 
     if args["--verbose"]:
         print_response(response)
+
+
+def _optional_int(value):
+    return None if value is None else int(value)
+
+
+def print_batch_results(results, verbose):
+    for result in results:
+        print("batch {index:d}: {modules:d} modules, {attempts:d} attempts, "
+              "status {status_code}, error: {error}"
+              .format(**result.to_json()), file=sys.stderr)
+        if verbose and result.response is not None:
+            print_response(result.response)
+
+
+def batched_import_main(args, api_xml, client, paths):
+    dry_run = args["--dry-run"]
+    try:
+        results = xmlimport_batched(
+            api_xml, client.domain, paths=paths, client=client,
+            dry_run=dry_run,
+            max_modules=_optional_int(args["--batch-modules"]),
+            max_bytes=_optional_int(args["--batch-bytes"]),
+            concurrency=int(args["--concurrency"]),
+            retries=int(args["--retries"]))
+    except BatchImportError as e:
+        print_batch_results(e.args[1], args["--verbose"])
+        raise
+
+    if dry_run:
+        for result in results:
+            print_dry_run_prepared_request(result.request)
+        return
+    print_batch_results(results, args["--verbose"])